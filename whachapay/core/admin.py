@@ -1,16 +1,55 @@
 from django.contrib import admin
-from core.models import (Deal, Dealer, IPAddress, Make, MakeYear, Model,
-                         ModelYear, Trim, TrimYear, User, UserIP, Vehicle)
+from core import queries, tasks
+from core.models import (Deal, Dealer, DealMonthStats, DealStats, IPAddress,
+                         Make, MakeYear, Model, ModelYear, Task, Trim,
+                         TrimYear, User, UserIP, Vehicle)
 
-admin.site.register(Deal)
+def approve_deals(modeladmin, request, queryset):
+    """Clear the spam flag of the selected deals. See core.spam."""
+    approved = queries.approve_deals(queryset.values_list('pk', flat=True))
+    tasks.run_eager()
+    modeladmin.message_user(request, 'Approved %d deals.' % approved)
+approve_deals.short_description = 'Approve the selected flagged deals'
+
+def flag_deals(modeladmin, request, queryset):
+    """Flag the selected deals as spam. See core.spam."""
+    flagged = queries.flag_deals(queryset.values_list('pk', flat=True))
+    modeladmin.message_user(request, 'Flagged %d deals.' % flagged)
+flag_deals.short_description = 'Flag the selected deals as spam'
+
+class DealAdmin(admin.ModelAdmin):
+    # The names are stored with the deal, so the changelist is one query.
+    list_display = ('year', 'make_name', 'model_name', 'trim_name',
+                    'dealer_name', 'price', 'date', 'flagged', 'spam_reasons')
+    list_filter = ('flagged',)
+    # Select widgets would list every vehicle, trim, dealer, and user IP.
+    raw_id_fields = ('user_ip', 'vehicle', 'trim', 'dealer')
+    # Changed with the actions, which update the stats.
+    readonly_fields = ('flagged',)
+    actions = [approve_deals, flag_deals]
+
+class DealStatsAdmin(admin.ModelAdmin):
+    list_select_related = True
+    raw_id_fields = ('vehicle', 'trim', 'dealer')
+
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('name', 'arg', 'created', 'attempts')
+
+class VehicleAdmin(admin.ModelAdmin):
+    list_select_related = True
+
+admin.site.register(Deal, DealAdmin)
 admin.site.register(Dealer)
+admin.site.register(DealMonthStats, DealStatsAdmin)
+admin.site.register(DealStats, DealStatsAdmin)
 admin.site.register(IPAddress)
 admin.site.register(Make)
 admin.site.register(MakeYear)
 admin.site.register(Model)
 admin.site.register(ModelYear)
+admin.site.register(Task, TaskAdmin)
 admin.site.register(Trim)
 admin.site.register(TrimYear)
 admin.site.register(User)
 admin.site.register(UserIP)
-admin.site.register(Vehicle)
+admin.site.register(Vehicle, VehicleAdmin)
@@ -0,0 +1,86 @@
+"""
+PostgreSQL backend that keeps its connections in a per process pool (see
+core.pool) instead of opening one per request: Django closes a request's
+connection when it finishes, which returns it to the pool, and the next
+request's first query takes it back, skipping the connection setup: the TCP
+and TLS handshakes, authentication, and the backend process fork.
+
+A connection is rolled back as it is returned, so no transaction outlives its
+request. One that has been idle for more than
+settings.DATABASE_POOL_CHECK_AFTER seconds is checked with a query before it
+is reused. Set the ENGINE of a database to 'core.backends.postgresql_pool' to
+use it; settings.py does so for the PostgreSQL databases.
+"""
+import time
+from django.conf import settings
+from django.db.backends.postgresql_psycopg2 import base
+from core import pool
+
+Database = base.Database
+
+class DatabaseCreation(base.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # The pooled connections to the test database would keep it from
+        # being dropped.
+        pool.clear()
+        super(DatabaseCreation, self)._destroy_test_db(test_database_name,
+                                                       verbosity)
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        self.creation = DatabaseCreation(self)
+        # When the current connection was opened.
+        self.connection_opened = None
+
+    def get_pool(self):
+        """Returns the pool of the connections with these settings."""
+        s = self.settings_dict
+        key = (s['NAME'], s['USER'], s['PASSWORD'], s['HOST'], s['PORT'],
+               tuple(sorted(s['OPTIONS'].items())))
+        return pool.get_pool(key, settings.DATABASE_POOL_SIZE,
+                             settings.DATABASE_POOL_MAX_AGE, check_connection,
+                             close_connection)
+
+    def _cursor(self):
+        if self.connection is None:
+            pooled = self.get_pool().get()
+            if pooled:
+                self.connection, self.connection_opened = pooled
+                self.connection.set_isolation_level(self.isolation_level)
+            else:
+                self.connection_opened = time.time()
+        return super(DatabaseWrapper, self)._cursor()
+
+    def close(self):
+        self.validate_thread_sharing()
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        try:
+            connection.rollback()
+        except Database.Error:
+            close_connection(connection)
+        else:
+            self.get_pool().put(connection, self.connection_opened)
+
+def check_connection(connection, idle):
+    """Returns bool, whether a pooled connection can be reused."""
+    if connection.closed:
+        return False
+    if idle < settings.DATABASE_POOL_CHECK_AFTER:
+        return True
+    try:
+        connection.cursor().execute('SELECT 1')
+        # Don't leave the check's transaction open.
+        connection.rollback()
+    except Database.Error:
+        return False
+    return True
+
+def close_connection(connection):
+    """Close a connection, which may already be broken."""
+    try:
+        connection.close()
+    except Database.Error:
+        pass
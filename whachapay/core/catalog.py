@@ -0,0 +1,240 @@
+"""
+In-process index of the vehicle catalog (makes, models, and trims by year),
+so that the selection dropdowns don't query the database.
+
+The index is immutable and rebuilt whenever the catalog version changes. The
+version is a CatalogVersion row, changed by the catalog models' post_save and
+post_delete signals, which fire for both fixture loads and admin edits, in
+the edit's transaction. It is kept in the Django cache for
+settings.CATALOG_VERSION_TTL seconds, and edits clear it there, so with a
+cache shared between processes an edit in one process invalidates the index
+in all of them at once, and otherwise within that time.
+
+The index can also be saved to a snapshot file at deploy time, with the
+build_catalog_snapshot command, so that a new process loads its first index
+from settings.CATALOG_SNAPSHOT instead of the catalog tables. The snapshot
+holds the version it was built at, and is only used while the database is
+still at that version, which takes one query: a snapshot older than the
+catalog is ignored, and the index is built from the database.
+"""
+import json, marshal, os, tempfile, threading, time
+from django.conf import settings
+from django.core.cache import cache
+from core import replicas
+
+VERSION_KEY = 'catalog:version'
+
+# Changed whenever the snapshot contents change, so that an old snapshot is
+# ignored rather than misread.
+SNAPSHOT_FORMAT = 1
+
+class CatalogIndex(object):
+    """
+    Immutable catalog lookup tables. Options are tuples of (pk, name) pairs,
+    ordered by name.
+    """
+    def __init__(self, version, years, makes, models, trims, make_names,
+                 model_names, trim_names):
+        self.version = version
+        # Tuple of the distinct make years, ascending.
+        self.years = years
+        # Keyed by year.
+        self._makes = makes
+        # Keyed by (make pk, year).
+        self._models = models
+        # Keyed by (model pk, year).
+        self._trims = trims
+        # Keyed by pk.
+        self._make_names = make_names
+        self._model_names = model_names
+        self._trim_names = trim_names
+        # Memoized serialized options, keyed by (year, make pk).
+        self._options_json = {}
+
+    def get_makes(self, year):
+        return self._makes.get(year, ())
+
+    def get_models(self, make_pk, year):
+        return self._models.get((make_pk, year), ())
+
+    def get_trims(self, model_pk, year):
+        return self._trims.get((model_pk, year), ())
+
+    def get_options_json(self, year, make_pk):
+        """
+        Get the make options for a year, and the model options for a year and
+        make, serialized once per index.
+
+        Returns string: '{"makes": [[pk, name]], "models": [[pk, name]]}'
+        """
+        key = (year, make_pk)
+        options = self._options_json.get(key)
+        if options is None:
+            options = self._options_json[key] = json.dumps(
+                {'makes': self.get_makes(year),
+                 'models': self.get_models(make_pk, year)})
+        return options
+
+    def get_make_name(self, make_pk):
+        return self._make_names[make_pk]
+
+    def get_model_name(self, model_pk):
+        return self._model_names[model_pk]
+
+    def get_trim_name(self, trim_pk):
+        return self._trim_names[trim_pk]
+
+    def get_snapshot(self):
+        """
+        Returns dictionary of the index's tables, which marshal can serialize.
+        """
+        return {'format': SNAPSHOT_FORMAT, 'version': self.version,
+                'years': self.years, 'makes': self._makes,
+                'models': self._models, 'trims': self._trims,
+                'make_names': self._make_names,
+                'model_names': self._model_names,
+                'trim_names': self._trim_names}
+
+def build_index(version):
+    """
+    Build the index from the catalog tables, in one query per table.
+
+    Returns CatalogIndex.
+    """
+    from core.models import Make, MakeYear, Model, ModelYear, Trim, TrimYear
+
+    make_names = dict(Make.objects.values_list('pk', 'name'))
+    model_names, model_makes = {}, {}
+    for pk, make, name in Model.objects.values_list('pk', 'make', 'name'):
+        model_names[pk] = name
+        model_makes[pk] = make
+    trim_names, trim_models = {}, {}
+    for pk, model, name in Trim.objects.values_list('pk', 'model', 'name'):
+        trim_names[pk] = name
+        trim_models[pk] = model
+
+    makes = group_by_year(MakeYear.objects.values_list('make', 'year'),
+                          lambda make, year: year, make_names)
+    models = group_by_year(ModelYear.objects.values_list('model', 'year'),
+                           lambda model, year: (model_makes[model], year),
+                           model_names)
+    trims = group_by_year(TrimYear.objects.values_list('trim', 'year'),
+                          lambda trim, year: (trim_models[trim], year),
+                          trim_names)
+    years = tuple(sorted(makes))
+    return CatalogIndex(version, years, makes, models, trims, make_names,
+                        model_names, trim_names)
+
+def group_by_year(rows, get_key, names):
+    """
+    Group (pk, year) rows into option tuples of (pk, name), ordered by name.
+
+    Returns dictionary keyed by get_key(pk, year).
+    """
+    groups = {}
+    for pk, year in rows:
+        groups.setdefault(get_key(pk, year), set()).add((pk, names[pk]))
+    return dict((key, tuple(sorted(options, key=lambda o: (o[1], o[0]))))
+                for key, options in groups.iteritems())
+
+def get_version():
+    """
+    Get the current catalog version, from the cache if it has it, and
+    otherwise from the database.
+
+    Returns int.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        from core.models import CatalogVersion
+        # Not from a lagging replica, as it is cached.
+        with replicas.use_primary():
+            versions = list(CatalogVersion.objects.values_list('version',
+                                                               flat=True))
+        # Until the catalog is first edited.
+        version = versions[0] if versions else 0
+        cache.set(VERSION_KEY, version, settings.CATALOG_VERSION_TTL)
+    return version
+
+def bump_version():
+    """Change the catalog version, in the current transaction."""
+    from core.models import CatalogVersion
+    rows = CatalogVersion.objects.select_for_update().filter(pk=1)
+    versions = list(rows.values_list('version', flat=True))
+    # Time based, so that the version of an edit rolled back after an index
+    # was built from it isn't reused by the next one.
+    version = int(time.time() * 1000)
+    if versions:
+        rows.update(version=max(versions[0] + 1, version))
+    else:
+        CatalogVersion.objects.create(pk=1, version=version)
+    cache.delete(VERSION_KEY)
+
+def save_snapshot(path):
+    """
+    Save the index for the current catalog version to a snapshot file,
+    replacing it atomically.
+
+    Returns CatalogIndex, the index saved.
+    """
+    index = get_index()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(index.get_snapshot(), f)
+        os.rename(temp, path)
+    except:
+        os.remove(temp)
+        raise
+    return index
+
+def load_snapshot(path):
+    """
+    Load the index from a snapshot file. It is only current if its version
+    is the catalog version.
+
+    Returns CatalogIndex, or None if there is no usable snapshot.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        try:
+            data = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return None
+    if not isinstance(data, dict) or data.get('format') != SNAPSHOT_FORMAT:
+        return None
+    return CatalogIndex(data['version'], data['years'], data['makes'],
+                        data['models'], data['trims'], data['make_names'],
+                        data['model_names'], data['trim_names'])
+
+_index = None
+_index_lock = threading.Lock()
+_snapshot_loaded = False
+
+def get_index():
+    """
+    Get the index for the current catalog version, rebuilding it if the
+    version has changed. A process's first index is loaded from the snapshot
+    if there is one of the current version.
+
+    Returns CatalogIndex.
+    """
+    global _index, _snapshot_loaded
+    if not _snapshot_loaded:
+        with _index_lock:
+            if not _snapshot_loaded:
+                _index = load_snapshot(settings.CATALOG_SNAPSHOT) or _index
+                _snapshot_loaded = True
+    version = get_version()
+    index = _index
+    if index is None or index.version != version:
+        with _index_lock:
+            index = _index
+            if index is None or index.version != version:
+                # Kept until the next version, so not from a lagging
+                # replica.
+                with replicas.use_primary():
+                    index = _index = build_index(version)
+    return index
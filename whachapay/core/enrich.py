@@ -0,0 +1,87 @@
+"""
+Dealer enrichment. Dealers are created from Places search results, which only
+have a vicinity string; the enrich_dealers command fills in their structured
+address and precise coordinates with Place Details lookups, and a Static Maps
+image URL, so that their pages can show a plain image rather than building a
+JavaScript map per dealer.
+
+Dealers waiting for enrichment have no enriched time, whether they were
+created by the views, imported, or generated. The lookups of a batch run in
+parallel on the Places client's thread pool, at most
+settings.GMAP_DETAILS_RATE per second, outside any transaction; the results
+are then saved in one. A dealer whose lookup failed stays waiting, behind
+the dealers not tried as often, to be retried by a later batch; after
+settings.GMAP_ENRICH_MAX_ATTEMPTS failures it is given up on and only gets
+the map image, like the dealers without a reference, such as imported ones.
+
+The updates are saved without signals, so the batch bumps the dealer index,
+and the page caches of the enriched dealers, once at the end.
+"""
+from datetime import datetime
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from core import geo, page_cache, places, util
+from core.models import Deal, Dealer
+
+def enrich_dealers(batch_size=None, client=None):
+    """
+    Enrich a batch of the waiting dealers, least tried and then oldest first,
+    of at most batch_size, by default settings.GMAP_ENRICH_BATCH_SIZE.
+
+    Returns tuple of ints: (dealers enriched, dealers whose lookup failed).
+    """
+    dealers = list(Dealer.objects.filter(enriched__isnull=True)
+                   .order_by('enrich_attempts', 'pk')
+                   .values_list('pk', 'location', 'reference',
+                                'enrich_attempts')
+                   [:batch_size or settings.GMAP_ENRICH_BATCH_SIZE])
+    if not dealers:
+        return 0, 0
+    references = [r for pk, location, r, attempts in dealers if r]
+    details = {}
+    if references:
+        details = (client or places.get_client()).get_details(references)
+    enriched = []
+    with transaction.commit_on_success():
+        for pk, location, reference, attempts in dealers:
+            values = {}
+            if reference:
+                values = details.get(reference)
+                if values is None:
+                    if attempts + 1 < settings.GMAP_ENRICH_MAX_ATTEMPTS:
+                        Dealer.objects.filter(pk=pk).update(
+                            enrich_attempts=F('enrich_attempts') + 1)
+                        continue
+                    values = {'enrich_attempts': attempts + 1}
+            values = dict(values)
+            location = values.pop('location', location)
+            lat, lng = util.get_lat_lng(location)
+            values.update(location=location, latitude=lat, longitude=lng,
+                          enriched=datetime.now())
+            if lat is not None:
+                values['map_url'] = places.get_static_map_url(location)
+            Dealer.objects.filter(pk=pk).update(**values)
+            enriched.append(pk)
+    if enriched:
+        geo.bump_version()
+        page_cache.bump(*get_page_keys(enriched))
+    return len(enriched), len(dealers) - len(enriched)
+
+def get_page_keys(dealer_pks):
+    """
+    Get the version keys of the pages of the given dealers: their dealer
+    pages, one for each vehicle they have deals of, and their deals' detail
+    pages.
+
+    Returns set of strings.
+    """
+    keys = set()
+    for chunk in util.get_chunks(dealer_pks):
+        for pk, year, make, model, place_id in (
+                Deal.objects.filter(dealer__in=chunk)
+                .values_list('pk', 'year', 'vehicle__make', 'vehicle__model',
+                             'dealer__place_id')):
+            keys.add(page_cache.get_dealer_key(year, make, model, place_id))
+            keys.add(page_cache.get_deal_key(pk))
+    return keys
@@ -0,0 +1,123 @@
+"""
+Streaming exports of the deals, less the flagged ones (see core.spam), and
+the per vehicle, trim, and dealer price statistics, as CSV or NDJSON.
+
+Rows are read in chunks of chunk_size by primary key ranges (WHERE pk > last
+ORDER BY pk LIMIT chunk_size), each chunk in its own short query, so an export
+of any size holds one chunk in memory and never keeps a long-running
+transaction open. Django 1.4 has no server-side cursor support, and a named
+psycopg2 cursor would pin a transaction for the length of the export.
+"""
+import csv, json
+from cStringIO import StringIO
+from core.models import Deal, DealStats
+
+# (column name, field lookup)
+VEHICLE_COLUMNS = (
+    ('year', 'vehicle__make_year__year'),
+    ('make', 'vehicle__make__name'),
+    ('model', 'vehicle__model__name'),
+    ('trim', 'trim__name'),
+    ('place_id', 'dealer__place_id'),
+    ('dealer_name', 'dealer__name'),
+)
+
+# Deals carry the names, so only the place id needs a join.
+DEAL_COLUMNS = (
+    ('id', 'pk'),
+    ('year', 'year'),
+    ('make', 'make_name'),
+    ('model', 'model_name'),
+    ('trim', 'trim_name'),
+    ('place_id', 'dealer__place_id'),
+    ('dealer_name', 'dealer_name'),
+    ('price', 'price'),
+    ('date', 'date'),
+    ('comment', 'comment'),
+)
+
+STATS_COLUMNS = VEHICLE_COLUMNS + (
+    ('count', 'count'),
+    ('sum', 'sum'),
+    ('avg', None),
+    ('min_price', 'min_price'),
+    ('max_price', 'max_price'),
+    ('sum_squares', 'sum_squares'),
+)
+
+# kind: (model, columns)
+EXPORTS = {
+    'deals': (Deal, DEAL_COLUMNS),
+    'stats': (DealStats, STATS_COLUMNS),
+}
+
+FORMATS = ('csv', 'ndjson')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+def get_columns(kind):
+    """Returns list of the column names of an export."""
+    return [name for name, lookup in EXPORTS[kind][1]]
+
+def iter_rows(kind, vehicle=None, dealer=None, chunk_size=1000):
+    """
+    Read the rows of an export, optionally limited to a vehicle pk and a
+    dealer place id.
+
+    Yields dictionaries of column values.
+    """
+    model, columns = EXPORTS[kind]
+    lookups = ['pk'] + [lookup for name, lookup in columns
+                        if lookup and lookup != 'pk']
+    rows = model.objects.order_by('pk')
+    if kind == 'deals':
+        rows = rows.filter(flagged=False)
+    if vehicle:
+        rows = rows.filter(vehicle=vehicle)
+    if dealer:
+        rows = rows.filter(dealer__place_id=dealer)
+    last = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last).values(*lookups)[:chunk_size])
+        for values in chunk:
+            row = dict((name, values[lookup]) for name, lookup in columns
+                       if lookup)
+            if kind == 'stats':
+                row['avg'] = values['sum'] / values['count']
+            yield row
+        if len(chunk) < chunk_size:
+            break
+        last = chunk[-1]['pk']
+
+def iter_export(kind, format='csv', **kwargs):
+    """
+    Encode the rows of an export, with a header row for CSV. Takes the
+    iter_rows keyword arguments.
+
+    Yields byte strings of one or more lines.
+    """
+    columns = get_columns(kind)
+    if format == 'ndjson':
+        for row in iter_rows(kind, **kwargs):
+            yield json.dumps(row, default=unicode) + '\n'
+        return
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for i, row in enumerate(iter_rows(kind, **kwargs), 1):
+        writer.writerow([encode_csv(row[c]) for c in columns])
+        # Flush every so often rather than yielding each line.
+        if i % 100 == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def encode_csv(value):
+    """Returns the value as a csv module friendly string."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
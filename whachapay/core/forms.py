@@ -1,8 +1,7 @@
 import pprint
 from django import forms
 from django.core.exceptions import ValidationError
-from core.models import MakeYear
-from core.queries import get_trim_options
+from core.queries import get_make_years, get_trim_options
 
 _pp = pprint.PrettyPrinter(indent=2)
 
@@ -37,11 +36,9 @@ class AjaxChoiceField(forms.ChoiceField):
         validate_positive(value, self.label)
 
 class HomeForm(forms.Form):
-    # Get distinct make_years.
-    make_year_choices = [(year, year) for year in MakeYear.objects.values_list(
-            'year', flat=True).distinct().order_by('year')]
-    make_year_choices.insert(0, (0, 'Year'))
-    make_year = forms.ChoiceField(label='Year', choices=make_year_choices,
+    # The years are loaded from the catalog index in __init__, so that they
+    # follow catalog edits and importing the form doesn't query the database.
+    make_year = forms.ChoiceField(label='Year', choices=[(0, 'Year')],
                                   validators=[validate_make_year])
 
     """
@@ -64,6 +61,12 @@ class HomeForm(forms.Form):
     place_name = forms.CharField(widget=forms.HiddenInput)
     lat_lng = forms.CharField(widget=forms.HiddenInput)
 
+    def __init__(self, *args, **kwargs):
+        """Load the distinct make years."""
+        super(HomeForm, self).__init__(*args, **kwargs)
+        self.fields['make_year'].choices = [(0, 'Year')] + [
+            (year, year) for year in get_make_years()]
+
 class TrimForm(forms.Form):
     trim = forms.ChoiceField()
 
@@ -73,8 +76,8 @@ class TrimForm(forms.Form):
         model_pk = kwargs.pop('model_pk')
         trim_year = kwargs.pop('trim_year')
         super(TrimForm, self).__init__(*args, **kwargs)
-        self.fields['trim'].choices = (
-            [(m.id, m.name) for m in get_trim_options(model_pk, trim_year)])
+        self.fields['trim'].choices = list(get_trim_options(model_pk,
+                                                            trim_year))
         self.fields['trim'].choices.insert(0, (0, 'All Trims'))
         self.fields['trim'].initial = 0
 
@@ -0,0 +1,113 @@
+"""
+In-process spatial index of the known dealers, so that area searches are
+answered from local data rather than a live Places search.
+
+Dealers are bucketed into a grid of DEALER_INDEX_CELL_SIZE degree cells. A
+radius query scans only the cells that overlap the search circle's bounding
+box. Like the catalog index (see core.catalog), the index is immutable and
+rebuilt when its version stamp in the Django cache changes; the stamp is
+bumped by the Dealer post_save and post_delete signals, and by deal imports,
+which create dealers with bulk_create.
+"""
+import math, threading
+from django.conf import settings
+from core import replicas, util
+
+VERSION_KEY = 'dealers:version'
+
+# Meters per degree of latitude.
+METERS_PER_DEGREE = math.pi * util.EARTH_RADIUS / 180
+
+class DealerIndex(object):
+    """
+    Immutable grid of dealers. Dealers are tuples of
+    (place id, latitude, longitude).
+    """
+    def __init__(self, version, cell_size, cells):
+        self.version = version
+        self.cell_size = cell_size
+        # Lists of dealers, keyed by (lat cell, lng cell).
+        self._cells = cells
+
+    def __len__(self):
+        return sum(len(dealers) for dealers in self._cells.itervalues())
+
+    def get_nearby(self, lat, lng, radius):
+        """
+        Get the dealers within radius meters of a point.
+
+        Returns list of (distance, place id) tuples, nearest first.
+        """
+        lat_span = radius / METERS_PER_DEGREE
+        # Degrees of longitude shrink towards the poles.
+        lng_span = min(180, lat_span / max(math.cos(math.radians(lat)), 0.01))
+        lat_cells = get_cell_range(lat - lat_span, lat + lat_span,
+                                   self.cell_size)
+        lng_cells = get_cell_range(lng - lng_span, lng + lng_span,
+                                   self.cell_size)
+        nearby = []
+        for lat_cell in lat_cells:
+            for lng_cell in lng_cells:
+                for place_id, d_lat, d_lng in self._cells.get(
+                        (lat_cell, lng_cell), ()):
+                    distance = util.get_distance(lat, lng, d_lat, d_lng)
+                    if distance <= radius:
+                        nearby.append((distance, place_id))
+        nearby.sort()
+        return nearby
+
+def get_cell(value, cell_size):
+    """Returns int, the grid cell of a latitude or longitude."""
+    return int(math.floor(value / cell_size))
+
+def get_cell_range(low, high, cell_size):
+    """Returns list of the grid cells from low to high degrees."""
+    return range(get_cell(low, cell_size), get_cell(high, cell_size) + 1)
+
+def build_index(version):
+    """
+    Build the index from the Dealer table, in one query.
+
+    Returns DealerIndex.
+    """
+    from core.models import Dealer
+
+    cell_size = settings.DEALER_INDEX_CELL_SIZE
+    cells = {}
+    for place_id, lat, lng in Dealer.objects.filter(
+            latitude__isnull=False, longitude__isnull=False).values_list(
+            'place_id', 'latitude', 'longitude'):
+        key = (get_cell(lat, cell_size), get_cell(lng, cell_size))
+        cells.setdefault(key, []).append((place_id, lat, lng))
+    return DealerIndex(version, cell_size, cells)
+
+def get_version():
+    """Get the current dealer version stamp. Returns int."""
+    return util.get_version_stamp(VERSION_KEY)
+
+def bump_version():
+    """Invalidate every process's index."""
+    util.bump_version_stamp(VERSION_KEY)
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """
+    Get the index for the current dealer version, rebuilding it if the
+    version has changed.
+
+    Returns DealerIndex.
+    """
+    global _index
+    version = get_version()
+    index = _index
+    if index is None or index.version != version:
+        with _index_lock:
+            index = _index
+            if index is None or index.version != version:
+                # Kept until the next version, so not from a lagging
+                # replica.
+                with replicas.use_primary():
+                    index = _index = build_index(version)
+    return index
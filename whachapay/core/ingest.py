@@ -0,0 +1,339 @@
+"""
+Batch deal ingestion, for backfilling deals from partner feeds.
+
+Records are read lazily and processed in batches. Each batch resolves its IP
+addresses, users, vehicles, and dealers with a handful of IN queries, creates
+the missing ones with bulk_create, and then bulk creates its deals, all in one
+transaction. Deals are deduplicated by a hash of their content, so re-running
+an import is harmless. On SQLite, the IN lookups and inserts are split to fit
+its limits; see util.bulk_create.
+
+A record is a dictionary of strings, or of numbers for year and price:
+    { 'email': '',
+      'ip': '',
+      'year': '',
+      'make': '',
+      'model': '',
+      'trim': '',
+      'place_id': '',
+      'dealer_name': '',
+      'dealer_location': '',
+      'dealer_address': '',
+      'price': '',
+      'date': '',
+      'comment': '' }
+make, model, and trim are catalog names; date is YYYY-MM-DD; comment is
+optional.
+"""
+import csv, hashlib, json, logging
+from datetime import datetime
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_ipv4_address
+from django.db import transaction
+from core import geo, page_cache, queries, util
+from core.models import (Deal, Dealer, IPAddress, Make, MakeYear, Model, Trim,
+                         User, UserIP, Vehicle)
+
+logger = logging.getLogger(__name__)
+
+HASH_FIELDS = ('email', 'ip', 'year', 'make', 'model', 'trim', 'place_id',
+               'price', 'date', 'comment')
+
+class IngestError(ValueError):
+    """A record that can't be imported."""
+    pass
+
+class IngestResult(object):
+    """Running counts for an import."""
+    def __init__(self):
+        self.created = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    @property
+    def total(self):
+        return self.created + self.duplicates + self.rejected
+
+class DealIngester(object):
+    """
+    Imports deal records in batches of batch_size.
+    """
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self._catalog = None
+        self._names = None
+
+    def ingest(self, records, result=None):
+        """
+        Import an iterable of records. Only one batch is held in memory.
+
+        Returns IngestResult.
+        """
+        result = result or IngestResult()
+        batch = []
+        for number, record in enumerate(records, 1):
+            try:
+                batch.append(self.clean(record))
+            except IngestError, e:
+                result.rejected += 1
+                logger.warning('Rejected record %d: %s', number, e)
+                continue
+            if len(batch) >= self.batch_size:
+                self.ingest_batch(batch, result)
+                batch = []
+        if batch:
+            self.ingest_batch(batch, result)
+        if result.created:
+            # New dealers were bulk created, without signals.
+            geo.bump_version()
+            page_cache.bump_all()
+        return result
+
+    def clean(self, record):
+        """
+        Validate a record, and resolve its catalog names to pks.
+
+        Returns dictionary, or raises IngestError.
+        """
+        if not isinstance(record, dict):
+            raise IngestError('record is not an object.')
+        try:
+            row = dict((f, unicode(record.get(f) or u'').strip())
+                       for f in HASH_FIELDS + ('dealer_name', 'dealer_location',
+                                               'dealer_address'))
+            row['year'] = int(row['year'])
+            row['price'] = int(row['price'])
+            row['date'] = datetime.strptime(row['date'], '%Y-%m-%d').date()
+        except ValueError, e:
+            raise IngestError(e)
+        for f in ('email', 'ip', 'place_id', 'dealer_name'):
+            if not row[f]:
+                raise IngestError('%s is required.' % f)
+        if not 100 <= row['price'] <= 1000000:
+            raise IngestError('price %d is out of range.' % row['price'])
+        try:
+            validate_ipv4_address(row['ip'])
+        except ValidationError:
+            # PostgreSQL would reject the whole batch.
+            raise IngestError('ip %s is not an IPv4 address.' % row['ip'])
+
+        makes, make_years, models, trims = self.get_catalog()
+        try:
+            row['make_pk'] = makes[row['make'].lower()]
+            row['make_year_pk'] = make_years[(row['make_pk'], row['year'])]
+            row['model_pk'] = models[(row['make_pk'], row['model'].lower())]
+            row['trim_pk'] = trims[(row['model_pk'], row['trim'].lower())]
+        except KeyError, e:
+            raise IngestError('%s is not in the catalog.' % (e,))
+        row['content_hash'] = get_content_hash(row)
+        return row
+
+    def get_catalog(self):
+        """
+        Build the catalog lookup maps, once per ingester.
+
+        Returns tuple of dictionaries: make pk by lowercase name, make year pk
+        by (make pk, year), model pk by (make pk, lowercase name), and trim pk
+        by (model pk, lowercase name).
+        """
+        if self._catalog is None:
+            make_names = dict(Make.objects.values_list('pk', 'name'))
+            makes = dict((name.lower(), pk)
+                         for pk, name in make_names.iteritems())
+            make_years = dict(((make, year), pk) for pk, make, year in
+                              MakeYear.objects.values_list('pk', 'make',
+                                                           'year'))
+            models, model_names = {}, {}
+            for pk, make, name in Model.objects.values_list('pk', 'make',
+                                                            'name'):
+                models[(make, name.lower())] = pk
+                model_names[pk] = name
+            trims, trim_names = {}, {}
+            for pk, model, name in Trim.objects.values_list('pk', 'model',
+                                                            'name'):
+                trims[(model, name.lower())] = pk
+                trim_names[pk] = name
+            self._names = (make_names, model_names, trim_names)
+            self._catalog = (makes, make_years, models, trims)
+        return self._catalog
+
+    def get_names(self):
+        """
+        Returns tuple of dictionaries of the make, model, and trim names by
+        pk.
+        """
+        self.get_catalog()
+        return self._names
+
+    def ingest_batch(self, rows, result):
+        """
+        Import a batch of cleaned rows in one transaction.
+
+        Nothing returned; result is updated.
+        """
+        with transaction.commit_on_success():
+            # Deduplicate within the batch, and against earlier imports.
+            unique = {}
+            for row in rows:
+                unique.setdefault(row['content_hash'], row)
+            existing = set()
+            for chunk in util.get_chunks(unique.keys()):
+                existing.update(Deal.objects.filter(
+                    content_hash__in=chunk).values_list('content_hash',
+                                                        flat=True))
+            new_rows = [r for h, r in unique.iteritems() if h not in existing]
+            result.duplicates += len(rows) - len(new_rows)
+            if not new_rows:
+                return
+
+            user_ips = self.resolve_user_ips(new_rows)
+            vehicles = self.resolve_vehicles(new_rows)
+            dealers = self.resolve_dealers(new_rows)
+            # bulk_create doesn't send pre_save, so copy the names here.
+            names = self.get_names()
+            dealer_names = {}
+            for chunk in util.get_chunks(set(dealers.values())):
+                dealer_names.update(Dealer.objects.filter(
+                    pk__in=chunk).values_list('pk', 'name'))
+            util.bulk_create(Deal,
+                [Deal(user_ip_id=user_ips[(r['email'], r['ip'])],
+                      vehicle_id=vehicles[(r['make_year_pk'], r['make_pk'],
+                                           r['model_pk'])],
+                      trim_id=r['trim_pk'],
+                      dealer_id=dealers[r['place_id']],
+                      price=r['price'],
+                      date=r['date'],
+                      comment=r['comment'],
+                      content_hash=r['content_hash'],
+                      year=r['year'],
+                      make_name=names[0][r['make_pk']],
+                      model_name=names[1][r['model_pk']],
+                      trim_name=names[2][r['trim_pk']],
+                      dealer_name=dealer_names[dealers[r['place_id']]])
+                 for r in new_rows])
+            result.created += len(new_rows)
+
+    def resolve_user_ips(self, rows):
+        """Returns dictionary of UserIP pk by (email, ip)."""
+        ips = resolve(IPAddress, 'ip', set(r['ip'] for r in rows),
+                      lambda ip: IPAddress(ip=ip))
+        users = resolve(User, 'email', set(r['email'] for r in rows),
+                        lambda email: User(email=email))
+        pairs = set((users[r['email']], ips[r['ip']]) for r in rows)
+        user_ips = get_user_ips(pairs)
+        missing = pairs.difference(user_ips)
+        if missing:
+            util.bulk_create(UserIP, [UserIP(user_id=u, ip_id=i)
+                                      for u, i in missing])
+            user_ips.update(get_user_ips(missing))
+        return dict(((r['email'], r['ip']),
+                     user_ips[(users[r['email']], ips[r['ip']])])
+                    for r in rows)
+
+    def resolve_vehicles(self, rows):
+        """Returns dictionary of Vehicle pk by (make year, make, model) pk."""
+        keys = set((r['make_year_pk'], r['make_pk'], r['model_pk'])
+                   for r in rows)
+        vehicles = get_vehicles(keys)
+        missing = keys.difference(vehicles)
+        if missing:
+            util.bulk_create(Vehicle,
+                [Vehicle(make_year_id=my, make_id=ma, model_id=mo)
+                 for my, ma, mo in missing])
+            vehicles.update(get_vehicles(missing))
+        return vehicles
+
+    def resolve_dealers(self, rows):
+        """Returns dictionary of Dealer pk by place id."""
+        places = dict((r['place_id'], r) for r in rows)
+        def build(place_id):
+            # bulk_create doesn't send pre_save, so parse the coordinates here.
+            location = places[place_id]['dealer_location']
+            lat, lng = util.get_lat_lng(location)
+            return Dealer(place_id=place_id,
+                          name=places[place_id]['dealer_name'],
+                          location=location,
+                          address=places[place_id]['dealer_address'],
+                          latitude=lat,
+                          longitude=lng)
+        return resolve(Dealer, 'place_id', places.keys(), build)
+
+def resolve(model, field, values, build):
+    """
+    Look up the pks of the model instances with the given field values,
+    creating the missing ones with build(value).
+
+    Returns dictionary of pk by value.
+    """
+    def get_pks(values):
+        pks = {}
+        for chunk in util.get_chunks(values):
+            # Ordered by descending pk so that the first of any duplicates
+            # wins.
+            pks.update(model.objects.filter(**{field + '__in': chunk})
+                       .order_by('-pk').values_list(field, 'pk'))
+        return pks
+    pks = get_pks(values)
+    missing = set(values).difference(pks)
+    if missing:
+        util.bulk_create(model, [build(v) for v in missing])
+        pks.update(get_pks(missing))
+    return pks
+
+def get_user_ips(pairs):
+    """Returns dictionary of UserIP pk by (user pk, ip pk)."""
+    found = {}
+    for chunk in util.get_chunks(pairs):
+        user_ips = UserIP.objects.filter(
+            user__in=set(u for u, i in chunk),
+            ip__in=set(i for u, i in chunk)).order_by('-pk')
+        found.update(((u, i), pk) for pk, u, i in
+                     user_ips.values_list('pk', 'user', 'ip')
+                     if (u, i) in pairs)
+    return found
+
+def get_vehicles(keys):
+    """Returns dictionary of Vehicle pk by (make year, make, model) pk."""
+    found = {}
+    for chunk in util.get_chunks(keys):
+        vehicles = Vehicle.objects.filter(
+            make_year__in=set(k[0] for k in chunk),
+            model__in=set(k[2] for k in chunk))
+        found.update(((my, ma, mo), pk) for pk, my, ma, mo in
+                     vehicles.values_list('pk', 'make_year', 'make', 'model')
+                     if (my, ma, mo) in keys)
+    return found
+
+def get_content_hash(row):
+    """Returns string, the SHA-1 hex digest of the record's content."""
+    content = u'\x1f'.join(unicode(row[f]) for f in HASH_FIELDS)
+    return hashlib.sha1(content.lower().encode('utf-8')).hexdigest()
+
+def read_csv(f):
+    """Yield records from a CSV file with a header row of the record keys."""
+    for record in csv.DictReader(f):
+        yield dict((k, v.decode('utf-8') if v else v)
+                   for k, v in record.iteritems())
+
+def read_jsonl(f):
+    """Yield records from a file of one JSON object per line."""
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Let DealIngester.clean count and log it.
+                yield None
+
+def import_deals(f, format='csv', batch_size=1000, update_stats=True):
+    """
+    Import the deals from a CSV or JSONL file, then rebuild the deal stats.
+
+    Returns IngestResult.
+    """
+    reader = read_jsonl if format == 'jsonl' else read_csv
+    result = DealIngester(batch_size).ingest(reader(f))
+    if update_stats and result.created:
+        queries.rebuild_deal_stats()
+    return result
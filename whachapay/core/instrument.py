@@ -0,0 +1,233 @@
+"""
+Per-request performance instrumentation.
+
+InstrumentMiddleware records, for each request, the wall time, the number and
+time of the database queries, the time spent in the sections timed with
+timer() (template rendering and Places searches), and the size of the session
+payload. Each request is logged as a line of JSON to the core.instrument
+logger: at DEBUG level, or at WARNING if it is slower than
+PERF_SLOW_REQUEST_MS or runs more queries than its view's budget. The figures
+are also aggregated per view into histograms, served as JSON by the staff-only
+perf view.
+
+The queries are counted and timed by a cursor wrapper installed on each
+connection, which keeps nothing else, rather than by Django's debug cursor,
+which would keep every statement of every request.
+
+Views declare their query budget with the query_budget decorator. With
+PERF_ENFORCE_BUDGETS, a view that exceeds its budget raises
+QueryBudgetExceeded; tests turn it on with enforce_query_budgets.
+"""
+import json, logging, threading, time
+from bisect import bisect_left
+from functools import wraps
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the wall time histogram buckets, in milliseconds.
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class QueryBudgetExceeded(AssertionError):
+    """A view ran more queries than its declared budget."""
+    pass
+
+class RequestMetrics(object):
+    """The measurements for one request."""
+    def __init__(self, path):
+        self.path = path
+        self.view = None
+        self.budget = None
+        self.start = time.time()
+        self.wall_ms = 0
+        self.queries = 0
+        self.query_ms = 0
+        self.session_bytes = 0
+        # Milliseconds, keyed by timer name.
+        self.timers = {}
+
+    def as_dict(self):
+        data = {'path': self.path,
+                'view': self.view,
+                'wall_ms': round(self.wall_ms, 1),
+                'queries': self.queries,
+                'query_ms': round(self.query_ms, 1),
+                'session_bytes': self.session_bytes}
+        for name, ms in self.timers.iteritems():
+            data[name + '_ms'] = round(ms, 1)
+        return data
+
+class ViewStats(object):
+    """Aggregated measurements for one view."""
+    def __init__(self):
+        self.count = 0
+        # Counts per BUCKETS bucket, and one for slower requests.
+        self.histogram = [0] * (len(BUCKETS) + 1)
+        self.totals = {}
+
+    def add(self, metrics):
+        self.count += 1
+        self.histogram[bisect_left(BUCKETS, metrics.wall_ms)] += 1
+        for name, value in metrics.as_dict().iteritems():
+            if name not in ('path', 'view'):
+                self.totals[name] = self.totals.get(name, 0) + value
+
+    def as_dict(self):
+        return {'count': self.count,
+                'wall_ms_histogram': dict(
+                    zip(['<=%d' % b for b in BUCKETS] + ['>%d' % BUCKETS[-1]],
+                        self.histogram)),
+                'mean': dict((name, round(total / float(self.count), 1))
+                             for name, total in self.totals.iteritems())}
+
+_local = threading.local()
+_stats = {}
+_stats_lock = threading.Lock()
+
+def current():
+    """Returns the RequestMetrics of this thread's request, or None."""
+    return getattr(_local, 'metrics', None)
+
+class timer(object):
+    """
+    Context manager adding the time spent in its block to the current
+    request's timer with the given name. Does nothing outside a request.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        metrics = current()
+        if metrics is not None:
+            ms = (time.time() - self.start) * 1000
+            metrics.timers[self.name] = metrics.timers.get(self.name, 0) + ms
+
+class CountingCursor(object):
+    """
+    Cursor wrapper adding the number and time of its queries to the current
+    request's measurements.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self.measure(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.measure(self.cursor.executemany, sql, param_list)
+
+    def measure(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            metrics = current()
+            if metrics is not None:
+                metrics.queries += 1
+                metrics.query_ms += (time.time() - start) * 1000
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def install_counting_cursor(conn):
+    """Make a connection's cursors CountingCursors, once per connection."""
+    if getattr(conn, 'counting_cursor', False):
+        return
+    cursor = conn.cursor
+    conn.cursor = lambda: CountingCursor(cursor())
+    conn.counting_cursor = True
+
+def query_budget(queries):
+    """View decorator declaring the most queries the view may run."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return view(*args, **kwargs)
+        wrapper.query_budget = queries
+        return wrapper
+    return decorator
+
+def enforce_query_budgets(test):
+    """
+    Test class or method decorator: a view that runs more queries than its
+    budget raises QueryBudgetExceeded, failing the test.
+    """
+    from django.test.utils import override_settings
+    return override_settings(PERF_ENFORCE_BUDGETS=True)(test)
+
+def get_stats():
+    """
+    Get the aggregated measurements of this process, per view.
+
+    Returns dictionary keyed by view name. See ViewStats.as_dict.
+    """
+    with _stats_lock:
+        return dict((view, stats.as_dict())
+                    for view, stats in _stats.iteritems())
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+class InstrumentMiddleware(object):
+    """
+    Measures each request. List it first in MIDDLEWARE_CLASSES, so that the
+    other middleware, including the session save, is measured too.
+    """
+    def process_request(self, request):
+        _local.metrics = RequestMetrics(request.path)
+        # The connections are per thread, and kept between requests.
+        for conn in connections.all():
+            install_counting_cursor(conn)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = current()
+        if metrics is not None:
+            metrics.view = '%s.%s' % (view_func.__module__,
+                                      view_func.__name__)
+            metrics.budget = getattr(view_func, 'query_budget', None)
+
+    def process_response(self, request, response):
+        metrics = current()
+        if metrics is None:
+            return response
+        _local.metrics = None
+        metrics.wall_ms = (time.time() - metrics.start) * 1000
+        session = getattr(request, 'session', None)
+        # Don't load a session that the request didn't use.
+        if session is not None and session.accessed:
+            metrics.session_bytes = len(session.encode(dict(session.items())))
+        record(metrics)
+        if (metrics.budget is not None and metrics.queries > metrics.budget
+                and settings.PERF_ENFORCE_BUDGETS):
+            raise QueryBudgetExceeded(
+                '%s ran %d queries, over its budget of %d.'
+                % (metrics.view, metrics.queries, metrics.budget))
+        return response
+
+def record(metrics):
+    """Log a request's measurements, and add them to the view's stats."""
+    over_budget = (metrics.budget is not None
+                   and metrics.queries > metrics.budget)
+    level = (logging.WARNING if over_budget
+             or metrics.wall_ms > settings.PERF_SLOW_REQUEST_MS
+             else logging.DEBUG)
+    if logger.isEnabledFor(level):
+        data = metrics.as_dict()
+        data['budget'] = metrics.budget
+        logger.log(level, json.dumps(data, sort_keys=True))
+    # Unresolved paths are grouped, so that 404s can't grow the stats.
+    view = metrics.view or '(unresolved)'
+    with _stats_lock:
+        stats = _stats.get(view)
+        if stats is None:
+            stats = _stats[view] = ViewStats()
+        stats.add(metrics)
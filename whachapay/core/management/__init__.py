@@ -0,0 +1,11 @@
+from django.db.models import signals
+from core import models as core_models
+
+def create_indexes(sender, created_models, **kwargs):
+    """Create the composite indexes for newly created tables."""
+    from core import schema
+    created = schema.create_indexes(models=created_models)
+    if created and kwargs.get('verbosity', 1) >= 1:
+        print 'Created %d core indexes' % len(created)
+
+signals.post_syncdb.connect(create_indexes, sender=core_models)
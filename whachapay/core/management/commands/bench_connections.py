@@ -0,0 +1,57 @@
+import time
+from optparse import make_option
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connections, load_backend
+from core import pool
+
+# (label, ENGINE)
+BACKENDS = (
+    ('unpooled', 'django.db.backends.postgresql_psycopg2'),
+    ('pooled', 'core.backends.postgresql_pool'),
+)
+
+class Command(NoArgsCommand):
+    help = ('Time the connection setup cost of requests that run one query, '
+            'opening a connection per request and taking one from the '
+            'connection pool. Needs a PostgreSQL database.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requests', type='int', default=200,
+                    help='Number of requests per backend. Defaults to 200.'),
+        make_option('--database', default='default',
+                    help='Database alias. Defaults to default.'),
+    )
+
+    def handle_noargs(self, **options):
+        connection = connections[options['database']]
+        if connection.vendor != 'postgresql':
+            raise CommandError('The benchmark needs a PostgreSQL database.')
+        means = []
+        for label, engine in BACKENDS:
+            wrapper = load_backend(engine).DatabaseWrapper(
+                dict(connection.settings_dict, ENGINE=engine),
+                alias='__bench__')
+            times = time_requests(wrapper, options['requests'])
+            means.append(sum(times) / len(times))
+            self.stdout.write('%s: %d requests, mean %.2f ms, worst %.2f ms\n'
+                              % (label, len(times), means[-1] * 1000,
+                                 max(times) * 1000))
+        pool.clear()
+        self.stdout.write('The pool saves %.2f ms per request (%.1fx).\n'
+                          % ((means[0] - means[1]) * 1000,
+                             means[0] / means[1]))
+
+def time_requests(wrapper, count):
+    """
+    Run a query and close the connection, as a request does, count times.
+
+    Returns list of seconds per request.
+    """
+    times = []
+    for i in range(count):
+        start = time.time()
+        cursor = wrapper.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+        wrapper.close()
+        times.append(time.time() - start)
+    return times
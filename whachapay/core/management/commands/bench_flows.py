@@ -0,0 +1,323 @@
+import json, os, re, subprocess, tempfile, threading, time
+from datetime import date, datetime, timedelta
+from optparse import make_option
+from random import Random
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection, connections, transaction
+from django.test.client import Client
+from django.test.simple import DjangoTestSuiteRunner
+from core import instrument, page_cache, places, price_stats
+from core.places_stub import PlacesStubServer
+from core.synthetic import SyntheticData
+
+ENTRY_STEPS = ('home', 'enter', 'dealer_select', 'deal_entry', 'deal_post',
+               'deal_entered')
+FIND_STEPS = ('find', 'area_summary', 'dealer_deals', 'deal_detail')
+
+class Command(NoArgsCommand):
+    help = ('Seed a throwaway test database with synthetic deals, then drive '
+            'the deal entry (home, dealer select, deal entry) and find deals '
+            '(home, area summary, dealer deals, deal detail) flows from '
+            'concurrent clients against a local Places stub, and report the '
+            'latency percentiles, throughput, and queries per request. With '
+            '--output, the results are appended to a JSON lines file and '
+            'compared with the previous run at the same scale.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dealers', type='int', default=100,
+                    help='Number of dealers. Defaults to 100.'),
+        make_option('--deals', type='int', default=10000,
+                    help='Number of deals. Defaults to 10000.'),
+        make_option('--makes', type='int', default=5,
+                    help='Number of makes. Defaults to 5.'),
+        make_option('--models', type='int', default=4,
+                    help='Number of models per make. Defaults to 4.'),
+        make_option('--trims', type='int', default=3,
+                    help='Number of trims per model. Defaults to 3.'),
+        make_option('--clients', type='int', default=8,
+                    help='Number of concurrent clients. Defaults to 8.'),
+        make_option('--iterations', type='int', default=20,
+                    help='Number of times each client runs each flow. '
+                         'Defaults to 20.'),
+        make_option('--places-delay', type='float', default=0,
+                    help='Seconds the Places stub waits before answering. '
+                         'Defaults to 0.'),
+        make_option('--seed', type='int', default=0,
+                    help='Random seed for the data and the flows. '
+                         'Defaults to 0.'),
+        make_option('--output', default=None,
+                    help='JSON lines file to append the results to.'),
+    )
+
+    def handle_noargs(self, **options):
+        # Each client thread has its own database connection, so an in-memory
+        # SQLite database would not be shared; use a temporary file.
+        temp_files = []
+        for alias in connections:
+            db = connections[alias].settings_dict
+            if (db['ENGINE'].endswith('sqlite3')
+                    and db.get('TEST_NAME') in (None, '', ':memory:')):
+                fd, db['TEST_NAME'] = tempfile.mkstemp(suffix='.sqlite3')
+                os.close(fd)
+                os.remove(db['TEST_NAME'])
+                temp_files.append(db['TEST_NAME'])
+        runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            result = self.run(options)
+        finally:
+            runner.teardown_databases(old_config)
+            for name in temp_files:
+                if os.path.exists(name):
+                    os.remove(name)
+        self.report(result)
+        if options['output']:
+            previous = get_previous(options['output'], result['scale'])
+            if previous:
+                self.compare(previous, result)
+            with open(options['output'], 'a') as f:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    def run(self, options):
+        """
+        Seed the data and drive the flows.
+
+        Returns dictionary, the results.
+        """
+        scale = dict((name, options[name]) for name in
+                     ('dealers', 'deals', 'makes', 'models', 'trims',
+                      'clients', 'iterations', 'places_delay', 'seed'))
+        start = time.time()
+        data = SyntheticData(seed=options['seed'])
+        transaction.commit_on_success(data.seed)(
+            makes=options['makes'], models=options['models'],
+            trims=options['trims'], dealers=options['dealers'],
+            deals=options['deals'])
+        seed_seconds = time.time() - start
+        self.stdout.write('Seeded %(deals)d deals at %(dealers)d dealers in '
+                          % options + '%.1f s.\n' % seed_seconds)
+
+        server = PlacesStubServer(delay=options['places_delay'], page_size=20)
+        server.response = data.get_places_response(count=60)
+        server.start()
+        places_client = places._client
+        places._client = places.PlacesClient(
+            server.url, 'key', keywords=settings.GMAP_PLACE_KEYWORDS,
+            max_pages=settings.GMAP_PLACE_MAX_PAGES, page_token_delay=0,
+            threads=settings.GMAP_FETCH_THREADS)
+        page_cache.get_backend().clear()
+        instrument.reset_stats()
+        timings = []
+        drivers = [FlowDriver(data, options['seed'] * 1000 + i,
+                              options['iterations'], timings)
+                   for i in range(options['clients'])]
+        threads = [threading.Thread(target=d.run) for d in drivers]
+        start = time.time()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            seconds = time.time() - start
+            places._client.close()
+            places._client = places_client
+            server.shutdown()
+            server.server_close()
+
+        steps = {}
+        for step, ms, ok in timings:
+            steps.setdefault(step, ([], [0]))
+            steps[step][0].append(ms)
+            if not ok:
+                steps[step][1][0] += 1
+        return {'commit': get_commit(),
+                'date': datetime.now().isoformat(),
+                'scale': scale,
+                'seed_seconds': round(seed_seconds, 1),
+                'seconds': round(seconds, 2),
+                'requests': len(timings),
+                'requests_per_second': round(len(timings) / seconds, 1),
+                'places_hits': server.hits,
+                'steps': dict((step, summarize(times, errors[0]))
+                              for step, (times, errors) in steps.iteritems()),
+                'views': dict((view.split('.')[-1],
+                               {'count': stats['count'],
+                                'queries': stats['mean'].get('queries', 0),
+                                'query_ms': stats['mean'].get('query_ms', 0)})
+                              for view, stats in
+                              instrument.get_stats().iteritems())}
+
+    def report(self, result):
+        self.stdout.write('%d requests in %.2f s: %.1f requests/s, %d Places '
+                          'requests.\n' % (result['requests'], result['seconds'],
+                                           result['requests_per_second'],
+                                           result['places_hits']))
+        self.stdout.write('%-14s %6s %6s %8s %8s %8s %8s\n'
+                          % ('step', 'count', 'errors', 'p50 ms', 'p90 ms',
+                             'p99 ms', 'max ms'))
+        for step in ENTRY_STEPS + FIND_STEPS:
+            s = result['steps'].get(step)
+            if s:
+                self.stdout.write('%-14s %6d %6d %8.1f %8.1f %8.1f %8.1f\n'
+                                  % (step, s['count'], s['errors'], s['p50'],
+                                     s['p90'], s['p99'], s['max']))
+        self.stdout.write('%-16s %6s %8s %10s\n'
+                          % ('view', 'count', 'queries', 'query ms'))
+        for view, v in sorted(result['views'].iteritems()):
+            self.stdout.write('%-16s %6d %8.1f %10.1f\n'
+                              % (view, v['count'], v['queries'],
+                                 v['query_ms']))
+
+    def compare(self, previous, result):
+        self.stdout.write('Compared with %s (%s):\n'
+                          % (previous.get('commit') or 'unknown commit',
+                             previous.get('date')))
+        self.stdout.write('  requests/s %8.1f -> %8.1f\n'
+                          % (previous['requests_per_second'],
+                             result['requests_per_second']))
+        for step in ENTRY_STEPS + FIND_STEPS:
+            old, new = previous['steps'].get(step), result['steps'].get(step)
+            if old and new:
+                self.stdout.write('  %-14s p50 %8.1f -> %8.1f  p90 %8.1f -> '
+                                  '%8.1f\n' % (step, old['p50'], new['p50'],
+                                               old['p90'], new['p90']))
+        for view in sorted(result['views']):
+            old = previous['views'].get(view)
+            new = result['views'][view]
+            if old and old['queries'] != new['queries']:
+                self.stdout.write('  %-14s queries %.1f -> %.1f\n'
+                                  % (view, old['queries'], new['queries']))
+
+class FlowDriver(object):
+    """
+    One client, running the deal entry and find deals flows in turn for
+    random vehicles, through the Django test client. Appends (step,
+    milliseconds, ok) to timings.
+    """
+    def __init__(self, data, seed, iterations, timings):
+        self.data = data
+        self.rng = Random(seed)
+        self.iterations = iterations
+        self.timings = timings
+
+    def run(self):
+        try:
+            for i in range(self.iterations):
+                self.client = Client()
+                self.enter_deal()
+                self.find_deals()
+        finally:
+            connection.close()
+
+    def request(self, step, method, path, data=None, status=200):
+        """
+        Time a request.
+
+        Returns HttpResponse, or None if it failed.
+        """
+        start = time.time()
+        try:
+            response = getattr(self.client, method)(path, data or {})
+            ok = response.status_code == status
+        except Exception:
+            response, ok = None, False
+        self.timings.append((step, (time.time() - start) * 1000, ok))
+        return response if ok else None
+
+    def search(self, button):
+        self.vehicle = self.rng.choice(self.data.vehicles)
+        pk, year, make, model, self.trims = self.vehicle
+        lat, lng = self.data.get_location()
+        return self.request(button, 'get', '/home/', {
+            'make_year': str(year), 'make': str(make), 'model': str(model),
+            'location': 'Honolulu, HI', 'place_name': 'Honolulu',
+            'lat_lng': '%.4f,%.4f' % (lat, lng), button: '1'}, status=302)
+
+    def enter_deal(self):
+        self.request('home', 'get', '/home/')
+        if not self.search('enter'):
+            return
+        response = self.request('dealer_select', 'get', '/home/dealer_select/')
+        place_ids = find_all(r'/home/entry/([a-f0-9]{40})/', response)
+        if not place_ids:
+            return
+        path = '/home/entry/%s/' % self.rng.choice(place_ids)
+        if not self.request('deal_entry', 'get', path):
+            return
+        if not self.request('deal_post', 'post', path, {
+                'trim': str(self.rng.choice(self.trims)),
+                'price': str(self.rng.randint(15, 60) * 1000),
+                'date': (date.today() - timedelta(
+                    days=self.rng.randrange(30))).isoformat(),
+                'comment': '', 'email': 'bench%d@customer.com'
+                % self.rng.randrange(1000)}, status=302):
+            return
+        self.request('deal_entered', 'get', '/home/deal_entered/')
+
+    def find_deals(self):
+        if not self.search('find'):
+            return
+        response = self.request('area_summary', 'get', '/home/area_summary/',
+                                {'trim': str(self.rng.choice(self.trims))})
+        place_ids = find_all(r'/home/dealer_deals/([a-f0-9]{40})/', response)
+        if not place_ids:
+            return
+        response = self.request('dealer_deals', 'get', '/home/dealer_deals/%s/'
+                                % self.rng.choice(place_ids))
+        deal_pks = find_all(r'/home/deal/(\d+)/', response)
+        if deal_pks:
+            self.request('deal_detail', 'get',
+                         '/home/deal/%s/' % self.rng.choice(deal_pks))
+
+def find_all(pattern, response):
+    """Returns list of the pattern's matches in a response's content."""
+    if response is None:
+        return []
+    return sorted(set(re.findall(pattern, response.content)))
+
+def summarize(times, errors):
+    """
+    Summarize a step's request times, in milliseconds.
+
+    Returns dictionary:
+        { 'count': 0,
+          'errors': 0,
+          'p50': 0.0,
+          'p90': 0.0,
+          'p99': 0.0,
+          'max': 0.0 }
+    """
+    times = sorted(times)
+    summary = {'count': len(times), 'errors': errors,
+               'max': round(times[-1], 1)}
+    for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        summary[name] = round(price_stats.get_percentile(
+            times, 0, len(times), q), 1)
+    return summary
+
+def get_commit():
+    """Returns string, the git commit of the working tree, or None."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_previous(output, scale):
+    """
+    Get the last results in an output file run at the same scale.
+
+    Returns dictionary, or None.
+    """
+    previous = None
+    if os.path.exists(output):
+        with open(output) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    if result.get('scale') == scale:
+                        previous = result
+    return previous
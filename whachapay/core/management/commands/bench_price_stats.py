@@ -0,0 +1,49 @@
+import random, time
+from array import array
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from core import price_stats
+
+class Command(NoArgsCommand):
+    help = ('Time the robust price statistics for a batch of random deal '
+            'prices grouped by dealer, as an area summary computes them.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--deals', type='int', default=1000000,
+                    help='Number of deal prices. Defaults to 1000000.'),
+        make_option('--dealers', type='int', default=1000,
+                    help='Number of dealers. Defaults to 1000.'),
+        make_option('--repeat', type='int', default=5,
+                    help='Number of timed runs. Defaults to 5.'),
+    )
+
+    def handle_noargs(self, **options):
+        prices, counts = build_groups(options['deals'], options['dealers'])
+        times = []
+        for i in range(options['repeat']):
+            start = time.time()
+            price_stats.summarize_groups(prices, counts)
+            times.append(time.time() - start)
+        self.stdout.write('%d deals, %d dealers: best %.3f s, worst %.3f s\n'
+                          % (len(prices), len(counts), min(times),
+                             max(times)))
+
+def build_groups(deal_count, dealer_count):
+    """
+    Build random prices, sorted within dealers as the database returns them,
+    with a few mistyped prices.
+
+    Returns tuple of (array of prices, list of counts per dealer).
+    """
+    rng = random.Random(0)
+    prices = array('l')
+    counts = []
+    for dealer in range(dealer_count):
+        count = deal_count // dealer_count + (
+            1 if dealer < deal_count % dealer_count else 0)
+        base = rng.randint(15000, 60000)
+        group = [int(rng.gauss(base, base * 0.05)) for i in range(count)]
+        if group:
+            group[0] *= 10
+        prices.extend(sorted(group))
+        counts.append(count)
+    return prices, counts
@@ -0,0 +1,70 @@
+import json
+from datetime import date
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.core.paginator import Paginator
+from django.utils.importlib import import_module
+from core.forms import TrimForm
+from core.models import Deal, Dealer
+
+class Command(NoArgsCommand):
+    help = ('Compare the encoded size of the session payload that the views '
+            'used to write with that of the current compact selection.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--results', type='int', default=20,
+                    help='Number of places results. Defaults to 20.'),
+        make_option('--deals', type='int', default=20,
+                    help='Number of deals shown for a dealer. Defaults to 20.'),
+    )
+
+    def handle_noargs(self, **options):
+        store = import_module(settings.SESSION_ENGINE).SessionStore()
+        legacy = len(store.encode({'data': build_legacy_data(
+                        options['results'], options['deals'])}))
+        compact = len(store.encode({'selection': build_selection()}))
+        self.stdout.write('Legacy session payload:  %7d bytes\n' % legacy)
+        self.stdout.write('Compact session payload: %7d bytes\n' % compact)
+        self.stdout.write('Reduction: %.1f%%\n'
+                          % (100.0 * (legacy - compact) / legacy))
+
+def build_selection():
+    """The session selection as written by views.build_home_selection."""
+    return {'year': 2012, 'make': 1, 'model': 1, 'location': 'Honolulu',
+            'lat_lng': '21.3069,-157.8583', 'trim': u'2',
+            'places_key': 'places:9d6c5fb2b2a9c1d0b8e0e24b8d1e3d53'}
+
+def build_legacy_data(result_count, deal_count):
+    """
+    The session data as it was written by the views before the selection was
+    slimmed down: after an area summary, dealer deals, and deal detail visit.
+    """
+    results = [{'location': '21.%06d,-157.%06d' % (i, i),
+                'id': '%040x' % i,
+                'name': 'Dealer %d' % i,
+                'vicinity': '%d Kapiolani Boulevard, Honolulu' % i}
+               for i in range(result_count)]
+    dealers = [Dealer(pk=i + 1, place_id=r['id'], location=r['location'],
+                      name=r['name'], address=r['vicinity'])
+               for i, r in enumerate(results)]
+    deals = [Deal(pk=i + 1, user_ip_id=1, vehicle_id=1, trim_id=1,
+                  dealer=dealers[0], price=30000 + i, date=date.today(),
+                  comment='Friendly salespeople, very pleased.')
+             for i in range(deal_count)]
+    page = Paginator([{'obj': d, 'avg': 30000} for d in dealers], 5).page(1)
+    return {'vehicle': {'obj': {'make': u'1', 'model': u'1'},
+                        'text': {'year': u'2012', 'make_name': u'BMW',
+                                 'model_name': u'3 Series'}},
+            'location': u'Honolulu',
+            'places': {'html_attributions': [], 'results': results},
+            'area_avg': 30000,
+            'dealers': page,
+            'form': TrimForm({'trim': u'2'}, model_pk=1, trim_year=2012),
+            'form_action': 'dealer_deals',
+            'trim': u'2',
+            'places_json': json.dumps(results[:5]),
+            'dealer': dealers[0],
+            'deals': deals,
+            'dealer_avg': 30000,
+            'place_json': json.dumps(results[0]),
+            'deal': deals[0]}
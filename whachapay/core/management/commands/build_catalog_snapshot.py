@@ -0,0 +1,23 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from core import catalog
+
+class Command(NoArgsCommand):
+    help = ('Save the catalog index to a snapshot file, so that new processes '
+            'load it instead of querying the catalog tables. Run at deploy, '
+            'and after editing the catalog.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', default=None,
+                    help='Snapshot file. Defaults to '
+                         'settings.CATALOG_SNAPSHOT.'),
+    )
+
+    def handle_noargs(self, **options):
+        path = options['output'] or settings.CATALOG_SNAPSHOT
+        if not path:
+            raise CommandError('No snapshot file; set CATALOG_SNAPSHOT or '
+                               'pass --output.')
+        index = catalog.save_snapshot(path)
+        self.stdout.write('Saved %d years of the catalog, version %s, to %s.\n'
+                          % (len(index.years), index.version, path))
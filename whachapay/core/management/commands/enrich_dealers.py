@@ -0,0 +1,44 @@
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from core import enrich
+
+class Command(NoArgsCommand):
+    help = ('Fill in the structured addresses, coordinates, and map images of '
+            'new dealers from Place Details lookups, in rate limited batches '
+            'as the dealers arrive.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', default=False,
+                    help='Enrich the waiting dealers and exit.'),
+        make_option('--interval', type='float', default=60.0,
+                    help='Seconds to wait when no dealers are waiting, or '
+                         'the lookups are failing. Defaults to 60.'),
+        make_option('--batch-size', type='int', default=None,
+                    help='Most dealers per batch. Defaults to '
+                         'settings.GMAP_ENRICH_BATCH_SIZE.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options['verbosity'])
+        total = failures = 0
+        try:
+            while True:
+                enriched, failed = enrich.enrich_dealers(options['batch_size'])
+                total += enriched
+                failures += failed
+                if (enriched or failed) and verbosity > 1:
+                    self.stdout.write('Enriched %d dealers, %d lookups '
+                                      'failed.\n' % (enriched, failed))
+                # A batch of failures would be retried straight away.
+                if not enriched:
+                    if options['once']:
+                        break
+                    # Don't hold a connection while idle.
+                    connection.close()
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        if verbosity:
+            self.stdout.write('Enriched %d dealers, %d lookups failed.\n'
+                              % (total, failures))
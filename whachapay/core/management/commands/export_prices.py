@@ -0,0 +1,37 @@
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from core import export
+
+class Command(BaseCommand):
+    args = '<deals|stats>'
+    help = ('Stream the deals, or the per vehicle, trim, and dealer price '
+            'statistics, as CSV or NDJSON. See core.export.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=export.FORMATS, default='csv',
+                    help='csv or ndjson. Defaults to csv.'),
+        make_option('--output', default=None,
+                    help='File to write. Defaults to standard output.'),
+        make_option('--vehicle', type='int', default=None,
+                    help='Only export this vehicle pk.'),
+        make_option('--dealer', default=None,
+                    help='Only export the dealer with this place id.'),
+        make_option('--chunk-size', type='int', default=1000,
+                    dest='chunk_size',
+                    help='Rows read per query. Defaults to 1000.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in export.EXPORTS:
+            raise CommandError('Give the export: deals or stats.')
+        out = open(options['output'], 'wb') if options['output'] \
+            else sys.stdout
+        try:
+            for data in export.iter_export(args[0], options['format'],
+                                           vehicle=options['vehicle'],
+                                           dealer=options['dealer'],
+                                           chunk_size=options['chunk_size']):
+                out.write(data)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,55 @@
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from core.synthetic import SyntheticData
+
+class Command(NoArgsCommand):
+    help = ('Add a synthetic catalog, dealers clustered around metro areas, '
+            'users, and deals with plausible prices to the database, at '
+            'production scale. The data is determined by the arguments and '
+            'the seed. Deals are written with COPY on PostgreSQL.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--makes', type='int', default=33,
+                    help='Number of makes. Defaults to 33.'),
+        make_option('--models', type='int', default=10,
+                    help='Number of models per make. Defaults to 10.'),
+        make_option('--trims', type='int', default=6,
+                    help='Most trims per model. Defaults to 6.'),
+        make_option('--first-year', type='int', default=2004,
+                    help='First model year. Defaults to 2004.'),
+        make_option('--last-year', type='int', default=2013,
+                    help='Last model year. Defaults to 2013.'),
+        make_option('--dealers', type='int', default=2000,
+                    help='Number of dealers. Defaults to 2000.'),
+        make_option('--deals', type='int', default=1000000,
+                    help='Number of deals. Defaults to 1000000.'),
+        make_option('--users', type='int', default=None,
+                    help='Number of users. Defaults to one per ten deals.'),
+        make_option('--seed', type='int', default=0,
+                    help='Random seed. Defaults to 0.'),
+        make_option('--chunk-size', type='int', default=10000,
+                    help='Rows written per statement. Defaults to 10000.'),
+    )
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        data = SyntheticData(seed=options['seed'],
+                             chunk_size=options['chunk_size'])
+        years = range(options['first_year'], options['last_year'] + 1)
+        users = options['users'] or max(1, options['deals'] // 10)
+        steps = (('catalog', data.seed_catalog, (options['makes'],
+                                                 options['models'],
+                                                 options['trims'], years)),
+                 ('dealers', data.seed_dealers, (options['dealers'],)),
+                 ('users', data.seed_users, (users,)),
+                 ('deals', data.seed_deals, (options['deals'],)),
+                 ('deal stats', data.finish, ()))
+        for name, step, args in steps:
+            start = time.time()
+            step(*args)
+            self.stdout.write('Stored %s in %.1f s.\n'
+                              % (name, time.time() - start))
+        self.stdout.write('%d vehicles, %d dealers, %d users, %d deals.\n'
+                          % (len(data.vehicles), len(data.dealer_pks),
+                             len(data.user_ips), options['deals']))
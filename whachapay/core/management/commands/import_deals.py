@@ -0,0 +1,37 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from core import ingest
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Import deals from a CSV or JSONL file of deal records, skipping '
+            'deals imported before. See core.ingest for the record format.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=('csv', 'jsonl'), default=None,
+                    help='csv or jsonl. Defaults to the file extension.'),
+        make_option('--batch-size', type='int', default=1000,
+                    dest='batch_size',
+                    help='Deals per transaction. Defaults to 1000.'),
+        make_option('--no-stats', action='store_false', default=True,
+                    dest='update_stats',
+                    help="Don't rebuild the deal stats after the import."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the file to import.')
+        path = args[0]
+        format = options['format'] or ('jsonl' if path.endswith('.jsonl')
+                                       else 'csv')
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            raise CommandError(e)
+        with f:
+            result = ingest.import_deals(f, format=format,
+                                         batch_size=options['batch_size'],
+                                         update_stats=options['update_stats'])
+        self.stdout.write('Imported %d deals: %d created, %d duplicates, '
+                          '%d rejected.\n' % (result.total, result.created,
+                                              result.duplicates,
+                                              result.rejected))
@@ -0,0 +1,36 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from core.places_stub import PlacesStubServer
+
+class Command(NoArgsCommand):
+    help = ('Run a local stand-in for the Google Places web service. Point '
+            'GMAP_PLACE_URL at the printed URL to use it.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--port', type='int', default=8001,
+                    help='Port to listen on. Defaults to 8001.'),
+        make_option('--response', default=None,
+                    help='JSON file to serve. Defaults to '
+                    'core/stub_data/places_search.json.'),
+        make_option('--details', default=None,
+                    help='JSON file of Place Details results keyed by '
+                    'reference. Defaults to core/stub_data/places_details.json.'),
+        make_option('--delay', type='float', default=0,
+                    help='Seconds to wait before each response, to simulate '
+                    'upstream latency.'),
+        make_option('--page-size', type='int', default=None,
+                    dest='page_size',
+                    help='Results per page. Defaults to all on one page.'),
+    )
+
+    def handle_noargs(self, **options):
+        server = PlacesStubServer(('127.0.0.1', options['port']),
+                                  response_file=options['response'],
+                                  details_file=options['details'],
+                                  delay=options['delay'],
+                                  page_size=options['page_size'],
+                                  verbose=int(options['verbosity']) > 1)
+        self.stdout.write('Serving canned Places results at %s\n' % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,40 @@
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from core import tasks
+
+class Command(NoArgsCommand):
+    help = ('Run the deferred tasks queued by the views, such as the deal '
+            'stats and page cache updates after a deal is entered, in batches '
+            'as they arrive.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', default=False,
+                    help='Run the queued tasks and exit.'),
+        make_option('--interval', type='float', default=1.0,
+                    help='Seconds to wait when the queue is empty. '
+                         'Defaults to 1.'),
+        make_option('--batch-size', type='int', default=None,
+                    help='Most tasks per transaction. Defaults to '
+                         'settings.TASK_BATCH_SIZE.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options['verbosity'])
+        total = 0
+        try:
+            while True:
+                done = tasks.process(options['batch_size'])
+                total += done
+                if done and verbosity > 1:
+                    self.stdout.write('Ran %d tasks.\n' % done)
+                if not done:
+                    if options['once']:
+                        break
+                    # Don't hold a connection while idle.
+                    connection.close()
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        if verbosity:
+            self.stdout.write('Ran %d tasks.\n' % total)
@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+from core import queries
+
+class Command(NoArgsCommand):
+    help = ('Rebuild the precomputed deal price statistics, overall and by '
+            'month, from the deals.')
+
+    def handle_noargs(self, **options):
+        count = queries.rebuild_deal_stats()
+        self.stdout.write('Rebuilt %d deal stats rows.\n' % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from core import schema
+
+class Command(NoArgsCommand):
+    help = ('Add the columns and indexes that are missing from an existing '
+            'database. See core.schema.')
+
+    def handle_noargs(self, **options):
+        changes = schema.upgrade()
+        for change in changes:
+            self.stdout.write('Added %s.\n' % change)
+        if not changes:
+            self.stdout.write('The schema is up to date.\n')
@@ -1,5 +1,6 @@
 from django.db import models
-from core import util
+from django.db.models.signals import post_delete, post_save, pre_save
+from core import catalog, geo, util
 
 class Make(models.Model):
     """Populated via fixture."""
@@ -21,6 +22,7 @@ class MakeYear(models.Model):
 
     class Meta:
         ordering = ['make', '-year']
+        unique_together = ('make', 'year')
 
 class Model(models.Model):
     """Populated via fixture."""
@@ -43,6 +45,7 @@ class ModelYear(models.Model):
 
     class Meta:
         ordering = ['model', '-year']
+        unique_together = ('model', 'year')
 
 class Trim(models.Model):
     """Populated via fixture."""
@@ -65,6 +68,7 @@ class TrimYear(models.Model):
 
     class Meta:
         ordering = ['trim', '-year']
+        unique_together = ('trim', 'year')
 
 class Vehicle(models.Model):
     """
@@ -78,7 +82,7 @@ class Vehicle(models.Model):
         return util.get_unicode(self.make_year.year, self.make.name, self.model.name)
 
     class Meta:
-        ordering = ['make_year', 'make', 'model']
+        unique_together = ('make_year', 'make', 'model')
 
 class User(models.Model):
     email = models.EmailField(max_length=100)
@@ -120,9 +124,26 @@ class Dealer(models.Model):
     place_id = models.CharField(max_length=40, unique=True)
     location = models.CharField(max_length=100)
     name = models.CharField(max_length=100)
-    # !!! FIX: Store address parts to make formatting easier. Will have to make
-    # a place detail request.
+    # The Places search result vicinity.
     address = models.CharField(max_length=200)
+    # Parsed from location when saved, for core.geo.
+    latitude = models.FloatField(null=True, blank=True, editable=False)
+    longitude = models.FloatField(null=True, blank=True, editable=False)
+    # The Places search result reference, for the Place Details lookup.
+    reference = models.TextField(blank=True, editable=False)
+    # Filled in from Place Details by the enrich_dealers command, which sets
+    # enriched when done, whether or not the place was found, or when the
+    # lookup has failed settings.GMAP_ENRICH_MAX_ATTEMPTS times. See
+    # core.enrich.
+    formatted_address = models.CharField(max_length=200, blank=True)
+    street = models.CharField(max_length=100, blank=True)
+    city = models.CharField(max_length=100, blank=True)
+    state = models.CharField(max_length=50, blank=True)
+    postal_code = models.CharField(max_length=20, blank=True)
+    country = models.CharField(max_length=50, blank=True)
+    map_url = models.CharField(max_length=500, blank=True, editable=False)
+    enriched = models.DateTimeField(null=True, blank=True, editable=False)
+    enrich_attempts = models.PositiveIntegerField(default=0, editable=False)
 
     def __unicode__(self):
         return self.name
@@ -138,10 +159,149 @@ class Deal(models.Model):
     price = models.IntegerField()
     date = models.DateField()
     comment = models.TextField(blank=True)
+    # Set for imported deals, to make imports idempotent. See core.ingest.
+    content_hash = models.CharField(max_length=40, null=True, blank=True,
+                                    editable=False)
+    # Copied from the vehicle, trim, and dealer when saved, and kept up to
+    # date when they are renamed, so that deals can be listed and shown
+    # without following the foreign keys.
+    year = models.IntegerField(null=True, blank=True, editable=False)
+    make_name = models.CharField(max_length=100, blank=True, editable=False)
+    model_name = models.CharField(max_length=100, blank=True, editable=False)
+    trim_name = models.CharField(max_length=100, blank=True, editable=False)
+    dealer_name = models.CharField(max_length=100, blank=True, editable=False)
+    # Set for entered deals. A flagged deal is left out of the deal lists and
+    # the price aggregates. See core.spam.
+    entry_hash = models.CharField(max_length=40, blank=True, editable=False)
+    flagged = models.BooleanField(default=False)
+    # Comma separated reasons for the flag.
+    spam_reasons = models.CharField(max_length=50, blank=True, editable=False)
 
     def __unicode__(self):
-        return util.get_unicode(self.user_ip, self.vehicle, self.dealer,
-                                self.price, self.date)
+        return util.get_unicode(self.year, self.make_name, self.model_name,
+                                self.trim_name, self.dealer_name, self.price,
+                                self.date)
+
+class DealStats(models.Model):
+    """
+    Precomputed price aggregates for a vehicle, trim, and dealer. Maintained
+    incrementally as deals are stored, and rebuilt from the deals with the
+    rebuild_deal_stats command.
+    """
+    vehicle = models.ForeignKey(Vehicle)
+    trim = models.ForeignKey(Trim)
+    dealer = models.ForeignKey(Dealer)
+    count = models.IntegerField(default=0)
+    sum = models.BigIntegerField(default=0)
+    min_price = models.IntegerField()
+    max_price = models.IntegerField()
+    sum_squares = models.BigIntegerField(default=0)
+    # Quantile sketch of the prices. See core.sketches.
+    sketch = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return util.get_unicode(self.vehicle, self.trim.name, self.dealer,
+                                self.count)
+
+    class Meta:
+        unique_together = ('vehicle', 'dealer', 'trim')
+        verbose_name_plural = 'deal stats'
+
+class DealMonthStats(models.Model):
+    """
+    Price aggregates for a vehicle, trim, and dealer over the deals dated in
+    a month, for price trends. Maintained and rebuilt along with DealStats.
+    """
+    vehicle = models.ForeignKey(Vehicle)
+    trim = models.ForeignKey(Trim)
+    dealer = models.ForeignKey(Dealer)
+    # The first day of the month.
+    month = models.DateField()
+    count = models.IntegerField(default=0)
+    sum = models.BigIntegerField(default=0)
+    min_price = models.IntegerField()
+    max_price = models.IntegerField()
+    sum_squares = models.BigIntegerField(default=0)
+    # Quantile sketch of the prices. See core.sketches.
+    sketch = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return util.get_unicode(self.vehicle, self.trim.name, self.dealer,
+                                self.month.strftime('%Y-%m'), self.count)
 
     class Meta:
-        ordering = ['vehicle', 'dealer', 'price']
+        unique_together = ('vehicle', 'dealer', 'trim', 'month')
+        verbose_name_plural = 'deal month stats'
+
+class Task(models.Model):
+    """
+    Deferred work, queued in the transaction that makes it necessary, with
+    the pk it works on. See core.tasks.
+    """
+    name = models.CharField(max_length=50)
+    arg = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return util.get_unicode(self.name, self.arg, self.created)
+
+class CatalogVersion(models.Model):
+    """
+    The catalog version, in one row, changed in the transaction of each
+    catalog edit, so that it identifies the catalog's contents in every
+    process. See core.catalog.
+    """
+    version = models.BigIntegerField()
+
+    def __unicode__(self):
+        return unicode(self.version)
+
+def catalog_changed(sender, **kwargs):
+    """Invalidate the catalog index when a catalog table changes."""
+    catalog.bump_version()
+
+for catalog_model in (Make, MakeYear, Model, ModelYear, Trim, TrimYear):
+    post_save.connect(catalog_changed, sender=catalog_model)
+    post_delete.connect(catalog_changed, sender=catalog_model)
+
+def set_dealer_coordinates(sender, instance, **kwargs):
+    """Parse a dealer's location into its coordinates."""
+    instance.latitude, instance.longitude = util.get_lat_lng(instance.location)
+
+def dealers_changed(sender, **kwargs):
+    """Invalidate the dealer index when a dealer changes."""
+    geo.bump_version()
+
+def set_deal_names(sender, instance, **kwargs):
+    """Copy the names of a deal's vehicle, trim, and dealer into it."""
+    vehicle = instance.vehicle
+    instance.year = vehicle.make_year.year
+    instance.make_name = vehicle.make.name
+    instance.model_name = vehicle.model.name
+    instance.trim_name = instance.trim.name
+    instance.dealer_name = instance.dealer.name
+
+def update_deal_names(sender, instance, created=False, **kwargs):
+    """Copy a renamed make, model, trim, or dealer's name into its deals."""
+    if created:
+        return
+    field, lookup = DEAL_NAME_FIELDS[sender]
+    Deal.objects.filter(**{lookup: instance}).exclude(
+        **{field: instance.name}).update(**{field: instance.name})
+
+# The Deal name field copied from each model, and the lookup of its deals.
+DEAL_NAME_FIELDS = {
+    Make: ('make_name', 'vehicle__make'),
+    Model: ('model_name', 'vehicle__model'),
+    Trim: ('trim_name', 'trim'),
+    Dealer: ('dealer_name', 'dealer'),
+}
+
+pre_save.connect(set_dealer_coordinates, sender=Dealer)
+post_save.connect(dealers_changed, sender=Dealer)
+post_delete.connect(dealers_changed, sender=Dealer)
+pre_save.connect(set_deal_names, sender=Deal)
+for named_model in DEAL_NAME_FIELDS:
+    post_save.connect(update_deal_names, sender=named_model)
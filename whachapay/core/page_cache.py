@@ -0,0 +1,114 @@
+"""
+Cache of the rendered area summary, dealer deals, and deal detail pages.
+
+A page is cached under a hash of the view's inputs (the session selection,
+trim, and page) and of the version stamps of the data it shows. Storing a
+deal bumps only the stamps of its vehicle and of its vehicle at its dealer,
+so the other vehicles' and dealers' pages stay cached; imports and stats
+rebuilds bump the global stamp. A deal's detail pages have a stamp of their
+own, bumped when it is flagged or approved, or its dealer is enriched. Pages and stamps live in the
+settings.PAGE_CACHE_ALIAS cache, which can be any Django backend; use one
+shared between processes (memcached, or the file backend on one host) so that
+a deal stored in one process invalidates the pages of all of them.
+
+With read replicas, the time of each bump is kept as well, and a page whose
+stamps were bumped less than DATABASE_REPLICA_LAG seconds ago is rendered
+from the default database; see core.replicas.
+"""
+import hashlib, time
+from django.conf import settings
+from django.core.cache import get_cache
+from django.http import HttpResponse
+from core import replicas
+
+GLOBAL_KEY = 'pages:version'
+
+_cache = None
+
+def get_backend():
+    """Returns the page cache backend."""
+    global _cache
+    if _cache is None:
+        _cache = get_cache(settings.PAGE_CACHE_ALIAS)
+    return _cache
+
+def get_vehicle_key(year, make_pk, model_pk):
+    """Get the version key of the pages of a vehicle. Returns string."""
+    return 'pages:vehicle:%d:%d:%d' % (int(year), int(make_pk), int(model_pk))
+
+def get_dealer_key(year, make_pk, model_pk, place_id):
+    """
+    Get the version key of the pages of a vehicle at a dealer.
+
+    Returns string.
+    """
+    return '%s:%s' % (get_vehicle_key(year, make_pk, model_pk), place_id)
+
+def get_deal_key(deal_pk):
+    """Get the version key of a deal's detail pages. Returns string."""
+    return 'pages:deal:%d' % int(deal_pk)
+
+def get_versions(keys):
+    """
+    Get the version stamps with the given keys, in one cache request, starting
+    new ones for the keys the cache doesn't have.
+
+    Returns list of ints, in keys order.
+    """
+    cache = get_backend()
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Time based, so that a stamp lost from the cache is never reused.
+            cache.add(key, int(time.time() * 1000), settings.PAGE_CACHE_TTL)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+def bump(*keys):
+    """Invalidate the pages that depend on the given version keys."""
+    cache = get_backend()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000), settings.PAGE_CACHE_TTL)
+    if settings.DATABASE_REPLICAS:
+        cache.set_many(dict((get_bumped_key(key), time.time())
+                            for key in keys), settings.DATABASE_REPLICA_LAG)
+
+def get_bumped_key(key):
+    """Returns string, the key of the time a version stamp was bumped."""
+    return key + ':bumped'
+
+def bump_all():
+    """Invalidate all of the pages."""
+    bump(GLOBAL_KEY)
+
+def get_page(view, inputs, version_keys, render):
+    """
+    Get a view's page for the given inputs from the cache, or render it with
+    render() and cache it if the response is a success. inputs is a tuple of
+    strings and numbers; version_keys are the keys of the stamps of the data
+    the page shows, in addition to the global stamp.
+
+    Returns HttpResponse.
+    """
+    keys = (GLOBAL_KEY,) + tuple(version_keys)
+    versions = get_versions(keys)
+    digest = hashlib.md5(repr((inputs, versions))).hexdigest()
+    key = 'pages:%s:%s' % (view, digest)
+    cache = get_backend()
+    cached = cache.get(key)
+    if cached is not None:
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+    if replicas.get_replica() and cache.get_many(map(get_bumped_key, keys)):
+        # The replica may not have the changes yet.
+        with replicas.use_primary():
+            response = render()
+    else:
+        response = render()
+    if response.status_code == 200:
+        cache.set(key, (response.content, response['Content-Type']),
+                  settings.PAGE_CACHE_TTL)
+    return response
@@ -0,0 +1,80 @@
+"""
+Keyset (seek) pagination. Pages are read with WHERE (field, pk) > (value, pk)
+ORDER BY field, pk LIMIT per_page + 1 from the last row of the previous page,
+rather than with an offset, so that a deep page costs the same as the first
+when the ordering is backed by an index.
+"""
+from django.db.models import Q
+from core import util
+
+class KeysetPage(object):
+    """
+    A page of objects, with the cursors of the neighboring pages. A cursor is
+    a "value.pk" string for the after or before GET params.
+    """
+    def __init__(self, object_list, field, has_next, has_previous):
+        self.object_list = object_list
+        self.field = field
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return get_cursor(self.object_list[-1], self.field)
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return get_cursor(self.object_list[0], self.field)
+        return None
+
+def get_keyset_page(request, queryset, field, per_page):
+    """
+    Get the page of a queryset ordered by an integer field and pk, after or
+    before the cursor in the request's after or before GET param, or the
+    first page.
+
+    Returns KeysetPage.
+    """
+    after = parse_cursor(request.GET.get('after'))
+    before = parse_cursor(request.GET.get('before'))
+    if before:
+        value, pk = before
+        rows = list(queryset.filter(Q(**{field + '__lt': value})
+                                    | Q(**{field: value, 'pk__lt': pk}))
+                    .order_by('-' + field, '-pk')[:per_page + 1])
+        has_previous = len(rows) > per_page
+        rows.reverse()
+        return KeysetPage(rows[-per_page:], field, True, has_previous)
+    if after:
+        value, pk = after
+        queryset = queryset.filter(Q(**{field + '__gt': value})
+                                   | Q(**{field: value, 'pk__gt': pk}))
+    rows = list(queryset.order_by(field, 'pk')[:per_page + 1])
+    return KeysetPage(rows[:per_page], field, len(rows) > per_page,
+                      after is not None)
+
+def get_cursor(obj, field):
+    """Returns string."""
+    return '%d.%d' % (getattr(obj, field), obj.pk)
+
+def parse_cursor(cursor):
+    """Returns tuple of ints (value, pk), or None if invalid."""
+    parts = (cursor or '').split('.')
+    if len(parts) != 2:
+        return None
+    value, pk = [util.get_int(p) for p in parts]
+    if value is None or pk is None:
+        return None
+    return (value, pk)
@@ -0,0 +1,526 @@
+"""
+Google Places API web service client. Responses are cached by rounded
+location and radius, concurrent identical lookups are coalesced into a single
+upstream request, and each thread reuses a keep-alive connection with explicit
+connect and read timeouts.
+
+A search runs one query per keyword in parallel on a thread pool, and merges
+their first pages by place id. Its wall-clock time is bounded by a deadline;
+whatever has arrived by then is returned, marked partial, and not cached. The
+next_page_token pages, which Google only serves after a delay, are fetched
+afterwards by a background pager thread, outside the requests and the pool,
+which then replaces the cached results with the merged pages; until then the
+cached results are marked partial as well.
+
+Place Details lookups, for dealer enrichment (see core.enrich), run in batches
+on the same thread pool, spaced out by a rate limiter shared by the threads.
+"""
+import Queue, httplib, json, posixpath, socket, threading, time, urllib
+import urlparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+
+class PlacesCache(object):
+    """
+    Thread-safe LRU cache whose entries expire after a time to live.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # Re-insert to mark as most recently used.
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class RateLimiter(object):
+    """
+    Thread-safe limiter spacing calls to wait() at least 1 / rate seconds
+    apart. A rate of None or 0 doesn't limit.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Sleep until the next call is allowed."""
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+class _Call(object):
+    """An upstream lookup that other threads can wait on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+class PlacesClient(object):
+    """
+    Client for the Places search web service.
+    """
+    def __init__(self, url, key, connect_timeout=2.0, read_timeout=5.0,
+                 cache_size=1000, cache_ttl=3600, precision=2,
+                 keywords=('car+dealer',), max_pages=1, page_token_delay=2.0,
+                 deadline=None, threads=4, details_rate=None):
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path
+        # The details service is a sibling of the search service:
+        # .../place/search/json and .../place/details/json.
+        self.details_path = posixpath.join(
+            posixpath.dirname(posixpath.dirname(self.path)), 'details',
+            posixpath.basename(self.path))
+        self.details_limiter = RateLimiter(details_rate)
+        self.key = key
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.precision = precision
+        self.keywords = keywords
+        self.max_pages = max_pages
+        # Google only accepts a next_page_token after a short delay.
+        self.page_token_delay = page_token_delay
+        # Seconds a search may take in all, by default that of a single
+        # request.
+        self.deadline = deadline or connect_timeout + read_timeout
+        self.threads = threads
+        self.cache = PlacesCache(cache_size, cache_ttl)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = set()
+        self._pool = None
+        # Searches with more pages to fetch: (time the next pages can be
+        # fetched, cache key, pages per keyword, [(keyword number, page
+        # token)], number of the next pages).
+        self._pages = Queue.Queue()
+        self._pager = None
+
+    def search(self, location, radius=50000):
+        """
+        Search for car dealers near a "lat,lng" location string, within radius
+        meters.
+
+        Returns dictionary, empty if the lookup failed. See build_places;
+        it also has 'partial': True if the search was cut short by the
+        deadline or its later pages are still being fetched.
+        """
+        key = self.get_cache_key(location, radius)
+        if key is None:
+            return {}
+        places = self.cache.get(key)
+        if places is not None:
+            return places
+
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+        if not leader:
+            call.done.wait(self.deadline)
+            return call.result or {}
+
+        try:
+            call.result, cut_short = self._search(key, location, radius)
+            # Don't cache failures or results cut short, so the next request
+            # retries.
+            if call.result and not cut_short:
+                self.cache.set(key, call.result)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+        return call.result
+
+    def get_cache_key(self, location, radius):
+        """
+        Round the location so that nearby searches share a cache entry.
+
+        Returns tuple, or None if the location can't be parsed.
+        """
+        try:
+            lat, lng = [round(float(l), self.precision)
+                        for l in location.split(',')]
+        except (AttributeError, ValueError):
+            return None
+        return (lat, lng, int(radius))
+
+    def _search(self, key, location, radius):
+        """
+        Run the first page queries of the keywords in parallel until they
+        finish or the deadline passes, and queue the fetch of their later
+        pages.
+
+        Returns tuple of (dictionary, empty if no query succeeded, see
+        search; bool, whether the deadline cut the search short).
+        """
+        deadline = time.time() + self.deadline
+        calls = [self._get_pool().apply_async(
+                     self._query, (location, radius, keyword))
+                 for keyword in self.keywords]
+        pages, tokens = [], []
+        cut_short = False
+        for number, call in enumerate(calls):
+            call.wait(max(0, deadline - time.time()))
+            page, token = call.get() if call.ready() else (None, None)
+            cut_short = cut_short or not call.ready()
+            pages.append([page] if page else [])
+            if token and self.max_pages > 1:
+                tokens.append((number, token))
+        # Take the pages that arrived in time, in keyword order.
+        places = merge_places([found[0] for found in pages if found])
+        if places and (cut_short or tokens):
+            places['partial'] = True
+        if places and tokens and not cut_short:
+            self._fetch_later(key, pages, tokens)
+        return places, cut_short
+
+    def _query(self, location, radius, keyword):
+        """
+        Fetch the first page of one keyword query.
+
+        Returns tuple of (dictionary, see build_places, or None if the query
+        failed; next page token, or None).
+        """
+        return self._get_page({'key': self.key,
+                               'location': location,
+                               'radius': str(radius),
+                               'sensor': 'false',
+                               'keyword': keyword,
+                               'types': 'car_dealer|establishment'})
+
+    def _get_page(self, params):
+        """
+        Fetch a page of search results.
+
+        Returns tuple of (dictionary or None, next page token or None). See
+        _query.
+        """
+        response = self.request(self.path, params)
+        try:
+            if not response or response['status'] != 'OK':
+                return None, None
+            return build_places(response), response.get('next_page_token')
+        except KeyError:
+            return None, None
+
+    def _fetch_later(self, key, pages, tokens):
+        """
+        Queue the fetch of a search's later pages for the pager thread,
+        starting it if needed.
+        """
+        with self._lock:
+            if self._pager is None:
+                self._pager = threading.Thread(target=self._run_pager,
+                                               args=(self._pages,))
+                self._pager.daemon = True
+                self._pager.start()
+        self._pages.put((time.time() + self.page_token_delay, key, pages,
+                         tokens, 2))
+
+    def _run_pager(self, queue):
+        """
+        Pager thread: fetch the next pages of the queued searches, in turn,
+        once Google accepts their page tokens, until max_pages, and cache
+        each search's merged pages when it has no more. Stops at a None.
+        """
+        while True:
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                return
+            try:
+                ready, key, pages, tokens, number = item
+                wait = ready - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                next_tokens = []
+                for keyword, token in tokens:
+                    page, token = self._get_page({'key': self.key,
+                                                  'sensor': 'false',
+                                                  'pagetoken': token})
+                    if page:
+                        pages[keyword].append(page)
+                    if page and token and number < self.max_pages:
+                        next_tokens.append((keyword, token))
+                if next_tokens:
+                    queue.put((time.time() + self.page_token_delay, key,
+                               pages, next_tokens, number + 1))
+                else:
+                    # Page by page, in keyword order, so that the first
+                    # pages lead, as in the partial result, and the
+                    # results already listed don't move.
+                    depth = max(len(found) for found in pages)
+                    self.cache.set(key, merge_places(
+                        [found[index] for index in range(depth)
+                         for found in pages if index < len(found)]))
+            finally:
+                queue.task_done()
+
+    def join_pages(self):
+        """Wait until the pager thread has fetched the queued pages."""
+        self._pages.join()
+
+    def get_details(self, references):
+        """
+        Look up the Place Details of places by their search result
+        references, in parallel.
+
+        Returns dictionary keyed by reference: a dictionary (see
+        build_details), empty if the place wasn't found, or None if the
+        lookup failed and may be retried.
+        """
+        calls = [(reference,
+                  self._get_pool().apply_async(self._get_details, (reference,)))
+                 for reference in references]
+        return dict((reference, call.get()) for reference, call in calls)
+
+    def _get_details(self, reference):
+        """Returns dictionary or None. See get_details."""
+        self.details_limiter.wait()
+        response = self.request(self.details_path,
+                                {'key': self.key, 'reference': reference,
+                                 'sensor': 'false'})
+        if not response:
+            return None
+        status = response.get('status')
+        if status in ('NOT_FOUND', 'ZERO_RESULTS', 'INVALID_REQUEST'):
+            return {}
+        if status != 'OK':
+            # OVER_QUERY_LIMIT, REQUEST_DENIED, UNKNOWN_ERROR.
+            return None
+        try:
+            return build_details(response['result'])
+        except (KeyError, TypeError, ValueError):
+            return {}
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+            return self._pool
+
+    def request(self, path, params):
+        """
+        GET a JSON document from the service, over this thread's keep-alive
+        connection. Retries once on a fresh connection, in case the server
+        closed the idle one.
+
+        Returns dictionary, or None on failure.
+        """
+        url = path + '?' + urllib.urlencode(params)
+        for attempt in range(2):
+            reused = getattr(self._local, 'conn', None) is not None
+            try:
+                conn = self._get_connection()
+                conn.request('GET', url)
+                response = conn.getresponse()
+                body = response.read()
+                if response.status != 200:
+                    return None
+                return json.loads(body)
+            except (httplib.HTTPException, socket.error):
+                self._close_connection()
+                if not reused:
+                    return None
+            except ValueError:
+                return None
+        return None
+
+    def _get_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.scheme == 'https':
+                conn = httplib.HTTPSConnection(self.netloc,
+                                               timeout=self.connect_timeout)
+            else:
+                conn = httplib.HTTPConnection(self.netloc,
+                                              timeout=self.connect_timeout)
+            conn.connect()
+            # The connect timeout is set at construction; switch the socket
+            # over to the read timeout now that it is established.
+            conn.sock.settimeout(self.read_timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.add(conn)
+        return conn
+
+    def _close_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+            with self._lock:
+                self._connections.discard(conn)
+
+    def close(self):
+        """
+        Stop the thread pool and the pager thread, and close the keep-alive
+        connections.
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+            if self._pager is not None:
+                self._pages.put(None)
+                self._pager = None
+                self._pages = Queue.Queue()
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+def build_places(response):
+    """
+    Construct a dictionary of just the relevant places data.
+
+    Returns dictionary:
+        { 'results': [ { 'location': '',
+                         'id': '',
+                         'name': '',
+                         'vicinity': '',
+                         'reference': ''}]
+          'html_attributions': []}
+    """
+    results = [{'location': str(r['geometry']['location']['lat']) + ','
+                + str(r['geometry']['location']['lng']),
+                'id': r['id'],
+                'name': r['name'],
+                'vicinity': r['vicinity'],
+                # Needed for a Place Details lookup.
+                'reference': r.get('reference', '')}
+               for r in response['results']]
+    places = {'html_attributions': response['html_attributions']}
+    places['results'] = results
+    return places
+
+# Address component type: (details key, use the short name).
+ADDRESS_COMPONENTS = {
+    'street_number': ('street_number', False),
+    'route': ('route', False),
+    'locality': ('city', False),
+    'administrative_area_level_1': ('state', True),
+    'postal_code': ('postal_code', False),
+    'country': ('country', True),
+}
+
+def build_details(result):
+    """
+    Construct a dictionary of just the relevant Place Details data.
+
+    Returns dictionary:
+        { 'formatted_address': '',
+          'street': '',
+          'city': '',
+          'state': '',
+          'postal_code': '',
+          'country': '',
+          'location': 'lat,lng' }
+    """
+    parts = {}
+    for component in result.get('address_components', ()):
+        for kind in component['types']:
+            if kind in ADDRESS_COMPONENTS:
+                key, short = ADDRESS_COMPONENTS[kind]
+                parts[key] = component['short_name' if short else 'long_name']
+    location = result['geometry']['location']
+    return {'formatted_address': result.get('formatted_address', ''),
+            'street': ' '.join(p for p in (parts.pop('street_number', ''),
+                                           parts.pop('route', '')) if p),
+            'city': parts.get('city', ''),
+            'state': parts.get('state', ''),
+            'postal_code': parts.get('postal_code', ''),
+            'country': parts.get('country', ''),
+            'location': '%s,%s' % (float(location['lat']),
+                                   float(location['lng']))}
+
+def get_static_map_url(location):
+    """
+    Build the Static Maps image URL of a "lat,lng" location, with a marker,
+    sized to replace the maps JavaScript.
+
+    Returns string.
+    """
+    return settings.GMAP_STATIC_MAP_URL + '?' + urllib.urlencode(
+        [('center', location), ('zoom', '14'),
+         ('size', settings.GMAP_STATIC_MAP_SIZE), ('markers', location),
+         ('sensor', 'false'), ('key', settings.GMAP_API_KEY)])
+
+def merge_places(pages):
+    """
+    Merge pages of places, dropping repeated place ids.
+
+    Returns dictionary, empty if there are no pages. See build_places.
+    """
+    if not pages:
+        return {}
+    places = {'html_attributions': [], 'results': []}
+    ids = set()
+    for page in pages:
+        for attribution in page['html_attributions']:
+            if attribution not in places['html_attributions']:
+                places['html_attributions'].append(attribution)
+        for result in page['results']:
+            if result['id'] not in ids:
+                ids.add(result['id'])
+                places['results'].append(result)
+    return places
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Get the shared client, configured from settings.
+
+    Returns PlacesClient.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PlacesClient(
+                    settings.GMAP_PLACE_URL, settings.GMAP_API_KEY,
+                    connect_timeout=settings.GMAP_CONNECT_TIMEOUT,
+                    read_timeout=settings.GMAP_READ_TIMEOUT,
+                    cache_size=settings.GMAP_PLACE_CACHE_SIZE,
+                    cache_ttl=settings.GMAP_PLACE_CACHE_TTL,
+                    precision=settings.GMAP_PLACE_CACHE_PRECISION,
+                    keywords=settings.GMAP_PLACE_KEYWORDS,
+                    max_pages=settings.GMAP_PLACE_MAX_PAGES,
+                    page_token_delay=settings.GMAP_PAGE_TOKEN_DELAY,
+                    deadline=settings.GMAP_SEARCH_DEADLINE,
+                    threads=settings.GMAP_FETCH_THREADS,
+                    details_rate=settings.GMAP_DETAILS_RATE)
+    return _client
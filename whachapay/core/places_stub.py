@@ -0,0 +1,114 @@
+"""
+Local stand-in for the Google Places web service, serving canned JSON so that
+the Places client can be exercised and load-tested offline. Answers both
+search and Place Details requests.
+"""
+import json, os, socket, sys, threading, time, urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+DEFAULT_RESPONSE = os.path.join(os.path.dirname(__file__), 'stub_data',
+                                'places_search.json')
+DEFAULT_DETAILS = os.path.join(os.path.dirname(__file__), 'stub_data',
+                               'places_details.json')
+
+class PlacesStubHandler(BaseHTTPRequestHandler):
+    # Needed for keep-alive connections.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.hits += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        parts = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(parts.query)
+        if '/details/' in parts.path:
+            body = json.dumps(self.server.get_details(
+                params.get('reference', [''])[0]))
+        else:
+            body = json.dumps(self.server.get_page(
+                params.get('pagetoken', ['page-0'])[0]))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class PlacesStubServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server answering every GET with the canned response, after
+    an optional delay in seconds. Counts the requests it has served in hits.
+
+    With a page_size, the results are split into pages linked by
+    next_page_token, as the real service returns at most 20 results at a time.
+
+    Place Details requests are answered from details, the canned results keyed
+    by reference, or with NOT_FOUND.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), response_file=None, delay=0,
+                 verbose=False, page_size=None, details_file=None):
+        HTTPServer.__init__(self, address, PlacesStubHandler)
+        with open(response_file or DEFAULT_RESPONSE) as f:
+            self.response = json.load(f)
+        with open(details_file or DEFAULT_DETAILS) as f:
+            self.details = json.load(f)
+        self.delay = delay
+        self.verbose = verbose
+        self.page_size = page_size
+        self.hits = 0
+
+    def get_page(self, token):
+        """
+        Get the page of the response for a page token, "page-<number>".
+
+        Returns dictionary.
+        """
+        if not self.page_size:
+            return self.response
+        try:
+            number = int(token.split('-')[1])
+        except (IndexError, ValueError):
+            return {'status': 'INVALID_REQUEST', 'results': [],
+                    'html_attributions': []}
+        start = number * self.page_size
+        page = dict(self.response)
+        page['results'] = self.response['results'][start:start
+                                                   + self.page_size]
+        if start + self.page_size < len(self.response['results']):
+            page['next_page_token'] = 'page-%d' % (number + 1)
+        return page
+
+    def get_details(self, reference):
+        """
+        Get the Place Details response for a reference.
+
+        Returns dictionary.
+        """
+        result = self.details.get(reference)
+        if result is None:
+            return {'status': 'NOT_FOUND', 'html_attributions': []}
+        return {'status': 'OK', 'result': result, 'html_attributions': []}
+
+    @property
+    def url(self):
+        """The search URL to use for GMAP_PLACE_URL."""
+        return ('http://%s:%d/maps/api/place/search/json'
+                % self.server_address)
+
+    def handle_error(self, request, client_address):
+        # Clients that time out and hang up are expected under load.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        """Serve from a daemon thread. Returns the thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,87 @@
+"""
+Per process pools of idle database connections, so that a request reuses a
+connection left by an earlier one instead of opening its own: Django 1.4
+opens a connection on a request's first query, and closes it when the
+request finishes. See core.backends.postgresql_pool, which uses them.
+
+A pool keeps up to size idle connections, most recently used first, and
+never blocks: a request that finds none opens a new connection, and a
+connection returned to a full pool is closed. A connection idle for a while
+is checked before it is reused, as the server or a proxy may have dropped
+it, and connections older than max_age seconds are closed rather than
+reused, so that server side resources are released from time to time.
+"""
+import threading, time
+
+class ConnectionPool(object):
+    """
+    Idle connections to one database. check(connection, idle seconds)
+    returns whether an idle connection can be reused, and close(connection)
+    closes one, ignoring errors.
+    """
+    def __init__(self, size, max_age, check, close):
+        self.size = size
+        self.max_age = max_age
+        self.check = check
+        self.close = close
+        self.lock = threading.Lock()
+        # (connection, created time, returned time) tuples, most recently
+        # returned last.
+        self.idle = []
+
+    def get(self):
+        """
+        Take the most recently returned usable connection, closing the
+        unusable ones found before it.
+
+        Returns tuple of (connection, created time), or None if there is
+        none.
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                connection, created, returned = self.idle.pop()
+            now = time.time()
+            if (now - created < self.max_age
+                    and self.check(connection, now - returned)):
+                return connection, created
+            self.close(connection)
+
+    def put(self, connection, created):
+        """Return a connection for reuse, or close it if it can't be kept."""
+        if time.time() - created < self.max_age:
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append((connection, created, time.time()))
+                    return
+        self.close(connection)
+
+    def clear(self):
+        """Close the idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, created, returned in idle:
+            self.close(connection)
+
+_pools = {}
+_lock = threading.Lock()
+
+def get_pool(key, size, max_age, check, close):
+    """
+    Get the pool of the database identified by key, a tuple of its
+    connection parameters, creating it if needed.
+
+    Returns ConnectionPool.
+    """
+    with _lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(size, max_age, check, close)
+        return _pools[key]
+
+def clear():
+    """Close the idle connections of all of the pools."""
+    with _lock:
+        pools = _pools.values()
+    for pool in pools:
+        pool.clear()
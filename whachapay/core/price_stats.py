@@ -0,0 +1,106 @@
+"""
+Robust deal price statistics: median, percentiles, trimmed mean, and
+interquartile range outlier fences, so that a single mistyped price doesn't
+skew a dealer's average.
+
+The functions work on arrays of prices that are already sorted, as the
+database returns them (see queries.add_price_stats), and on many groups of
+prices packed into one array. Percentiles are then index lookups, outliers
+are counted by bisection, and the trimmed sums run over array slices, so the
+cost per group is a few C-level operations rather than a Python loop over its
+prices. See the bench_price_stats command.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from django.conf import settings
+
+PERCENTILES = (('p10', 0.10), ('p25', 0.25), ('median', 0.50), ('p75', 0.75),
+               ('p90', 0.90))
+
+# Prices further than this many interquartile ranges below the first quartile
+# or above the third are outliers.
+FENCE_FACTOR = 1.5
+
+def to_array(prices):
+    """Returns array of the prices, sorted."""
+    return array('l', sorted(prices))
+
+def summarize(prices, start=0, end=None, trim=None):
+    """
+    Summarize the sorted prices between start and end, trimming the given
+    fraction of prices from each end for the trimmed mean. trim defaults to
+    settings.PRICE_TRIM_FRACTION.
+
+    Returns dictionary, or None if there are no prices. Prices are whole
+    dollars; means are rounded down, as the integer averages always were:
+        { 'count': 0,
+          'sum': 0,
+          'mean': 0,
+          'trimmed_mean': 0,
+          'p10': 0,
+          'p25': 0,
+          'median': 0,
+          'p75': 0,
+          'p90': 0,
+          'low_fence': 0,
+          'high_fence': 0,
+          'outliers': 0 }
+    """
+    if end is None:
+        end = len(prices)
+    count = end - start
+    if count <= 0:
+        return None
+    if trim is None:
+        trim = settings.PRICE_TRIM_FRACTION
+    total = sum(prices[start:end])
+    cut = int(count * trim)
+    summary = {'count': count,
+               'sum': total,
+               'mean': total // count,
+               'trimmed_mean': (sum(prices[start + cut:end - cut])
+                                // (count - 2 * cut))}
+    percentiles = dict((name, get_percentile(prices, start, end, q))
+                       for name, q in PERCENTILES)
+    for name, value in percentiles.iteritems():
+        summary[name] = int(round(value))
+    iqr = percentiles['p75'] - percentiles['p25']
+    low = percentiles['p25'] - FENCE_FACTOR * iqr
+    high = percentiles['p75'] + FENCE_FACTOR * iqr
+    summary['low_fence'] = int(low)
+    summary['high_fence'] = int(high)
+    summary['outliers'] = (bisect_left(prices, low, start, end) - start
+                           + end - bisect_right(prices, high, start, end))
+    return summary
+
+def summarize_groups(prices, counts, trim=None):
+    """
+    Summarize consecutive groups of prices, each sorted, with the given
+    number of prices in each group.
+
+    Returns list of dictionaries, in counts order. See summarize.
+    """
+    summaries = []
+    start = 0
+    for count in counts:
+        summaries.append(summarize(prices, start, start + count, trim))
+        start += count
+    return summaries
+
+def get_percentile(prices, start, end, q):
+    """
+    Get the q quantile of the sorted prices between start and end,
+    interpolating between the closest ranks.
+
+    Returns float.
+    """
+    position = (end - start - 1) * q
+    low = int(position)
+    value = prices[start + low]
+    if low + 1 < end - start:
+        value += (prices[start + low + 1] - value) * (position - low)
+    return float(value)
+
+def is_outlier(price, summary):
+    """Returns bool, whether a price is outside a summary's fences."""
+    return not summary['low_fence'] <= price <= summary['high_fence']
@@ -1,32 +1,61 @@
-from core import util
-from core.models import (Deal, Dealer, IPAddress, Make, MakeYear, Model, Trim,
-                         User, UserIP, Vehicle)
+from array import array
+from datetime import date
+from itertools import groupby
+from operator import itemgetter
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Sum
+from core import (catalog, geo, page_cache, price_stats, sketches, spam,
+                  tasks, util)
+from core.models import (Deal, Dealer, DealMonthStats, DealStats, IPAddress,
+                         Make, MakeYear, Model, Task, Trim, User, UserIP,
+                         Vehicle)
+
+def get_make_years():
+    """
+    Get the distinct make years, from the catalog index.
+
+    Returns tuple of ints, ascending.
+    """
+    return catalog.get_index().years
 
 def get_make_options(make_year):
-    """Get all makes for a given year."""
-    return Make.objects.filter(makeyear__year__exact=make_year)
+    """
+    Get all makes for a given year, from the catalog index.
+
+    Returns tuple of (pk, name) tuples.
+    """
+    return catalog.get_index().get_makes(util.get_int(make_year))
 
 def get_model_options(make_pk, model_year):
-    """Get all models for a given make and year."""
-    return Model.objects.filter(make=make_pk).filter(
-        modelyear__year__exact=model_year)
+    """
+    Get all models for a given make and year, from the catalog index.
+
+    Returns tuple of (pk, name) tuples.
+    """
+    return catalog.get_index().get_models(util.get_int(make_pk),
+                                          util.get_int(model_year))
 
 def get_trim_options(model_pk, trim_year):
-    """Get all trims for a given model and year."""
-    return Trim.objects.filter(model=model_pk).filter(
-        trimyear__year__exact=trim_year)
+    """
+    Get all trims for a given model and year, from the catalog index.
+
+    Returns tuple of (pk, name) tuples.
+    """
+    return catalog.get_index().get_trims(util.get_int(model_pk),
+                                         util.get_int(trim_year))
 
 def get_make_name(make_pk):
     """Get a make name for a given pk."""
-    return Make.objects.filter(pk=make_pk).values_list('name', flat=True)[0]
+    return catalog.get_index().get_make_name(int(make_pk))
 
 def get_model_name(model_pk):
     """Get a model name for a given pk."""
-    return Model.objects.filter(pk=model_pk).values_list('name', flat=True)[0]
+    return catalog.get_index().get_model_name(int(model_pk))
 
 def get_trim_name(trim_pk):
     """Get a trim name for a given pk."""
-    return Trim.objects.filter(pk=trim_pk).values_list('name', flat=True)[0]
+    return catalog.get_index().get_trim_name(int(trim_pk))
 
 def get_make_year(make_pk, make_year):
     """Get a make year for a given make pk and year."""
@@ -59,74 +88,622 @@ def get_dealer(place_id):
     except Dealer.DoesNotExist:
         return None
 
+def get_dealer_map_urls(place_ids):
+    """
+    Get the map image URLs of the enriched dealers among some place ids.
+
+    Returns dictionary of URLs keyed by place id.
+    """
+    if not place_ids:
+        return {}
+    return dict(Dealer.objects.filter(place_id__in=place_ids)
+                .exclude(map_url='').values_list('place_id', 'map_url'))
+
 def get_deals(vehicle, dealer, trim):
     """
-    Get the deals for a given vehicle, dealer, and optional trim.
+    Get the unflagged deals for a given vehicle, dealer, and optional trim.
+    Deals carry their vehicle, trim, and dealer names, so listing them is one
+    query.
+
+    Returns QuerySet ordered by price, empty if none found.
+    """
+    deals = Deal.objects.filter(vehicle=vehicle, dealer=dealer, flagged=False)
+    if trim:
+        deals = deals.filter(trim=trim)
+    return deals.order_by('price')
+
+def get_dealer_stats(place_ids, vehicle, trim):
+    """
+    Get the deal count, sum, and average price per dealer for the given place
+    ids, vehicle, and optional trim. Reads the precomputed DealStats rows in a
+    single grouped query, regardless of the number of place ids or deals.
+
+    Returns list, in place_ids order, of the dealers that have deals:
+        [ { 'place_id': '',
+            'name': '',
+            'location': '',
+            'address': '',
+            'count': 0,
+            'sum': 0,
+            'avg': 0 } ]
+    """
+    if not place_ids or not vehicle:
+        return []
+    stats = DealStats.objects.filter(vehicle=vehicle,
+                                     dealer__place_id__in=place_ids)
+    if trim:
+        stats = stats.filter(trim=trim)
+    # Sum across trims when no trim is given.
+    rows = stats.values(
+        'dealer__place_id', 'dealer__name', 'dealer__location',
+        'dealer__address').annotate(deal_count=Sum('count'),
+                                    deal_sum=Sum('sum'))
+    stats = [{'place_id': r['dealer__place_id'],
+              'name': r['dealer__name'],
+              'location': r['dealer__location'],
+              'address': r['dealer__address'],
+              'count': r['deal_count'],
+              'sum': r['deal_sum'],
+              'avg': r['deal_sum'] / r['deal_count']}
+             for r in rows if r['deal_count']]
+    order = dict((place_id, i) for i, place_id in enumerate(place_ids))
+    stats.sort(key=lambda s: order[s['place_id']])
+    return stats
+
+def get_nearby_dealer_stats(location, vehicle, trim, radius):
+    """
+    Get the deal stats of the known dealers within radius meters of a
+    "lat,lng" location, from the dealer index (see core.geo), without a
+    Places search.
+
+    Returns list, nearest first, of the dealers that have deals. See
+    get_dealer_stats; each also has 'distance', in meters.
+    """
+    nearby = get_nearby(location, radius)
+    distances = dict((place_id, d) for d, place_id in nearby)
+    stats = get_dealer_stats([place_id for d, place_id in nearby], vehicle,
+                             trim)
+    for s in stats:
+        s['distance'] = int(distances[s['place_id']])
+    return stats
+
+def get_nearby_dealer_ids(location, vehicle, trim, radius):
+    """
+    Get the place ids of the known dealers within radius meters of a
+    "lat,lng" location that have deals for the vehicle and optional trim, so
+    that a page of them can be looked up with get_dealer_stats.
+
+    Returns list, nearest first.
+    """
+    if not vehicle:
+        return []
+    place_ids = [place_id for d, place_id in get_nearby(location, radius)]
+    if not place_ids:
+        return []
+    stats = DealStats.objects.filter(vehicle=vehicle,
+                                     dealer__place_id__in=place_ids)
+    if trim:
+        stats = stats.filter(trim=trim)
+    with_deals = set(stats.values_list('dealer__place_id', flat=True))
+    return [place_id for place_id in place_ids if place_id in with_deals]
+
+def get_nearby(location, radius):
+    """
+    Get the known dealers within radius meters of a "lat,lng" location.
+
+    Returns list of (distance, place id) tuples, nearest first.
+    """
+    lat, lng = util.get_lat_lng(location)
+    if lat is None:
+        return []
+    return geo.get_index().get_nearby(lat, lng, radius)
+
+def get_price_stats(place_ids, vehicle, trim):
+    """
+    Get robust price statistics for each of the given dealers, and for all
+    of them together, leaving out the flagged deals. Up to
+    settings.PRICE_EXACT_LIMIT prices are read in a single query sorted by
+    dealer and price, and summarized exactly; beyond that, the statistics are
+    estimated from the merged price sketches of the DealStats rows. See
+    price_stats.summarize and sketches.summarize.
+
+    Returns tuple of (dictionary of summaries by place id, summary of all of
+    the prices or None if there are none).
+    """
+    if not place_ids or not vehicle:
+        return ({}, None)
+    deals = Deal.objects.filter(vehicle=vehicle,
+                                dealer__place_id__in=place_ids, flagged=False)
+    if trim:
+        deals = deals.filter(trim=trim)
+    rows = list(deals.order_by('dealer', 'price').values_list(
+        'dealer__place_id', 'price')[:settings.PRICE_EXACT_LIMIT + 1])
+    if len(rows) > settings.PRICE_EXACT_LIMIT:
+        return get_sketch_price_stats(place_ids, vehicle, trim)
+    prices = array('l')
+    keys, counts = [], []
+    for place_id, group in groupby(rows, itemgetter(0)):
+        start = len(prices)
+        prices.extend(price for p, price in group)
+        keys.append(place_id)
+        counts.append(len(prices) - start)
+    summaries = dict(zip(keys, price_stats.summarize_groups(prices, counts)))
+    if len(keys) == 1:
+        return (summaries, summaries[keys[0]])
+    return (summaries, price_stats.summarize(price_stats.to_array(prices)))
 
-    Returns list, empty if none found.
+def get_price_trend(place_ids, vehicle, trim, months, today=None):
     """
-    deals = Deal.objects.filter(vehicle=vehicle, dealer=dealer)
-    return deals.filter(trim=trim) if trim else deals
+    Get the monthly price aggregates of the given dealers over the last
+    months months, up to and including today's, from the DealMonthStats
+    rows rather than the deals.
+
+    Returns list, oldest month first, with a dictionary for every month:
+        [ { 'month': 'YYYY-MM',
+            'count': 0,
+            'mean': 0,     # None if count is 0; the same goes for the rest
+            'median': 0,   # estimated from the price sketches
+            'min': 0,
+            'max': 0 } ]
+    """
+    end = util.get_month(today or date.today())
+    start = util.add_months(end, 1 - months)
+    totals = {}
+    if place_ids and vehicle:
+        rows = DealMonthStats.objects.filter(
+            vehicle=vehicle, dealer__place_id__in=place_ids, month__gte=start,
+            month__lte=end)
+        if trim:
+            rows = rows.filter(trim=trim)
+        for month, n, total, low, high, sketch in rows.values_list(
+                'month', 'count', 'sum', 'min_price', 'max_price', 'sketch'):
+            sketch = sketches.PriceSketch.decode(sketch)
+            if month in totals:
+                t = totals[month]
+                totals[month] = (t[0] + n, t[1] + total, min(t[2], low),
+                                 max(t[3], high), t[4].merge(sketch))
+            else:
+                totals[month] = (n, total, low, high, sketch)
+    trend = []
+    month = start
+    while month <= end:
+        n, total, low, high, sketch = totals.get(month,
+                                                 (0, 0, None, None, None))
+        trend.append({'month': month.strftime('%Y-%m'),
+                      'count': n,
+                      'mean': total // n if n else None,
+                      'median': (int(round(sketch.get_quantile(0.5)))
+                                 if n else None),
+                      'min': low,
+                      'max': high})
+        month = util.add_months(month, 1)
+    return trend
+
+def get_sketch_price_stats(place_ids, vehicle, trim):
+    """
+    Estimate the price statistics of get_price_stats from the price sketches
+    of the DealStats rows, merging a dealer's trims, and all of the dealers.
+
+    Returns tuple. See get_price_stats.
+    """
+    rows = DealStats.objects.filter(vehicle=vehicle,
+                                    dealer__place_id__in=place_ids)
+    if trim:
+        rows = rows.filter(trim=trim)
+    dealers = {}
+    for place_id, total, sketch in rows.values_list('dealer__place_id', 'sum',
+                                                    'sketch'):
+        merged, dealer_total = dealers.get(place_id, (None, 0))
+        sketch = sketches.PriceSketch.decode(sketch)
+        dealers[place_id] = (merged.merge(sketch) if merged else sketch,
+                             dealer_total + total)
+    summaries = dict((place_id, sketches.summarize(sketch, total))
+                     for place_id, (sketch, total) in dealers.iteritems())
+    area = sketches.merge(sketch for sketch, total in dealers.itervalues())
+    return (summaries, sketches.summarize(
+        area, sum(total for sketch, total in dealers.itervalues())))
+
+def add_price_stats(stats, summaries):
+    """
+    Add the robust price statistics from get_price_stats to the dealer stats
+    returned by get_dealer_stats. Each dealer's 'avg' becomes its trimmed
+    mean, and it gains 'median' and 'outliers'.
+
+    Nothing returned; stats is updated.
+    """
+    for s in stats:
+        summary = summaries.get(s['place_id'])
+        if summary:
+            s['avg'] = summary['trimmed_mean']
+            s['median'] = summary['median']
+            s['outliers'] = summary['outliers']
 
 def get_deal(deal_pk):
-    """Get a deal for a given pk."""
+    """Get a deal for a given pk, with its dealer and user."""
     try:
-        return Deal.objects.get(pk=deal_pk)
+        return Deal.objects.select_related('dealer', 'user_ip__user').get(
+            pk=deal_pk)
     except Deal.DoesNotExist:
         return None
 
-def store_user_ip(meta, form_data):
+def enter_deal(meta, selection, place_data, form_data):
+    """
+    Deal entry view helper function. Store a deal, resolving its user, IP,
+    vehicle, and dealer, in one transaction, and queue the update of the deal
+    stats and pages; see core.tasks. A deal scored as spam is stored flagged,
+    and left out of the stats; see core.spam.
+
+    Returns Deal.
+    """
+    deal = store_deal_entry(util.get_client_ip(meta), selection, place_data,
+                            form_data)
+    tasks.run_eager()
+    return deal
+
+@transaction.commit_on_success
+def store_deal_entry(ip, selection, place_data, form_data):
+    """
+    Store a deal with a handful of queries: one each for the user IP, vehicle,
+    trim, and dealer when they already exist, the near duplicate lookup, and
+    the inserts of the deal and its task. The vehicle is read with the names
+    that the deal copies.
+
+    Returns Deal.
+    """
+    user_ip = resolve_user_ip(ip, form_data['email'])
+    vehicle = resolve_vehicle(selection['year'], selection['make'],
+                              selection['model'])
+    dealer = resolve_dealer(place_data)
+    entry_hash, reasons = spam.score_entry(
+        ip, form_data['email'], user_ip.user_id, vehicle.pk, dealer.pk,
+        form_data['price'], form_data['date'])
+    deal = Deal.objects.create(
+        user_ip=user_ip,
+        vehicle=vehicle,
+        trim=get_trim(form_data['trim']),
+        dealer=dealer,
+        price=form_data['price'],
+        date=form_data['date'],
+        comment=form_data['comment'],
+        entry_hash=entry_hash,
+        flagged=bool(reasons),
+        spam_reasons=','.join(reasons))
+    if not deal.flagged:
+        tasks.defer('deal_stored', deal.pk)
+    return deal
+
+def approve_deals(deal_pks):
+    """
+    Clear the flag of flagged deals, queue their addition to the deal stats
+    and pages, and invalidate their detail pages once committed. A deal
+    still queued for the stats, flagged before its task ran, is counted by
+    that task.
+
+    Returns int, the number of deals approved.
+    """
+    with transaction.commit_on_success():
+        queued = get_queued_deals()
+        approved = list(Deal.objects.filter(pk__in=deal_pks, flagged=True)
+                        .values_list('pk', flat=True))
+        Deal.objects.filter(pk__in=approved).update(flagged=False)
+        for deal_pk in approved:
+            if deal_pk not in queued:
+                tasks.defer('deal_stored', deal_pk)
+    page_cache.bump(*map(page_cache.get_deal_key, approved))
+    return len(approved)
+
+def flag_deals(deal_pks):
+    """
+    Flag deals as spam, taking the counted ones out of the deal stats, and
+    invalidate the pages that showed them, and their detail pages, once
+    committed. The deals still
+    queued for the stats are only flagged, as process_stored_deals skips
+    them; their tasks are locked meanwhile so that a worker can't count them.
+
+    Returns int, the number of deals flagged.
     """
-    Deal entry view helper function.
+    groups = {}
+    month_groups = {}
+    keys = set()
+    with transaction.commit_on_success():
+        queued = get_queued_deals()
+        deals = list(Deal.objects.filter(pk__in=deal_pks, flagged=False)
+                     .values_list('pk', 'vehicle', 'trim', 'dealer', 'price',
+                                  'date', 'year', 'vehicle__make',
+                                  'vehicle__model', 'dealer__place_id'))
+        Deal.objects.filter(pk__in=[d[0] for d in deals]).update(flagged=True)
+        for (pk, vehicle, trim, dealer, price, day, year, make, model,
+             place_id) in deals:
+            keys.add(page_cache.get_deal_key(pk))
+            if pk in queued:
+                continue
+            groups.setdefault((vehicle, trim, dealer), []).append(price)
+            month_groups.setdefault(
+                (vehicle, trim, dealer, util.get_month(day)), []).append(price)
+            keys.add(page_cache.get_vehicle_key(year, make, model))
+            keys.add(page_cache.get_dealer_key(year, make, model, place_id))
+        for (vehicle, trim, dealer), prices in sorted(groups.iteritems()):
+            remove_stats(DealStats,
+                         {'vehicle': vehicle, 'trim': trim, 'dealer': dealer},
+                         prices, queued)
+        for (vehicle, trim, dealer, month), prices in sorted(
+                month_groups.iteritems()):
+            remove_stats(DealMonthStats,
+                         {'vehicle': vehicle, 'trim': trim, 'dealer': dealer,
+                          'month': month},
+                         prices, queued)
+    page_cache.bump(*keys)
+    return len(deals)
+
+def get_queued_deals():
+    """
+    Get the deals whose deal_stored task hasn't run, locking the tasks until
+    the transaction ends so that a worker can't run them meanwhile.
+
+    Returns set of ints.
+    """
+    return set(Task.objects.select_for_update().filter(name='deal_stored')
+               .values_list('arg', flat=True))
+
+def resolve_user_ip(ip, email):
+    """
+    Get the UserIP of an IP address and email, in one query if it exists,
+    creating the missing IPAddress, User, and UserIP.
 
     Returns UserIP.
     """
-    ip, ipcreated = IPAddress.objects.get_or_create(
-        ip=util.get_client_ip(meta))
-    user, usercreated = User.objects.get_or_create(email=form_data['email'])
-    user_ip, uipcreated = UserIP.objects.get_or_create(user=user, ip=ip)
-    return user_ip
+    user_ips = list(UserIP.objects.filter(ip__ip=ip, user__email=email)
+                    .order_by('pk')[:1])
+    if user_ips:
+        return user_ips[0]
+    return get_or_insert(UserIP, user=get_or_insert(User, email=email),
+                         ip=get_or_insert(IPAddress, ip=ip))
 
-def store_vehicle(data):
+def resolve_vehicle(make_year, make_pk, model_pk):
     """
-    Deal entry view helper function.
-    
+    Get the vehicle of a year, make, and model, with its make year, make,
+    and model, in one query if it exists, creating it otherwise.
+
     Returns Vehicle.
     """
-    vehicle, vcreated = Vehicle.objects.get_or_create(
-        make_year=get_make_year(data['obj']['make'], data['text']['year']),
-        make=get_make(data['obj']['make']),
-        model=get_model(data['obj']['model']))
-    return vehicle
+    vehicles = list(Vehicle.objects
+                    .select_related('make_year', 'make', 'model')
+                    .filter(make_year__year=make_year, make=make_pk,
+                            model=model_pk)[:1])
+    if vehicles:
+        return vehicles[0]
+    return get_or_insert(Vehicle, make_year=get_make_year(make_pk, make_year),
+                         make=get_make(make_pk), model=get_model(model_pk))
 
-def store_dealer(data):
+def resolve_dealer(data):
     """
-    Deal entry view helper function. Enforces uniqueness by place_id. Assumes
-    that Google generates a new place_id if a physical location changes name,
-    etc.
+    Get the dealer of a Places result, creating it if it's new. Assumes that
+    Google generates a new place_id if a physical location changes name, etc.
 
     Returns Dealer.
     """
+    return get_or_insert(Dealer, place_id=data['id'],
+                         defaults={'location': data['location'],
+                                   'name': data['name'],
+                                   'address': data['vicinity'],
+                                   'reference': data.get('reference', '')})
+
+def get_or_insert(model, defaults=None, **kwargs):
+    """
+    Get the first model instance matching kwargs, or insert one. Safe against
+    concurrent inserts where kwargs are unique: the insert is made in a
+    savepoint, and on an IntegrityError the winner is read instead. Where
+    they aren't unique, concurrent inserts make duplicates, of which the
+    first is always returned.
+
+    Returns model instance.
+    """
+    rows = list(model.objects.filter(**kwargs).order_by('pk')[:1])
+    if rows:
+        return rows[0]
+    params = dict(kwargs, **(defaults or {}))
+    sid = transaction.savepoint()
     try:
-        dealer = Dealer.objects.get(place_id=data['id'])
-    except Dealer.DoesNotExist:
-        dealer = Dealer.objects.create(
-            place_id=data['id'],
-            location=data['location'],
-            name=data['name'],
-            address=data['vicinity'])
-    return dealer
+        obj = model.objects.create(**params)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return model.objects.filter(**kwargs).order_by('pk')[0]
+    transaction.savepoint_commit(sid)
+    return obj
 
-def store_deal(user_ip, vehicle, dealer, data):
+def add_deal_stats(vehicle_pk, trim_pk, dealer_pk, prices):
     """
-    Deal entry view helper function.
+    Add prices to the DealStats row for a vehicle, trim, and dealer, creating
+    the row if needed.
 
-    Returns Deal.
+    Nothing returned.
     """
-    return Deal.objects.create(user_ip=user_ip,
-                               vehicle=vehicle,
-                               trim=get_trim(data['trim']),
-                               dealer=dealer,
-                               price=data['price'],
-                               date=data['date'],
-                               comment=data['comment'])
+    add_stats(DealStats, {'vehicle': vehicle_pk, 'trim': trim_pk,
+                          'dealer': dealer_pk}, prices)
+
+def add_month_stats(vehicle_pk, trim_pk, dealer_pk, month, prices):
+    """
+    Add prices to the DealMonthStats row for a vehicle, trim, dealer, and
+    month, creating the row if needed.
+
+    Nothing returned.
+    """
+    add_stats(DealMonthStats, {'vehicle': vehicle_pk, 'trim': trim_pk,
+                               'dealer': dealer_pk, 'month': month}, prices)
+
+def add_stats(model, keys, prices):
+    """
+    Add prices to the DealStats or DealMonthStats row with the given keys,
+    creating the row if needed. Call in a transaction. The counters are
+    incremented in the database so that concurrent deals aren't lost, and a
+    concurrent creation of the row is retried as an increment.
+
+    Nothing returned.
+    """
+    count, total = len(prices), sum(prices)
+    low, high = min(prices), max(prices)
+    squares = sum(p * p for p in prices)
+    sketch = sketches.PriceSketch.from_prices(prices)
+    rows = model.objects.filter(**keys)
+    def increment():
+        if not rows.update(count=F('count') + count, sum=F('sum') + total,
+                           sum_squares=F('sum_squares') + squares):
+            return False
+        # The update holds the row's lock until the transaction ends, so the
+        # rest can be read, merged, and written back.
+        old_low, old_high, old_sketch = rows.values_list(
+            'min_price', 'max_price', 'sketch')[0]
+        rows.update(min_price=min(low, old_low), max_price=max(high, old_high),
+                    sketch=sketches.PriceSketch.decode(old_sketch).merge(
+                        sketch).encode())
+        return True
+    if increment():
+        return
+    sid = transaction.savepoint()
+    columns = dict((model._meta.get_field(name).attname, value)
+                   for name, value in keys.iteritems())
+    try:
+        model.objects.create(count=count, sum=total, min_price=low,
+                             max_price=high, sum_squares=squares,
+                             sketch=sketch.encode(), **columns)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        increment()
+    else:
+        transaction.savepoint_commit(sid)
+
+def remove_stats(model, keys, prices, queued):
+    """
+    Remove counted prices from the DealStats or DealMonthStats row with the
+    given keys. Call in a transaction. The counters are decremented in the
+    database, and the row is deleted once empty; the min, max, and sketch,
+    which can't be subtracted, are recomputed from the row's unflagged deals,
+    leaving out those whose pks are in queued, which aren't counted yet.
+
+    Nothing returned.
+    """
+    rows = model.objects.filter(**keys)
+    rows.update(count=F('count') - len(prices), sum=F('sum') - sum(prices),
+                sum_squares=F('sum_squares') - sum(p * p for p in prices))
+    rows.filter(count__lte=0).delete()
+    deals = Deal.objects.filter(vehicle=keys['vehicle'], trim=keys['trim'],
+                                dealer=keys['dealer'], flagged=False)
+    if 'month' in keys:
+        deals = deals.filter(date__gte=keys['month'],
+                             date__lt=util.add_months(keys['month'], 1))
+    remaining = [price for pk, price in deals.values_list('pk', 'price')
+                 if pk not in queued]
+    if remaining:
+        rows.update(min_price=min(remaining), max_price=max(remaining),
+                    sketch=sketches.PriceSketch.from_prices(remaining)
+                    .encode())
+
+def process_stored_deals(deal_pks):
+    """
+    deal_stored task handler. Add newly stored or approved deals to the deal
+    stats and month stats, a row at a time, and invalidate the pages that
+    show them once committed. Flagged deals are skipped.
+
+    Returns function.
+    """
+    groups = {}
+    month_groups = {}
+    keys = set()
+    for (vehicle, trim, dealer, price, day, year, make, model,
+         place_id) in Deal.objects.filter(pk__in=deal_pks,
+                                          flagged=False).values_list(
+            'vehicle', 'trim', 'dealer', 'price', 'date', 'year',
+            'vehicle__make', 'vehicle__model', 'dealer__place_id'):
+        groups.setdefault((vehicle, trim, dealer), []).append(price)
+        month_groups.setdefault((vehicle, trim, dealer, util.get_month(day)),
+                                []).append(price)
+        keys.add(page_cache.get_vehicle_key(year, make, model))
+        keys.add(page_cache.get_dealer_key(year, make, model, place_id))
+    for (vehicle, trim, dealer), prices in sorted(groups.iteritems()):
+        add_deal_stats(vehicle, trim, dealer, prices)
+    for (vehicle, trim, dealer, month), prices in sorted(
+            month_groups.iteritems()):
+        add_month_stats(vehicle, trim, dealer, month, prices)
+    return lambda: page_cache.bump(*keys)
+
+@transaction.commit_on_success
+def rebuild_deal_stats():
+    """
+    Replace all DealStats and DealMonthStats rows with aggregates computed
+    from the unflagged deals, using an INSERT ... SELECT for each, then fill
+    in their price sketches.
+
+    Returns int, the number of DealStats rows.
+    """
+    DealStats.objects.all().delete()
+    DealMonthStats.objects.all().delete()
+    cursor = connection.cursor()
+    tables = {'stats': DealStats._meta.db_table,
+              'month_stats': DealMonthStats._meta.db_table,
+              'deal': Deal._meta.db_table,
+              'month': get_month_sql(connection.ops.quote_name('date'))}
+    cursor.execute(
+        'INSERT INTO %(stats)s (vehicle_id, trim_id, dealer_id, count, sum,'
+        ' min_price, max_price, sum_squares, sketch)'
+        ' SELECT vehicle_id, trim_id, dealer_id, COUNT(*), SUM(price),'
+        " MIN(price), MAX(price), SUM(CAST(price AS BIGINT) * price), ''"
+        ' FROM %(deal)s WHERE NOT flagged'
+        ' GROUP BY vehicle_id, trim_id, dealer_id' % tables)
+    cursor.execute(
+        'INSERT INTO %(month_stats)s (vehicle_id, trim_id, dealer_id, month,'
+        ' count, sum, min_price, max_price, sum_squares, sketch)'
+        ' SELECT vehicle_id, trim_id, dealer_id, %(month)s, COUNT(*),'
+        ' SUM(price), MIN(price), MAX(price),'
+        " SUM(CAST(price AS BIGINT) * price), ''"
+        ' FROM %(deal)s WHERE NOT flagged'
+        ' GROUP BY vehicle_id, trim_id, dealer_id, %(month)s' % tables)
+    fill_sketches()
+    transaction.set_dirty()
+    page_cache.bump_all()
+    return DealStats.objects.count()
+
+def fill_sketches(chunk_size=10000):
+    """
+    Compute the price sketches of the DealStats and DealMonthStats rows in
+    one pass over the deals, in the order of the vehicle, dealer, and trim
+    index, and write them chunk_size rows at a time.
+
+    Nothing returned.
+    """
+    qn = connection.ops.quote_name
+    stats_sql = ('UPDATE %s SET sketch = %%s WHERE vehicle_id = %%s'
+                 ' AND trim_id = %%s AND dealer_id = %%s'
+                 % qn(DealStats._meta.db_table))
+    month_sql = stats_sql.replace(qn(DealStats._meta.db_table),
+                                  qn(DealMonthStats._meta.db_table)) + (
+        ' AND month = %s')
+    cursor = connection.cursor()
+    stats_rows, month_rows = [], []
+    deals = Deal.objects.filter(flagged=False).order_by(
+        'vehicle', 'dealer', 'trim').values_list(
+        'vehicle', 'trim', 'dealer', 'date', 'price').iterator()
+    for key, group in groupby(deals, itemgetter(0, 1, 2)):
+        sketch = sketches.PriceSketch()
+        months = {}
+        for vehicle, trim, dealer, day, price in group:
+            sketch.add(price)
+            month = util.get_month(day)
+            if month not in months:
+                months[month] = sketches.PriceSketch()
+            months[month].add(price)
+        stats_rows.append((sketch.encode(),) + key)
+        month_rows.extend((s.encode(),) + key + (month,)
+                          for month, s in months.iteritems())
+        if len(stats_rows) + len(month_rows) >= chunk_size:
+            cursor.executemany(stats_sql, stats_rows)
+            cursor.executemany(month_sql, month_rows)
+            stats_rows, month_rows = [], []
+    if stats_rows:
+        cursor.executemany(stats_sql, stats_rows)
+        cursor.executemany(month_sql, month_rows)
+
+def get_month_sql(column):
+    """Returns string, the SQL of the first day of a date column's month."""
+    if connection.vendor == 'postgresql':
+        return "CAST(date_trunc('month', %s) AS date)" % column
+    return "date(%s, 'start of month')" % column
@@ -0,0 +1,85 @@
+"""
+Read replica routing. The views decorated with read_only, which only read the
+deals, read the core models from one of settings.DATABASE_REPLICAS, picked
+for the request; everything else, and all writes, use the default database.
+
+Replicas lag behind the default database, so a visitor who has just entered
+a deal is pinned to the default database for DATABASE_REPLICA_LAG seconds,
+with a cookie, and reads their own deal. The cached pages are also rendered
+from the default database for that long after their data changes (see
+core.page_cache), so that a lagging replica can't cache a stale page for
+everyone.
+"""
+import random, threading
+from contextlib import contextmanager
+from functools import wraps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Set after a deal is entered, for DATABASE_REPLICA_LAG seconds.
+PIN_COOKIE = 'primary'
+
+_state = threading.local()
+
+class ReplicaRouter(object):
+    """
+    Routes the core models' reads to the replica of the current read_only
+    view, if any, and all writes to the default database.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'core':
+            return get_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Explicit, or the instances read from a replica would be saved to it.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the default database.
+        return True
+
+    def allow_syncdb(self, db, model):
+        return db not in settings.DATABASE_REPLICAS
+
+def get_replica():
+    """Returns string, the alias of the current request's replica, or None."""
+    return getattr(_state, 'replica', None)
+
+def read_only(view):
+    """
+    Decorator of the views that only read, to read from a replica unless the
+    visitor is pinned to the default database.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not settings.DATABASE_REPLICAS or PIN_COOKIE in request.COOKIES:
+            return view(request, *args, **kwargs)
+        _state.replica = random.choice(settings.DATABASE_REPLICAS)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _state.replica = None
+    return wrapper
+
+def pin_primary(response):
+    """
+    Pin the visitor to the default database until the replicas have their
+    writes.
+
+    Returns the response.
+    """
+    if settings.DATABASE_REPLICAS:
+        response.set_cookie(PIN_COOKIE, '1',
+                            max_age=settings.DATABASE_REPLICA_LAG)
+    return response
+
+@contextmanager
+def use_primary():
+    """Read from the default database within the block."""
+    replica = get_replica()
+    _state.replica = None
+    try:
+        yield
+    finally:
+        _state.replica = replica
@@ -0,0 +1,214 @@
+"""
+Schema additions that Django 1.4 syncdb can't make by itself: composite
+indexes, columns added to existing tables, and the unique_together constraints
+for tables created before the constraints were added.
+
+syncdb creates the indexes for the tables it creates (see core.management).
+Run the upgrade_schema command to bring an existing database up to date.
+"""
+from django.db import connection, transaction
+from core import queries
+from core.models import (Deal, Dealer, DealMonthStats, DealStats, Make,
+                         MakeYear, Model, ModelYear, Trim, TrimYear, Vehicle)
+
+# Fields added to the models after their tables were first created:
+# (model, field name)
+COLUMNS = (
+    (Deal, 'content_hash'),
+    (Dealer, 'latitude'),
+    (Dealer, 'longitude'),
+    (Deal, 'year'),
+    (Deal, 'make_name'),
+    (Deal, 'model_name'),
+    (Deal, 'trim_name'),
+    (Deal, 'dealer_name'),
+    (Dealer, 'reference'),
+    (Dealer, 'formatted_address'),
+    (Dealer, 'street'),
+    (Dealer, 'city'),
+    (Dealer, 'state'),
+    (Dealer, 'postal_code'),
+    (Dealer, 'country'),
+    (Dealer, 'map_url'),
+    (Dealer, 'enriched'),
+    (DealStats, 'sketch'),
+    (DealMonthStats, 'sketch'),
+    (Deal, 'entry_hash'),
+    (Deal, 'flagged'),
+    (Deal, 'spam_reasons'),
+    (Dealer, 'enrich_attempts'),
+)
+
+# (name, model, field names, unique)
+INDEXES = (
+    # get_deals, with a trim, ordered by price.
+    ('core_deal_vehicle_dealer_trim_price', Deal,
+     ('vehicle', 'dealer', 'trim', 'price'), False),
+    # get_deals for all trims, ordered by price.
+    ('core_deal_vehicle_dealer_price', Deal, ('vehicle', 'dealer', 'price'),
+     False),
+    # Deal ingestion deduplication. Not declared on the field, as a unique
+    # column can't be added to an existing SQLite table.
+    ('core_deal_content_hash', Deal, ('content_hash',), True),
+    # Near duplicate detection; see core.spam.
+    ('core_deal_entry_hash', Deal, ('entry_hash',), False),
+)
+
+# Equivalent to the models' unique_together, which syncdb only creates along
+# with the table.
+UNIQUE_TOGETHER_INDEXES = (
+    # get_vehicle.
+    ('core_vehicle_make_year_make_model', Vehicle,
+     ('make_year', 'make', 'model'), True),
+    # get_make_year.
+    ('core_makeyear_make_year', MakeYear, ('make', 'year'), True),
+    ('core_modelyear_model_year', ModelYear, ('model', 'year'), True),
+    ('core_trimyear_trim_year', TrimYear, ('trim', 'year'), True),
+)
+
+@transaction.commit_on_success
+def upgrade():
+    """
+    Add the missing columns and fill in the dealer coordinates, deal names,
+    and price sketches, then add the missing indexes, including the
+    unique_together ones.
+
+    Returns list of descriptions of the changes made.
+    """
+    added = add_columns()
+    changes = ['column %s.%s' % (model._meta.db_table, field)
+               for model, field in added]
+    filled = fill_dealer_coordinates()
+    if filled:
+        changes.append('coordinates for %d dealers' % filled)
+    filled = fill_deal_names()
+    if filled:
+        changes.append('names for %d deals' % filled)
+    if (DealStats, 'sketch') in added or (DealMonthStats, 'sketch') in added:
+        # The price sketches can only be computed from the deals.
+        changes.append('price sketches for %d deal stats'
+                       % queries.rebuild_deal_stats())
+    changes += ['index %s' % name
+                for name in create_indexes(unique_together=True)]
+    return changes
+
+def add_columns():
+    """
+    Add the COLUMNS that are missing from their tables. The columns must be
+    nullable or have a default.
+
+    Returns list of the (model, field name) pairs added.
+    """
+    cursor = connection.cursor()
+    added = []
+    for model, name in COLUMNS:
+        table = model._meta.db_table
+        columns = [c[0] for c in
+                   connection.introspection.get_table_description(cursor,
+                                                                  table)]
+        field = model._meta.get_field(name)
+        if field.column in columns:
+            continue
+        cursor.execute(get_add_column_sql(model, field))
+        added.append((model, name))
+    if added:
+        transaction.set_dirty()
+    return added
+
+def fill_dealer_coordinates():
+    """
+    Parse the coordinates of the dealers saved before they were added.
+
+    Returns int, the number of dealers updated.
+    """
+    filled = 0
+    for dealer in Dealer.objects.filter(latitude__isnull=True):
+        # Saving parses the location; see core.models.
+        dealer.save()
+        if dealer.latitude is not None:
+            filled += 1
+    return filled
+
+def fill_deal_names():
+    """
+    Copy the vehicle, trim, and dealer names into the deals saved before the
+    name columns were added, in one UPDATE.
+
+    Returns int, the number of deals updated.
+    """
+    qn = connection.ops.quote_name
+    tables = dict((model.__name__.lower(), qn(model._meta.db_table))
+                  for model in (Deal, Dealer, Make, MakeYear, Model, Trim,
+                                Vehicle))
+    cursor = connection.cursor()
+    cursor.execute(
+        'UPDATE %(deal)s SET'
+        ' year = (SELECT y.year FROM %(vehicle)s v JOIN %(makeyear)s y'
+        '  ON y.id = v.make_year_id WHERE v.id = %(deal)s.vehicle_id),'
+        ' make_name = (SELECT m.name FROM %(vehicle)s v JOIN %(make)s m'
+        '  ON m.id = v.make_id WHERE v.id = %(deal)s.vehicle_id),'
+        ' model_name = (SELECT m.name FROM %(vehicle)s v JOIN %(model)s m'
+        '  ON m.id = v.model_id WHERE v.id = %(deal)s.vehicle_id),'
+        ' trim_name = (SELECT name FROM %(trim)s'
+        '  WHERE id = %(deal)s.trim_id),'
+        ' dealer_name = (SELECT name FROM %(dealer)s'
+        '  WHERE id = %(deal)s.dealer_id)'
+        ' WHERE year IS NULL' % tables)
+    if cursor.rowcount:
+        transaction.set_dirty()
+    return max(cursor.rowcount, 0)
+
+def get_add_column_sql(model, field):
+    """Returns string."""
+    qn = connection.ops.quote_name
+    definition = field.db_type(connection=connection)
+    if field.null:
+        definition += ' NULL'
+    else:
+        default = field.get_default()
+        if isinstance(default, bool):
+            default = 'TRUE' if default else 'FALSE'
+        elif isinstance(default, basestring):
+            default = "'%s'" % default.replace("'", "''")
+        definition += ' NOT NULL DEFAULT %s' % default
+    return 'ALTER TABLE %s ADD COLUMN %s %s' % (qn(model._meta.db_table),
+                                                qn(field.column), definition)
+
+@transaction.commit_on_success
+def create_indexes(models=None, unique_together=False):
+    """
+    Create the missing indexes, optionally limited to those on the given
+    models, and optionally including the unique_together indexes.
+
+    Returns list of the names of the indexes created.
+    """
+    specs = INDEXES + (UNIQUE_TOGETHER_INDEXES if unique_together else ())
+    cursor = connection.cursor()
+    created = []
+    for name, model, fields, unique in specs:
+        if models is not None and model not in models:
+            continue
+        if index_exists(cursor, name):
+            continue
+        cursor.execute(get_create_index_sql(name, model, fields, unique))
+        created.append(name)
+    if created:
+        transaction.set_dirty()
+    return created
+
+def get_create_index_sql(name, model, fields, unique):
+    """Returns string."""
+    qn = connection.ops.quote_name
+    columns = [model._meta.get_field(f).column for f in fields]
+    return 'CREATE %sINDEX %s ON %s (%s)' % ('UNIQUE ' if unique else '',
+                                             qn(name), qn(model._meta.db_table),
+                                             ', '.join(map(qn, columns)))
+
+def index_exists(cursor, name):
+    """Returns bool."""
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [name])
+    else:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index'"
+                       " AND name = %s", [name])
+    return cursor.fetchone() is not None
@@ -0,0 +1,169 @@
+"""
+Mergeable price quantile sketches, so that the percentiles of an area's deals
+can be computed from a few stored summaries instead of from the deals.
+
+A sketch is a histogram of prices in logarithmic buckets, as in DDSketch:
+bucket i holds the prices in (GAMMA ** (i - 1), GAMMA ** i], and stands for a
+value within ACCURACY, relative, of each of them. So a quantile of a sketch is
+within ACCURACY of the price of the same rank, however many prices there
+are; merging sketches is adding their bucket counts, which loses nothing; and
+a sketch has at most one bucket per 1% of its price range.
+
+The DealStats and DealMonthStats rows store the sketch of their prices as
+text (see PriceSketch.encode). Changing ACCURACY makes the stored sketches
+unmergeable with new ones; run the rebuild_deal_stats command after.
+"""
+import math
+from bisect import bisect_right
+from django.conf import settings
+from core import price_stats
+
+ACCURACY = 0.005
+GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+class PriceSketch(object):
+    """
+    Histogram of prices in logarithmic buckets. Prices below 1 are counted as
+    1.
+    """
+    def __init__(self, buckets=None):
+        # Counts keyed by bucket index.
+        self.buckets = buckets if buckets is not None else {}
+        self.count = sum(self.buckets.itervalues())
+        # Memoized (rank ends, values) of the buckets in order.
+        self._ranks = None
+
+    @classmethod
+    def from_prices(cls, prices):
+        """Returns PriceSketch of the prices."""
+        sketch = cls()
+        for price in prices:
+            sketch.add(price)
+        return sketch
+
+    @classmethod
+    def decode(cls, text):
+        """
+        Parse a sketch encoded by encode(). An empty string is an empty
+        sketch.
+
+        Returns PriceSketch.
+        """
+        buckets = {}
+        if text:
+            for pair in text.split(','):
+                index, count = pair.split(':')
+                buckets[int(index)] = int(count)
+        return cls(buckets)
+
+    def encode(self):
+        """Returns string: "index:count" pairs, in index order, by commas."""
+        return ','.join('%d:%d' % (index, self.buckets[index])
+                        for index in sorted(self.buckets))
+
+    def add(self, price, count=1):
+        index = get_bucket(price)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self._ranks = None
+
+    def merge(self, other):
+        """Add another sketch's counts to this one. Returns self."""
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self._ranks = None
+        return self
+
+    def iter_values(self):
+        """Returns iterator of (value, count) tuples, ascending."""
+        return ((get_value(index), self.buckets[index])
+                for index in sorted(self.buckets))
+
+    def get_quantile(self, q):
+        """
+        Get the q quantile, interpolating between the closest ranks as
+        price_stats.get_percentile does.
+
+        Returns float, or None if the sketch is empty.
+        """
+        if not self.count:
+            return None
+        if self._ranks is None:
+            ends, values = [], []
+            rank = 0
+            for value, count in self.iter_values():
+                rank += count
+                ends.append(rank)
+                values.append(value)
+            self._ranks = (ends, values)
+        ends, values = self._ranks
+        position = (self.count - 1) * q
+        low = int(position)
+        value = values[bisect_right(ends, low)]
+        if low + 1 < self.count:
+            value += ((values[bisect_right(ends, low + 1)] - value)
+                      * (position - low))
+        return value
+
+def get_bucket(price):
+    """Returns int, the index of a price's bucket."""
+    return int(math.ceil(math.log(max(price, 1)) / LOG_GAMMA))
+
+def get_value(index):
+    """
+    Returns float, the value standing for the prices in a bucket, within
+    ACCURACY of each.
+    """
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+def merge(sketches):
+    """Returns PriceSketch, the sum of the sketches."""
+    merged = PriceSketch()
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
+
+def summarize(sketch, total=None, trim=None):
+    """
+    Summarize a sketch as price_stats.summarize summarizes prices, trimming
+    the given fraction of prices from each end for the trimmed mean. trim
+    defaults to settings.PRICE_TRIM_FRACTION. total is the exact sum of the
+    prices, if known; otherwise the sum and mean are estimated as well.
+
+    Returns dictionary, or None if the sketch is empty. See
+    price_stats.summarize.
+    """
+    count = sketch.count
+    if not count:
+        return None
+    if trim is None:
+        trim = settings.PRICE_TRIM_FRACTION
+    if total is None:
+        total = int(sum(value * n for value, n in sketch.iter_values()))
+    cut = int(count * trim)
+    # Sum the values of the ranks from cut to count - cut.
+    trimmed = 0.0
+    rank = 0
+    for value, n in sketch.iter_values():
+        kept = min(rank + n, count - cut) - max(rank, cut)
+        if kept > 0:
+            trimmed += value * kept
+        rank += n
+    summary = {'count': count,
+               'sum': total,
+               'mean': total // count,
+               'trimmed_mean': int(trimmed // (count - 2 * cut))}
+    percentiles = dict((name, sketch.get_quantile(q))
+                       for name, q in price_stats.PERCENTILES)
+    for name, value in percentiles.iteritems():
+        summary[name] = int(round(value))
+    iqr = percentiles['p75'] - percentiles['p25']
+    low = percentiles['p25'] - price_stats.FENCE_FACTOR * iqr
+    high = percentiles['p75'] + price_stats.FENCE_FACTOR * iqr
+    summary['low_fence'] = int(low)
+    summary['high_fence'] = int(high)
+    summary['outliers'] = sum(n for value, n in sketch.iter_values()
+                              if not low <= value <= high)
+    return summary
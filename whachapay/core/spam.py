@@ -0,0 +1,90 @@
+"""
+Spam scoring of the deals entered by visitors, so that one IP address or
+email can't flood a dealer's prices.
+
+A deal is flagged when its IP address or its user's email has entered too
+many deals recently, or when it nearly repeats one of its user's deals. A
+flagged deal is stored as usual, so the visitor sees it entered, but it is
+left out of the deal lists, the deals export, and the price aggregates until
+approved in the admin, where a deal can also be flagged by hand.
+
+The checks take constant time per deal: the recent deals are counted in the
+settings.SPAM_CACHE_ALIAS cache, in a sliding window of SPAM_WINDOW seconds
+made of SPAM_WINDOW_SLOTS counters, and each deal is stored with a hash of
+its user, vehicle, dealer, rounded price, and date, which is indexed (see
+core.schema), so a near duplicate is found with one lookup. Imported and
+generated deals aren't scored.
+"""
+import hashlib, time
+from django.conf import settings
+from django.core.cache import get_cache
+from core.models import Deal
+
+_cache = None
+
+def get_backend():
+    """Returns the submission counter cache backend."""
+    global _cache
+    if _cache is None:
+        _cache = get_cache(settings.SPAM_CACHE_ALIAS)
+    return _cache
+
+def count_submission(kind, value, now=None):
+    """
+    Count a deal entered by an IP address or email, kind being 'ip' or
+    'user', at time now, by default the current time.
+
+    Returns int, the number of deals entered by it within the window,
+    including this one.
+    """
+    cache = get_backend()
+    slots = settings.SPAM_WINDOW_SLOTS
+    slot_seconds = max(settings.SPAM_WINDOW // slots, 1)
+    slot = int((now if now is not None else time.time()) // slot_seconds)
+    # Hashed, as emails can have characters that memcached keys can't.
+    prefix = 'spam:%s:%s:' % (kind, hashlib.sha1(value.encode('utf-8'))
+                              .hexdigest())
+    key = prefix + str(slot)
+    timeout = (slots + 1) * slot_seconds
+    if not cache.add(key, 1, timeout):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired since the add.
+            cache.set(key, 1, timeout)
+    counts = cache.get_many([prefix + str(s)
+                             for s in range(slot - slots + 1, slot + 1)])
+    return sum(counts.itervalues())
+
+def get_entry_hash(user_pk, vehicle_pk, dealer_pk, price_step, day):
+    """
+    Get the hash of a deal's user, vehicle, dealer, price step (its price
+    divided by settings.SPAM_DUPLICATE_PRICE_STEP), and date.
+
+    Returns string.
+    """
+    return hashlib.sha1('%d:%d:%d:%d:%s' % (user_pk, vehicle_pk, dealer_pk,
+                                            price_step, day.isoformat())
+                        ).hexdigest()
+
+def score_entry(ip, email, user_pk, vehicle_pk, dealer_pk, price, day):
+    """
+    Score a deal being entered, counting it for its IP address and email.
+    It is a near duplicate of a deal of the same user, vehicle, dealer, and
+    date whose price is in the same, or an adjacent, price step: so prices
+    less than a step apart always match, and prices two steps apart may.
+
+    Returns tuple of (the deal's entry hash, list of the reasons to flag it,
+    any of 'ip', 'user', and 'duplicate').
+    """
+    reasons = []
+    if count_submission('ip', ip) > settings.SPAM_IP_LIMIT:
+        reasons.append('ip')
+    if count_submission('user', email) > settings.SPAM_USER_LIMIT:
+        reasons.append('user')
+    step = price // settings.SPAM_DUPLICATE_PRICE_STEP
+    hashes = [get_entry_hash(user_pk, vehicle_pk, dealer_pk, s, day)
+              for s in (step, step - 1, step + 1)]
+    if Deal.objects.filter(entry_hash__in=hashes).exists():
+        reasons.append('duplicate')
+    return hashes[0], reasons
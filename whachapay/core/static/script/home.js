@@ -1,71 +1,62 @@
 $(function() {
 
     /**
-     * Refresh the select lists when one is selected.
+     * Refresh the select lists when one is selected. The options are fetched
+     * from a URL keyed by the catalog version (set via script tag in the page
+     * template), so repeat selections are served from the browser cache.
      */
     $('select').change(function() {
         var name = $(this).attr('name');
-        var params = getAllSelects();
-        params['selected'] = name;
+        var makeYear = $('#id_make_year').val();
+        var make = (name == 'make') ? $('#id_make').val() : 0;
+        var value = $(this).val();
 
-        $.get('/home/update_selections/', params,
+        if (name == 'model') {
+            return;
+        }
+        if (value == 0) {
+            // Nothing to fetch; just reset the dependent selects.
+            if (name == 'make_year') {
+                setOptions($('#id_make'), 'Make', [], true);
+            }
+            setOptions($('#id_model'), 'Model', [], true);
+            return;
+        }
+
+        $.get('/home/options/' + catalogVersion + '/' + makeYear + '/' +
+              make + '/',
               function(data) {
                   if (data) {
-                      var value = $('#id_' + name).val();
                       switch (name) {
                       case 'make_year':
-                          if (value == 0) {
-                              $('#id_make').attr('disabled', true);
-                          } else {
-                              $('#id_make').attr('disabled', false);
-                          }
-                          $('#id_model').attr('disabled', true);
-                          $('#id_make').html(data.make);
-                          $('#id_model').html(data.model);
+                          setOptions($('#id_make'), 'Make', data.makes, false);
+                          setOptions($('#id_model'), 'Model', [], true);
                           break;
                       case 'make':
-                          if (value == 0) {
-                              $('#id_model').attr('disabled', true);
-                          } else {
-                              $('#id_model').attr('disabled', false);
-                          }
-                          $('#id_model').html(data.model);
+                          setOptions($('#id_model'), 'Model', data.models,
+                                     false);
                           break;
                       }
                   }
               },
               'json');
     });
-    
-    /**
-     * Get a representation of the state of all select elements.
-     * @returns {Object} Keyed according to element name.
-     */
-    var getAllSelects = function() {
-        var selects = {};
-        
-        $('select').each(function() {
-            $.extend(selects, getSelect($(this)));
-        });
-
-        return selects;
-    }
 
     /**
-     * Get a representation of a select name and value.
+     * Replace the options of a select element.
      * @param {jQuery object} select The select element object.
-     * @returns {Object} Keyed according to element name.
+     * @param {String} placeholder The text of the zero-valued first option.
+     * @param {Array} options The [pk, name] pairs to add.
+     * @param {Boolean} disabled Whether to disable the select.
      */
-    var getSelect = function(select) {
-        var name = select.attr('name');
-        var text = select.find(':selected').text();
-        // Send the text only when the year has been selected,
-        // otherwise send the value.
-        var value = (name == 'make_year') ? text : select.val();
-        var repr = {};
-        repr[name] = value;
-        
-        return repr;
+    var setOptions = function(select, placeholder, options, disabled) {
+        select.empty();
+        select.append($('<option>').val(0).text(placeholder));
+        var l = options.length;
+        for (var i = 0; i < l; i++) {
+            select.append($('<option>').val(options[i][0]).text(options[i][1]));
+        }
+        select.attr('disabled', disabled);
     }
 
     /**
@@ -1,8 +1,12 @@
 /**
- * Create a map for a place. Uses the place's location, id, and name.
+ * Create a map for a place. Uses the place's location, id, and name. Places
+ * with a map_url are shown as a static image by the page instead.
  * @param {Object} place The place representation object.
  */
 var createMap = function(place) {
+    if (place['map_url']) {
+        return;
+    }
     var latLng = stringToLatLng(place['location']);
     var options = {
         zoom: 14,
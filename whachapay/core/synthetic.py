@@ -0,0 +1,364 @@
+"""
+Synthetic data for benchmarks and scale testing: a catalog of makes, models,
+and trims over a range of years, dealers clustered around metro areas, users
+with their IPs, and deals with plausible prices. The data is generated from a
+seeded random number generator, so the same arguments always give the same
+data. See the generate_data command.
+
+Prices are built from a base price per model, drawn from a log-normal
+distribution, with a premium per trim level, a yearly increase, a markup per
+dealer, and some noise; a few are mistyped by a factor of ten, as real ones
+are, to exercise the outlier fences of core.price_stats. Models and dealers
+are drawn with skewed popularity, so that some have many deals and most have
+few.
+
+The catalog and dealers are written with bulk_create. Users, IPs, and deals
+are written as raw rows, with COPY on PostgreSQL and multi-row executemany
+elsewhere, so that ten million deals load in minutes. Neither sends the model
+signals, so finish() bumps the catalog, dealer, and page versions and
+rebuilds the deal stats once at the end.
+"""
+import hashlib, math, random
+from bisect import bisect
+from cStringIO import StringIO
+from datetime import date, timedelta
+from django.db import connection, transaction
+from core import catalog, geo, queries, util
+from core.models import (Deal, Dealer, IPAddress, Make, MakeYear, Model,
+                         ModelYear, Trim, TrimYear, User, UserIP, Vehicle)
+
+# Metro areas the dealers cluster around: (name, latitude, longitude,
+# relative number of dealers). Downtown Honolulu, where the sample dealers
+# are, comes first.
+METROS = ((u'Honolulu', 21.3069, -157.8583, 1),
+          (u'Los Angeles', 34.0522, -118.2437, 6),
+          (u'San Francisco', 37.7749, -122.4194, 3),
+          (u'Seattle', 47.6062, -122.3321, 2),
+          (u'Phoenix', 33.4484, -112.0740, 2),
+          (u'Denver', 39.7392, -104.9903, 2),
+          (u'Dallas', 32.7767, -96.7970, 4),
+          (u'Houston', 29.7604, -95.3698, 4),
+          (u'Chicago', 41.8781, -87.6298, 5),
+          (u'Atlanta', 33.7490, -84.3880, 3),
+          (u'Miami', 25.7617, -80.1918, 3),
+          (u'New York', 40.7128, -74.0060, 8),
+          (u'Boston', 42.3601, -71.0589, 2))
+
+MAKES = (u'Acura', u'Audi', u'BMW', u'Buick', u'Cadillac', u'Chevrolet',
+         u'Chrysler', u'Dodge', u'Fiat', u'Ford', u'GMC', u'Honda',
+         u'Hyundai', u'Infiniti', u'Jaguar', u'Jeep', u'Kia', u'Land Rover',
+         u'Lexus', u'Lincoln', u'Mazda', u'Mercedes-Benz', u'Mini',
+         u'Mitsubishi', u'Nissan', u'Porsche', u'Ram', u'Scion', u'Subaru',
+         u'Suzuki', u'Toyota', u'Volkswagen', u'Volvo')
+
+# Model and street names are made of a prefix and a suffix.
+NAME_PREFIXES = (u'Al', u'Ca', u'Ex', u'Mon', u'Sor', u'Ve', u'Ac', u'Ro',
+                 u'Tu', u'Pri', u'Ci', u'Ma', u'Es', u'Nav', u'Sie', u'Tau')
+NAME_SUFFIXES = (u'tima', u'mry', u'plorer', u'terey', u'ento', u'rsa',
+                 u'cord', u'gue', u'cson', u'us', u'vic', u'lander', u'rra',
+                 u'ris', u'cape', u'ano')
+
+# Trim names, from the base trim up.
+TRIMS = (u'Base', u'S', u'SE', u'LE', u'Sport', u'XLE', u'Touring',
+         u'Limited', u'Platinum', u'GT', u'Hybrid', u'Signature')
+
+COMMENTS = (u'', u'', u'', u'Friendly salespeople, very pleased.',
+            u'Would have liked to get the price down a little lower.',
+            u'Test drive sold me.', u'Took three visits to get this price.',
+            u'Paid extra for the paint protection, regret it.')
+
+# Fraction of deals whose price is mistyped by a factor of ten.
+TYPO_RATE = 0.001
+
+class SyntheticData(object):
+    """
+    Generates and stores the data. Keeps what it has stored so far: the
+    vehicles as (vehicle pk, year, make pk, model pk, [trim pks]) with their
+    names, base prices, and popularity, the trim names, the dealers as places
+    results and pks with their markups and popularity, and the user IP pks.
+    """
+    def __init__(self, seed=0, metros=METROS, spread=15000, chunk_size=10000):
+        self.rng = random.Random(seed)
+        self.metros = metros
+        self.metro_weights = get_cumulative([m[3] for m in metros])
+        self.spread = spread
+        self.chunk_size = chunk_size
+        self.vehicles = []
+        # (make name, model name) per vehicle.
+        self.vehicle_names = []
+        self.trim_names = {}
+        self.vehicle_prices = []
+        self.vehicle_popularity = []
+        self.places = []
+        self.dealer_pks = []
+        self.dealer_markups = []
+        self.dealer_popularity = []
+        self.user_ips = []
+
+    def seed(self, makes=5, models=4, trims=3, years=(2012, 2013), dealers=100,
+             deals=10000, users=None):
+        """
+        Store a catalog of makes x models with up to trims trims, the
+        dealers, and the deals, from users users (by default one per ten
+        deals).
+
+        Nothing returned.
+        """
+        self.seed_catalog(makes, models, trims, years)
+        self.seed_dealers(dealers)
+        self.seed_users(users or max(1, deals // 10))
+        self.seed_deals(deals)
+        self.finish()
+
+    def seed_catalog(self, makes, models, trims, years):
+        """
+        Store the catalog, and a vehicle for each model and year. Each model
+        has between one and trims trims, and is made from one of the years
+        on.
+        """
+        rng = self.rng
+        years = sorted(years)
+        first = Make.objects.count()
+        util.bulk_create(Make, [Make(name=get_make_name(first + i))
+                                for i in range(makes)])
+        make_pks = get_last_pks(Make, makes)
+        # (make pk, name, base price, popularity, first year, trim count)
+        specs = []
+        for make in make_pks:
+            names = set()
+            while len(names) < models:
+                name = get_name(rng)
+                if name in names:
+                    name = u'%s %d' % (name, len(names) + 1)
+                names.add(name)
+            for name in sorted(names):
+                price = math.exp(rng.gauss(math.log(28000), 0.45))
+                specs.append((make, name, min(max(price, 9000), 250000),
+                              rng.paretovariate(1.2),
+                              rng.choice(years[:-1] or years),
+                              rng.randint(1, trims)))
+        util.bulk_create(Model, [Model(make_id=s[0], name=s[1])
+                                 for s in specs])
+        model_pks = get_last_pks(Model, len(specs))
+        util.bulk_create(Trim, [Trim(model_id=pk, name=TRIMS[i % len(TRIMS)])
+                                for pk, s in zip(model_pks, specs)
+                                for i in range(s[5])])
+        model_trims = {}
+        for pk, model, name in Trim.objects.order_by('-pk').values_list(
+                'pk', 'model', 'name')[:sum(s[5] for s in specs)]:
+            model_trims.setdefault(model, []).append(pk)
+            self.trim_names[pk] = name
+        model_years = [(pk, [y for y in years if y >= s[4]])
+                       for pk, s in zip(model_pks, specs)]
+        util.bulk_create(MakeYear, [MakeYear(make_id=m, year=y)
+                                    for m in make_pks for y in years])
+        util.bulk_create(ModelYear, [ModelYear(model_id=pk, year=y)
+                                     for pk, ys in model_years for y in ys])
+        util.bulk_create(TrimYear, [TrimYear(trim_id=t, year=y)
+                                    for pk, ys in model_years
+                                    for t in model_trims[pk] for y in ys])
+        make_years = dict(((m, y), pk) for pk, m, y in
+                          MakeYear.objects.filter(make__in=make_pks)
+                          .values_list('pk', 'make', 'year'))
+        vehicles = [(pk, s[0], y, s)
+                    for (pk, ys), s in zip(model_years, specs) for y in ys]
+        util.bulk_create(Vehicle, [Vehicle(make_year_id=make_years[(m, y)],
+                                           make_id=m, model_id=pk)
+                                   for pk, m, y, s in vehicles])
+        vehicle_pks = get_last_pks(Vehicle, len(vehicles))
+        make_names = dict(Make.objects.filter(pk__in=make_pks).values_list(
+            'pk', 'name'))
+        for vehicle_pk, (pk, make, year, s) in zip(vehicle_pks, vehicles):
+            self.vehicles.append((vehicle_pk, year, make, pk,
+                                  sorted(model_trims[pk])))
+            self.vehicle_names.append((make_names[make], s[1]))
+            # Prices rise 2% a year; recent years sell more.
+            self.vehicle_prices.append(s[2] * 0.98 ** (years[-1] - year))
+            self.vehicle_popularity.append(s[3] / (1 + years[-1] - year))
+
+    def seed_dealers(self, count):
+        """Store dealers, clustered around the metros."""
+        rng = self.rng
+        first = Dealer.objects.count()
+        dealers = []
+        for i in range(first, first + count):
+            metro = self.get_metro()
+            lat, lng = self.get_location(metro)
+            location = '%.6f,%.6f' % (lat, lng)
+            place = {'id': hashlib.sha1('dealer %d' % i).hexdigest(),
+                     'name': u'%s of %s' % (rng.choice(MAKES), metro[0]),
+                     'location': location,
+                     'vicinity': u'%d %s Boulevard, %s'
+                     % (rng.randint(1, 9999), get_name(rng), metro[0])}
+            self.places.append(place)
+            self.dealer_markups.append(rng.gauss(1, 0.025))
+            self.dealer_popularity.append(rng.paretovariate(1.5))
+            dealers.append(Dealer(place_id=place['id'], name=place['name'],
+                                  location=location,
+                                  address=place['vicinity'],
+                                  latitude=lat, longitude=lng))
+        util.bulk_create(Dealer, dealers)
+        self.dealer_pks.extend(get_last_pks(Dealer, count))
+
+    def get_metro(self):
+        """Returns a random metro, weighted by number of dealers."""
+        return self.metros[bisect(self.metro_weights,
+                                  self.rng.random() * self.metro_weights[-1])]
+
+    def get_location(self, metro=None):
+        """
+        Returns a random (lat, lng) around a metro, by default a random one,
+        normally distributed with a standard deviation of spread meters, up
+        to three.
+        """
+        name, lat, lng, weight = metro or self.get_metro()
+        north = max(-3, min(3, self.rng.gauss(0, 1))) * self.spread
+        east = max(-3, min(3, self.rng.gauss(0, 1))) * self.spread
+        return (lat + north / 111320.0,
+                lng + east / (111320.0 * math.cos(math.radians(lat))))
+
+    def seed_users(self, count):
+        """Store users, with an IP each."""
+        first = User.objects.count()
+        first_ip = IPAddress.objects.count()
+        insert_rows(User, ('email',),
+                    ((u'user%d@customer.com' % (first + i),)
+                     for i in xrange(count)), self.chunk_size)
+        insert_rows(IPAddress, ('ip',),
+                    ((get_ip(first_ip + i),) for i in xrange(count)),
+                    self.chunk_size)
+        insert_rows(UserIP, ('user', 'ip'),
+                    zip(get_last_pks(User, count),
+                        get_last_pks(IPAddress, count)), self.chunk_size)
+        self.user_ips.extend(get_last_pks(UserIP, count))
+
+    def seed_deals(self, count):
+        """Store deals from the users at the dealers."""
+        insert_rows(Deal, ('user_ip', 'vehicle', 'trim', 'dealer', 'price',
+                           'date', 'comment', 'year', 'make_name',
+                           'model_name', 'trim_name', 'dealer_name',
+                           'entry_hash', 'flagged', 'spam_reasons'),
+                    self.iter_deals(count), self.chunk_size)
+
+    def iter_deals(self, count):
+        """
+        Generate deals, as (user IP pk, vehicle pk, trim pk, dealer pk,
+        price, date, comment, year, make name, model name, trim name, dealer
+        name, entry hash, flagged, spam reasons) tuples. Generated deals
+        aren't scored as spam.
+        """
+        rng = self.rng
+        today = date.today()
+        vehicle_weights = get_cumulative(self.vehicle_popularity)
+        dealer_weights = get_cumulative(self.dealer_popularity)
+        for i in xrange(count):
+            v = bisect(vehicle_weights, rng.random() * vehicle_weights[-1])
+            pk, year, make, model, trims = self.vehicles[v]
+            level = rng.randrange(len(trims))
+            d = bisect(dealer_weights, rng.random() * dealer_weights[-1])
+            price = (self.vehicle_prices[v] * (1 + 0.12 * level)
+                     * self.dealer_markups[d] * rng.gauss(1, 0.03))
+            if rng.random() < TYPO_RATE:
+                price = price * 10 if rng.random() < 0.5 else price / 10
+            # A model year is sold from the summer before it to its end.
+            sold = date(year - 1, 7, 1) + timedelta(days=rng.randrange(549))
+            make_name, model_name = self.vehicle_names[v]
+            yield (rng.choice(self.user_ips), pk, trims[level],
+                   self.dealer_pks[d], max(100, int(round(price, -1))),
+                   min(sold, today), rng.choice(COMMENTS), year, make_name,
+                   model_name, self.trim_names[trims[level]],
+                   self.places[d]['name'], '', False, '')
+
+    def finish(self):
+        """Bump the versions of the data, and rebuild the deal stats."""
+        catalog.bump_version()
+        geo.bump_version()
+        queries.rebuild_deal_stats()
+
+    def get_places_response(self, count=20):
+        """
+        Get a Places search response listing the first dealers, for the stub
+        server.
+
+        Returns dictionary.
+        """
+        results = []
+        for place in self.places[:count]:
+            lat, lng = place['location'].split(',')
+            results.append({'geometry': {'location': {'lat': float(lat),
+                                                      'lng': float(lng)}},
+                            'id': place['id'],
+                            'name': place['name'],
+                            'types': ['car_dealer', 'establishment'],
+                            'vicinity': place['vicinity']})
+        return {'html_attributions': [], 'results': results, 'status': 'OK'}
+
+def get_make_name(number):
+    """Returns unicode, the numberth make name."""
+    name = MAKES[number % len(MAKES)]
+    if number >= len(MAKES):
+        name = u'%s %d' % (name, number // len(MAKES) + 1)
+    return name
+
+def get_name(rng):
+    """Returns unicode, a random model or street name."""
+    return rng.choice(NAME_PREFIXES) + rng.choice(NAME_SUFFIXES)
+
+def get_ip(number):
+    """Returns string, the numberth address of 10.0.0.0/8."""
+    return '10.%d.%d.%d' % (number >> 16 & 255, number >> 8 & 255, number & 255)
+
+def get_cumulative(weights):
+    """Returns list of the running totals of weights, for bisect."""
+    totals = []
+    total = 0
+    for weight in weights:
+        total += weight
+        totals.append(total)
+    return totals
+
+def get_last_pks(model, count):
+    """Returns list of the pks of the last count rows stored, ascending."""
+    return sorted(model.objects.order_by('-pk').values_list(
+        'pk', flat=True)[:count])
+
+def insert_rows(model, fields, rows, chunk_size):
+    """
+    Insert rows of values for the given fields of a model, chunk_size rows
+    at a time: with COPY on PostgreSQL, and executemany elsewhere.
+    """
+    opts = model._meta
+    columns = [opts.get_field(f).column for f in fields]
+    qn = connection.ops.quote_name
+    sql = ('INSERT INTO %s (%s) VALUES (%s)'
+           % (qn(opts.db_table), ', '.join(qn(c) for c in columns),
+              ', '.join(['%s'] * len(columns))))
+    cursor = connection.cursor()
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            write_chunk(cursor, opts.db_table, columns, sql, chunk)
+            chunk = []
+    if chunk:
+        write_chunk(cursor, opts.db_table, columns, sql, chunk)
+    transaction.set_dirty()
+
+def write_chunk(cursor, table, columns, sql, rows):
+    if connection.vendor == 'postgresql':
+        data = StringIO()
+        for row in rows:
+            data.write('\t'.join(copy_value(v) for v in row) + '\n')
+        data.seek(0)
+        cursor.copy_from(data, table, columns=columns)
+    else:
+        cursor.executemany(sql, rows)
+
+def copy_value(value):
+    """Returns string, a value in the COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
@@ -0,0 +1,85 @@
+"""
+Deferred work, kept out of the requests that make it necessary.
+
+defer() queues a task as a row of the core_task table, in the caller's
+transaction, so a task is queued if and only if the data it works on is
+committed. The process_tasks command runs the queued tasks in batches, oldest
+first: the tasks of a batch with the same name are passed to their handler
+together, so that, for example, a hundred deals for one dealer update its
+stats once. A batch is claimed with SELECT ... FOR UPDATE, so several workers
+can run, though one is enough.
+
+A handler that raises has its work rolled back to a savepoint, and its tasks
+are kept with their attempt count and error, to be retried up to
+TASK_MAX_ATTEMPTS times. A handler may return a function to call once its
+work is committed, for side effects outside the database such as cache
+invalidation. With TASKS_EAGER, run_eager() runs the queue in the request
+instead, for development without a worker.
+"""
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.importlib import import_module
+from core.models import Task
+
+logger = logging.getLogger(__name__)
+
+# Task name: dotted path of the handler, a function taking the list of the
+# tasks' args.
+HANDLERS = {
+    'deal_stored': 'core.queries.process_stored_deals',
+}
+
+def defer(name, arg):
+    """Queue a task, in the current transaction."""
+    if name not in HANDLERS:
+        raise ValueError('Unknown task %r.' % name)
+    Task.objects.create(name=name, arg=arg)
+
+def get_handler(name):
+    """Returns the handler function of a task name."""
+    module, function = HANDLERS[name].rsplit('.', 1)
+    return getattr(import_module(module), function)
+
+def process(batch_size=None):
+    """
+    Run a batch of the queued tasks, of at most batch_size, by default
+    settings.TASK_BATCH_SIZE.
+
+    Returns int, the number of tasks run successfully.
+    """
+    done = 0
+    callbacks = []
+    with transaction.commit_on_success():
+        tasks = list(Task.objects.select_for_update()
+                     .filter(attempts__lt=settings.TASK_MAX_ATTEMPTS)
+                     .order_by('pk')[:batch_size or settings.TASK_BATCH_SIZE])
+        groups = {}
+        for task in tasks:
+            groups.setdefault(task.name, []).append(task)
+        for name, group in sorted(groups.iteritems()):
+            pks = [t.pk for t in group]
+            sid = transaction.savepoint()
+            try:
+                callback = get_handler(name)([t.arg for t in group])
+            except Exception, e:
+                transaction.savepoint_rollback(sid)
+                logger.exception('%d %s tasks failed.', len(group), name)
+                Task.objects.filter(pk__in=pks).update(
+                    attempts=F('attempts') + 1, error=unicode(e))
+                continue
+            transaction.savepoint_commit(sid)
+            Task.objects.filter(pk__in=pks).delete()
+            done += len(group)
+            if callback:
+                callbacks.append(callback)
+    for callback in callbacks:
+        callback()
+    return done
+
+def run_eager():
+    """With settings.TASKS_EAGER, run the queued tasks now."""
+    if settings.TASKS_EAGER:
+        while process():
+            pass
@@ -5,7 +5,27 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json, os, random, tempfile, threading, time
+from StringIO import StringIO
+from datetime import date
+from django.conf import settings
+from django.contrib.auth.models import User as AuthUser
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.http import Http404, HttpResponse
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import unittest
+from core import (catalog, enrich, export, geo, ingest, instrument,
+                  page_cache, pagination, places, pool, price_stats, queries,
+                  replicas, schema, sketches, spam, synthetic, tasks, util,
+                  views)
+from core.forms import HomeForm
+from core.places_stub import PlacesStubServer
+from core.models import (Deal, Dealer, DealMonthStats, DealStats, Make,
+                         MakeYear, Task, Trim, User, UserIP, Vehicle)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +34,1404 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def enter_deal(place_id, trim, price, email='joe@customer.com'):
+    """Enter a 2012 BMW 3 Series deal at a sample dealer, as a visitor."""
+    dealer = Dealer.objects.get(place_id=place_id)
+    return queries.enter_deal(
+        {'REMOTE_ADDR': '127.0.0.1'}, {'year': 2012, 'make': 1, 'model': 1},
+        {'id': place_id, 'location': dealer.location, 'name': dealer.name,
+         'vicinity': dealer.address},
+        {'email': email, 'trim': trim, 'price': price,
+         'date': date(2013, 4, 1), 'comment': ''})
+
+
+class DealerStatsTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    place_ids = ['faba111bb43d6ac1f42e308b4dff2475d2b8562b',
+                 'ad76924a25faa79a7a60ffe4aef03cd8e87a073e',
+                 'unknown']
+
+    def setUp(self):
+        queries.rebuild_deal_stats()
+        spam.get_backend().clear()
+
+    def test_stats_in_place_order(self):
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        with self.assertNumQueries(1):
+            stats = queries.get_dealer_stats(self.place_ids, vehicle, None)
+        self.assertEqual([s['place_id'] for s in stats], self.place_ids[:2])
+        self.assertEqual([(s['count'], s['sum'], s['avg']) for s in stats],
+                         [(3, 71000, 23666), (5, 175000, 35000)])
+
+    def test_stats_by_trim(self):
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        stats = queries.get_dealer_stats(self.place_ids, vehicle, 2)
+        self.assertEqual([(s['count'], s['avg']) for s in stats],
+                         [(1, 24000), (3, 37666)])
+
+    def test_no_vehicle(self):
+        self.assertEqual(queries.get_dealer_stats(self.place_ids, None, None),
+                         [])
+
+    def test_add_price_stats(self):
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        stats = queries.get_dealer_stats(self.place_ids, vehicle, None)
+        with self.assertNumQueries(1):
+            summaries, area = queries.get_price_stats(self.place_ids, vehicle,
+                                                      None)
+        queries.add_price_stats(stats, summaries)
+        self.assertEqual([(s['median'], s['outliers']) for s in stats],
+                         [(24000, 0), (35000, 0)])
+        self.assertEqual((area['count'], area['median']), (8, 31000))
+        self.assertEqual(queries.get_price_stats([], vehicle, None),
+                         ({}, None))
+
+    @override_settings(TASKS_EAGER=True)
+    def test_entered_deals_update_stats(self):
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        dealer = queries.get_dealer(self.place_ids[0])
+        for price in (21000, 26000):
+            enter_deal(self.place_ids[0], 1, price)
+        stats = DealStats.objects.get(vehicle=vehicle, trim=1, dealer=dealer)
+        self.assertEqual((stats.count, stats.sum, stats.min_price,
+                          stats.max_price, stats.sum_squares),
+                         (4, 94000, 21000, 26000, 2226000000))
+        # The incremental updates agree with a rebuild from the deals.
+        queries.rebuild_deal_stats()
+        rebuilt = DealStats.objects.get(vehicle=vehicle, trim=1, dealer=dealer)
+        self.assertEqual((rebuilt.count, rebuilt.sum, rebuilt.min_price,
+                          rebuilt.max_price, rebuilt.sum_squares),
+                         (stats.count, stats.sum, stats.min_price,
+                          stats.max_price, stats.sum_squares))
+
+
+class PriceTrendTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    place_ids = DealerStatsTest.place_ids[:2]
+
+    def setUp(self):
+        queries.rebuild_deal_stats()
+        spam.get_backend().clear()
+        self.vehicle = queries.get_vehicle(2012, 1, 1)
+
+    def test_trend(self):
+        with self.assertNumQueries(1):
+            trend = queries.get_price_trend(self.place_ids, self.vehicle, None,
+                                            3, today=date(2013, 4, 15))
+        self.assertEqual([m['month'] for m in trend],
+                         ['2013-02', '2013-03', '2013-04'])
+        self.assertEqual(trend[0], {'month': '2013-02', 'count': 0,
+                                    'mean': None, 'median': None,
+                                    'min': None, 'max': None})
+        # All of the sample deals are from March.
+        self.assertEqual((trend[1]['count'], trend[1]['mean']), (8, 30750))
+        trend = queries.get_price_trend(self.place_ids[:1], self.vehicle, 2,
+                                        2, today=date(2013, 3, 1))
+        self.assertEqual([(m['count'], m['mean']) for m in trend],
+                         [(0, None), (1, 24000)])
+
+    @override_settings(TASKS_EAGER=True)
+    def test_entered_deals_update_months(self):
+        for price in (21000, 26000):
+            enter_deal(self.place_ids[0], 1, price)
+        trend = queries.get_price_trend(self.place_ids, self.vehicle, None, 2,
+                                        today=date(2013, 4, 30))
+        self.assertEqual([(m['count'], m['min'], m['max']) for m in trend],
+                         [(8, 22000, 40000), (2, 21000, 26000)])
+        # The incremental updates agree with a rebuild from the deals.
+        fields = ('vehicle', 'trim', 'dealer', 'month', 'count', 'sum',
+                  'min_price', 'max_price', 'sum_squares', 'sketch')
+        rows = sorted(DealMonthStats.objects.values_list(*fields))
+        queries.rebuild_deal_stats()
+        self.assertEqual(sorted(DealMonthStats.objects.values_list(*fields)),
+                         rows)
+
+    def test_add_months(self):
+        self.assertEqual(util.add_months(date(2013, 1, 1), -1),
+                         date(2012, 12, 1))
+        self.assertEqual(util.add_months(date(2012, 12, 1), 13),
+                         date(2014, 1, 1))
+
+
+class PriceSketchTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    def build_dealers(self, dealers=20, deals=5000):
+        """
+        Generate prices for each dealer around its own base price, with a few
+        mistyped ones.
+
+        Returns list of lists of prices.
+        """
+        rng = random.Random(0)
+        groups = []
+        for dealer in range(dealers):
+            base = rng.randint(15000, 60000)
+            group = [int(rng.gauss(base, base * 0.05)) for i in range(deals)]
+            group[0] *= 10
+            groups.append(group)
+        return groups
+
+    def test_accuracy(self):
+        groups = self.build_dealers()
+        merged = sketches.merge(
+            sketches.PriceSketch.decode(
+                sketches.PriceSketch.from_prices(group).encode())
+            for group in groups)
+        prices = price_stats.to_array(p for group in groups for p in group)
+        exact = price_stats.summarize(prices)
+        estimate = sketches.summarize(merged, exact['sum'])
+        self.assertEqual(estimate['count'], exact['count'])
+        self.assertEqual(estimate['mean'], exact['mean'])
+        for name, q in price_stats.PERCENTILES + (('min', 0), ('max', 1)):
+            value = price_stats.get_percentile(prices, 0, len(prices), q)
+            self.assertTrue(abs(merged.get_quantile(q) - value)
+                            <= value * sketches.ACCURACY, name)
+        self.assertTrue(abs(estimate['trimmed_mean'] - exact['trimmed_mean'])
+                        <= exact['trimmed_mean'] * sketches.ACCURACY)
+        self.assertTrue(abs(estimate['outliers'] - exact['outliers'])
+                        <= exact['count'] * 0.001)
+
+    def test_merge_and_encode(self):
+        groups = self.build_dealers(dealers=3, deals=1000)
+        whole = sketches.PriceSketch.from_prices(
+            p for group in groups for p in group)
+        parts = [sketches.PriceSketch.from_prices(group) for group in groups]
+        self.assertEqual(sketches.merge(parts).encode(), whole.encode())
+        self.assertEqual(
+            sketches.PriceSketch.decode(whole.encode()).buckets, whole.buckets)
+        # A few hundred buckets, however many prices.
+        self.assertTrue(len(whole.buckets) < 400)
+        self.assertTrue(len(parts[0].encode()) < 2000)
+        self.assertEqual(sketches.PriceSketch.decode('').get_quantile(0.5),
+                         None)
+
+    def test_speed(self):
+        groups = self.build_dealers()
+        encoded = [sketches.PriceSketch.from_prices(group).encode()
+                   for group in groups]
+        start = time.time()
+        prices = price_stats.to_array(p for group in groups for p in group)
+        price_stats.summarize(prices)
+        exact_seconds = time.time() - start
+        start = time.time()
+        sketches.summarize(sketches.merge(sketches.PriceSketch.decode(e)
+                                          for e in encoded))
+        sketch_seconds = time.time() - start
+        self.assertTrue(sketch_seconds * 5 < exact_seconds,
+                        (sketch_seconds, exact_seconds))
+
+    def test_area_stats_from_sketches(self):
+        queries.rebuild_deal_stats()
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        place_ids = DealerStatsTest.place_ids
+        exact_summaries, exact = queries.get_price_stats(place_ids, vehicle,
+                                                         None)
+        with override_settings(PRICE_EXACT_LIMIT=5):
+            with self.assertNumQueries(2):
+                summaries, area = queries.get_price_stats(place_ids, vehicle,
+                                                          None)
+        self.assertEqual(sorted(summaries), sorted(exact_summaries))
+        self.assertEqual((area['count'], area['sum']),
+                         (exact['count'], exact['sum']))
+        for name in ('median', 'p25', 'p75', 'trimmed_mean'):
+            self.assertTrue(abs(area[name] - exact[name])
+                            <= exact[name] * sketches.ACCURACY, name)
+        trend = queries.get_price_trend(place_ids, vehicle, None, 1,
+                                        today=date(2013, 3, 1))
+        self.assertTrue(abs(trend[0]['median'] - exact['median'])
+                        <= exact['median'] * sketches.ACCURACY)
+
+
+class PriceStatsTest(TestCase):
+
+    def test_summarize(self):
+        prices = price_stats.to_array([30000, 31000, 29000, 32000, 30500,
+                                       31500, 29500, 30000, 31000, 300000])
+        summary = price_stats.summarize(prices, trim=0.1)
+        self.assertEqual((summary['count'], summary['mean'],
+                          summary['trimmed_mean'], summary['median']),
+                         (10, 57450, 30687, 30750))
+        self.assertEqual((summary['p10'], summary['p25'], summary['p75'],
+                          summary['p90']), (29450, 30000, 31375, 58800))
+        self.assertEqual(summary['outliers'], 1)
+        self.assertTrue(price_stats.is_outlier(300000, summary))
+        self.assertFalse(price_stats.is_outlier(29000, summary))
+        self.assertEqual(price_stats.summarize(prices, 3, 3), None)
+
+    def test_groups(self):
+        prices = price_stats.to_array([1, 2, 3]) + price_stats.to_array([10])
+        summaries = price_stats.summarize_groups(prices, [3, 1], trim=0)
+        self.assertEqual([(s['count'], s['median'], s['p25'])
+                          for s in summaries], [(3, 2, 2), (1, 10, 10)])
+
+
+class KeysetPaginationTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    def setUp(self):
+        self.deals = queries.get_deals(queries.get_vehicle(2012, 1, 1),
+                                       queries.get_dealer(FlowTest.place_id),
+                                       None)
+
+    def get_page(self, **params):
+        request = RequestFactory().get('/', params)
+        return pagination.get_keyset_page(request, self.deals, 'price', 2)
+
+    def test_pages(self):
+        # Deals 4 and 8 share a price, to check the pk tie-breaker.
+        Deal.objects.filter(pk=8).update(price=32000)
+        with self.assertNumQueries(1):
+            first = self.get_page()
+            prices = [d.price for d in first]
+        self.assertEqual(prices, [30000, 32000])
+        self.assertEqual((first.has_previous, first.has_next), (False, True))
+        second = self.get_page(after=first.next_cursor)
+        self.assertEqual([d.pk for d in second], [8, 2])
+        third = self.get_page(after=second.next_cursor)
+        self.assertEqual([d.price for d in third], [40000])
+        self.assertFalse(third.has_next)
+        back = self.get_page(before=third.previous_cursor)
+        self.assertEqual([d.pk for d in back], [d.pk for d in second])
+        back = self.get_page(before=back.previous_cursor)
+        self.assertEqual([d.pk for d in back], [d.pk for d in first])
+        self.assertFalse(back.has_previous)
+
+    def test_invalid_cursor(self):
+        self.assertEqual([d.price for d in self.get_page(after='x.1')],
+                         [30000, 32000])
+
+
+class PlacesClientTest(TestCase):
+
+    def setUp(self):
+        self.server = PlacesStubServer(delay=0.2)
+        self.server.start()
+        self.client = places.PlacesClient(self.server.url, 'key')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_search_is_cached(self):
+        results = self.client.search('21.3069,-157.8583')['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['location'], '21.300311,-157.853781')
+        # Nearby locations round to the same cache entry.
+        self.client.search('21.3071,-157.8579')
+        self.assertEqual(self.server.hits, 1)
+        self.client.search('21.4,-157.8583')
+        self.assertEqual(self.server.hits, 2)
+
+    def test_concurrent_searches_are_coalesced(self):
+        found = []
+        def search():
+            found.append(self.client.search('21.3069,-157.8583'))
+        threads = [threading.Thread(target=search) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.server.hits, 1)
+        self.assertEqual(len([f for f in found if f['results']]), 5)
+
+    def test_pages_and_keywords(self):
+        server = PlacesStubServer(page_size=2)
+        server.start()
+        client = places.PlacesClient(server.url, 'key',
+                                     keywords=('car+dealer', 'used+cars'),
+                                     max_pages=3, page_token_delay=0)
+        try:
+            # The first page of each keyword, with the rest to come.
+            places_data = client.search('21.3069,-157.8583')
+            self.assertEqual((len(places_data['results']),
+                              places_data['partial']), (2, True))
+            first = [r['id'] for r in places_data['results']]
+            client.join_pages()
+            places_data = client.search('21.3069,-157.8583')
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+        # Two pages for each keyword, merged without repeats.
+        self.assertEqual(server.hits, 4)
+        self.assertFalse('partial' in places_data)
+        results = places_data['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(set(r['id'] for r in results)), 3)
+        # The results already listed keep their places.
+        self.assertEqual([r['id'] for r in results[:2]], first)
+
+    def test_later_pages_dont_delay_search(self):
+        self.server.page_size = 1
+        client = places.PlacesClient(self.server.url, 'key',
+                                     keywords=('car+dealer', 'used+cars'),
+                                     max_pages=3, page_token_delay=0.5,
+                                     deadline=0.3)
+        start = time.time()
+        results = client.search('21.3069,-157.8583')['results']
+        # The first pages arrive in parallel; the later ones come afterwards.
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEqual(len(results), 1)
+        client.join_pages()
+        self.assertEqual(
+            len(client.search('21.3069,-157.8583')['results']), 3)
+        client.close()
+
+    def test_deadline(self):
+        # On one thread, the second keyword waits for the first.
+        client = places.PlacesClient(self.server.url, 'key',
+                                     keywords=('car+dealer', 'used+cars'),
+                                     deadline=0.3, threads=1)
+        places_data = client.search('21.3069,-157.8583')
+        self.assertEqual((len(places_data['results']), places_data['partial']),
+                         (3, True))
+        # Cut short, so not cached.
+        self.assertEqual(len(client.cache), 0)
+        client.close()
+        # Let the stub finish the abandoned response before shutting down.
+        time.sleep(self.server.delay)
+
+    def test_timeout(self):
+        client = places.PlacesClient(self.server.url, 'key', read_timeout=0.05)
+        self.assertEqual(client.search('21.3069,-157.8583'), {})
+        self.assertEqual(len(client.cache), 0)
+        # Let the stub finish the abandoned response before shutting down.
+        time.sleep(self.server.delay)
+
+
+class CatalogIndexTest(TestCase):
+
+    def tearDown(self):
+        # Rolling back the test's edits doesn't send signals.
+        catalog.bump_version()
+
+    def test_options(self):
+        self.assertEqual(queries.get_make_options('2012'),
+                         ((1, u'BMW'), (3, u'Honda')))
+        self.assertEqual(queries.get_model_options('3', '2013'),
+                         ((3, u'Fit'),))
+        self.assertEqual(queries.get_trim_options(1, 2012),
+                         ((1, u'328i Sedan'), (2, u'335i Sedan')))
+        self.assertEqual(queries.get_make_options('Year'), ())
+        self.assertEqual(catalog.get_index().years, (2012, 2013))
+
+    def test_steady_state_has_no_queries(self):
+        catalog.get_index()
+        with self.assertNumQueries(0):
+            queries.get_make_options(2012)
+            queries.get_model_options(1, 2012)
+            queries.get_trim_options(1, 2012)
+            queries.get_make_name(1)
+
+    def test_edits_invalidate_index(self):
+        version = catalog.get_index().version
+        make = Make.objects.create(name='Acura')
+        MakeYear.objects.create(make=make, year=2012)
+        self.assertNotEqual(catalog.get_index().version, version)
+        self.assertEqual(queries.get_make_options(2012),
+                         ((make.pk, u'Acura'), (1, u'BMW'), (3, u'Honda')))
+
+    def test_home_form_follows_edits(self):
+        self.assertEqual(HomeForm().fields['make_year'].choices,
+                         [(0, 'Year'), (2012, 2012), (2013, 2013)])
+        MakeYear.objects.create(make=Make.objects.get(pk=1), year=2014)
+        self.assertEqual(HomeForm().fields['make_year'].choices[-1],
+                         (2014, 2014))
+
+    def test_snapshot(self):
+        path = self.save_snapshot()
+        with override_settings(CATALOG_SNAPSHOT=path):
+            with self.assertNumQueries(0):
+                index = catalog.get_index()
+                self.assertEqual(HomeForm().fields['make_year'].choices,
+                                 [(0, 'Year'), (2012, 2012), (2013, 2013)])
+                self.assertEqual(queries.get_make_options('2012'),
+                                 ((1, u'BMW'), (3, u'Honda')))
+                self.assertEqual(queries.get_trim_name(1), u'328i Sedan')
+            self.assertEqual(catalog.get_version(), index.version)
+            catalog.bump_version()
+            self.assertNotEqual(catalog.get_index().version, index.version)
+
+    def test_snapshot_survives_cache_loss(self):
+        path = self.save_snapshot()
+        snapshot_version = catalog.get_version()
+        # As in a new process with its own cache: the version is read from
+        # the database, and the snapshot is still current.
+        cache.clear()
+        with override_settings(CATALOG_SNAPSHOT=path):
+            with self.assertNumQueries(1):
+                index = catalog.get_index()
+        self.assertEqual(index.version, snapshot_version)
+
+    def test_stale_snapshot_is_ignored(self):
+        path = self.save_snapshot()
+        make = Make.objects.create(name='Acura')
+        MakeYear.objects.create(make=make, year=2012)
+        catalog._index = None
+        catalog._snapshot_loaded = False
+        with override_settings(CATALOG_SNAPSHOT=path):
+            self.assertEqual(queries.get_make_options(2012)[0],
+                             (make.pk, u'Acura'))
+
+    def save_snapshot(self):
+        """
+        Save a snapshot to a temporary file, and make the next get_index()
+        load it.
+
+        Returns string, the path.
+        """
+        fd, path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        catalog.save_snapshot(path)
+        catalog._index = None
+        catalog._snapshot_loaded = False
+        return path
+
+
+class DealerIndexTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    # Downtown Honolulu.
+    location = '21.3069,-157.8583'
+
+    def setUp(self):
+        queries.rebuild_deal_stats()
+
+    def tearDown(self):
+        geo.bump_version()
+
+    def test_nearby(self):
+        index = geo.get_index()
+        self.assertEqual(len(index), 2)
+        nearby = index.get_nearby(21.3069, -157.8583, 5000)
+        self.assertEqual([p for d, p in nearby],
+                         [FlowTest.place_id, DealerStatsTest.place_ids[0]])
+        self.assertTrue(nearby[0][0] < 1000 < nearby[1][0] < 5000)
+        self.assertEqual(len(index.get_nearby(21.3069, -157.8583, 1000)), 1)
+        self.assertEqual(index.get_nearby(20.8, -156.3, 50000), [])
+
+    def test_stats(self):
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        geo.get_index()
+        with self.assertNumQueries(1):
+            stats = queries.get_nearby_dealer_stats(self.location, vehicle,
+                                                    None, 5000)
+        self.assertEqual([(s['place_id'], s['count']) for s in stats],
+                         [(FlowTest.place_id, 5),
+                          (DealerStatsTest.place_ids[0], 3)])
+
+    def test_new_dealer_invalidates_index(self):
+        version = geo.get_index().version
+        dealer = Dealer.objects.create(place_id='new_place', name='New',
+                                       location='21.31,-157.86', address='')
+        self.assertEqual((dealer.latitude, dealer.longitude), (21.31, -157.86))
+        self.assertNotEqual(geo.get_index().version, version)
+        self.assertEqual(len(geo.get_index()), 3)
+
+
+class VehicleOptionsTest(TestCase):
+
+    def get_url(self, version, make_year, make):
+        return '/home/options/%s/%s/%s/' % (version, make_year, make)
+
+    def test_options(self):
+        version = catalog.get_index().version
+        response = self.client.get(self.get_url(version, 2012, 0))
+        self.assertEqual(json.loads(response.content),
+                         {'makes': [[1, 'BMW'], [3, 'Honda']], 'models': []})
+        self.assertTrue('max-age' in response['Cache-Control'])
+        response = self.client.get(self.get_url(version, 2013, 3))
+        self.assertEqual(json.loads(response.content)['models'],
+                         [[3, 'Fit']])
+
+    def test_conditional_get(self):
+        url = self.get_url(catalog.get_index().version, 2012, 1)
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+    def test_old_version_redirects(self):
+        version = catalog.get_index().version
+        response = self.client.get(self.get_url(version - 1, 2012, 1))
+        self.assertRedirects(response, self.get_url(version, 2012, 1))
+
+
+@instrument.enforce_query_budgets
+class FlowTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    place_id = 'ad76924a25faa79a7a60ffe4aef03cd8e87a073e'
+
+    def setUp(self):
+        queries.rebuild_deal_stats()
+        page_cache.get_backend().clear()
+        spam.get_backend().clear()
+        self.server = PlacesStubServer()
+        self.server.start()
+        self.places_client = places._client
+        places._client = places.PlacesClient(self.server.url, 'key')
+
+    def tearDown(self):
+        places._client.close()
+        places._client = self.places_client
+        self.server.shutdown()
+        self.server.server_close()
+
+    def search(self, button):
+        return self.client.get('/home/', {
+            'make_year': '2012', 'make': '1', 'model': '1',
+            'location': 'Honolulu, HI', 'place_name': 'Honolulu',
+            'lat_lng': '21.3069,-157.8583', button: '1'})
+
+    def test_enter_deal(self):
+        self.assertRedirects(self.search('enter'), '/home/dealer_select/')
+        response = self.client.get('/home/dealer_select/')
+        self.assertEqual(len(response.context['results'].object_list), 3)
+        response = self.client.post('/home/entry/%s/' % self.place_id, {
+            'trim': '1', 'price': '31000', 'date': '2013-04-01',
+            'comment': '', 'email': 'new@customer.com'})
+        self.assertRedirects(response, '/home/deal_entered/')
+        response = self.client.get('/home/deal_entered/')
+        self.assertEqual(response.context['deal'].price, 31000)
+
+    def test_failed_search_is_retried(self):
+        working = places._client
+        places._client = places.PlacesClient('http://127.0.0.1:1/place/'
+                                             'search/json', 'key')
+        try:
+            self.search('enter')
+            response = self.client.get('/home/dealer_select/')
+            self.assertEqual(len(response.context['results'].object_list), 0)
+        finally:
+            places._client.close()
+            places._client = working
+        response = self.client.get('/home/dealer_select/')
+        self.assertEqual(len(response.context['results'].object_list), 3)
+
+    def test_find_deals(self):
+        self.assertRedirects(self.search('find'), '/home/area_summary/')
+        response = self.client.get('/home/area_summary/', {'trim': '2'})
+        self.assertEqual(response.context['area_avg'], 34250)
+        self.assertEqual(len(response.context['dealers'].object_list), 2)
+        # The area summary uses the known dealers, not a Places search.
+        self.assertEqual(self.server.hits, 0)
+        # The trim carries over to the dealer's deals.
+        response = self.client.get('/home/dealer_deals/%s/' % self.place_id)
+        self.assertEqual(response.context['dealer_avg'], 37666)
+        deal = response.context['deals'].object_list[0]
+        response = self.client.get('/home/deal/%d/' % deal.pk)
+        self.assertEqual(response.context['dealer'].place_id, self.place_id)
+
+    def test_dealer_deals_pages_keep_trim(self):
+        deal = Deal.objects.filter(dealer__place_id=self.place_id,
+                                   trim=2)[0]
+        for i in range(20):
+            deal.pk = None
+            deal.price += 10
+            deal.save()
+        self.search('find')
+        response = self.client.get('/home/dealer_deals/%s/' % self.place_id,
+                                   {'trim': '2'})
+        self.assertContains(response, '?trim=2&after=')
+        response = self.client.get('/home/dealer_deals/%s/' % self.place_id,
+                                   {'trim': '2',
+                                    'after': response.context['deals']
+                                    .next_cursor})
+        self.assertContains(response, '?trim=2&before=')
+        self.assertTrue(all(d.trim_id == 2 for d in response.context['deals']))
+
+    @override_settings(TASKS_EAGER=True)
+    def test_pages_are_cached(self):
+        self.search('find')
+        self.client.get('/home/area_summary/', {'trim': '2'})
+        dealer_url = '/home/dealer_deals/%s/' % self.place_id
+        other_url = ('/home/dealer_deals/%s/'
+                     % DealerStatsTest.place_ids[0])
+        self.client.get(dealer_url)
+        self.client.get(other_url)
+        # Only the session is read.
+        with self.assertNumQueries(1):
+            response = self.client.get('/home/area_summary/', {'trim': '2'})
+        self.assertTrue('$34,250' in response.content)
+        with self.assertNumQueries(1):
+            self.client.get(other_url)
+
+        # A new deal invalidates the area and its dealer's pages only.
+        enter_deal(self.place_id, 2, 45000)
+        response = self.client.get('/home/area_summary/', {'trim': '2'})
+        self.assertEqual(response.context['area_avg'], 36400)
+        response = self.client.get(dealer_url)
+        self.assertEqual(response.context['dealer_avg'], 39500)
+        with self.assertNumQueries(1):
+            self.client.get(other_url)
+
+    def test_deal_detail_follows_flags(self):
+        self.search('find')
+        request = RequestFactory().get('/home/deal/1/')
+        request.session = self.client.session
+        self.assertEqual(views.deal_detail(request, '1').status_code, 200)
+        queries.flag_deals([1])
+        self.assertRaises(Http404, views.deal_detail, request, '1')
+        queries.approve_deals([1])
+        self.assertEqual(views.deal_detail(request, '1').status_code, 200)
+
+    def test_dealer_pages_show_map_images(self):
+        self.search('enter')
+        response = self.client.get('/home/dealer_select/')
+        self.assertFalse('<img' in response.content)
+        self.assertEqual(enrich.enrich_dealers(client=places._client), (2, 0))
+        response = self.client.get('/home/dealer_select/')
+        self.assertEqual(response.content.count("<img src='"), 2)
+        self.search('find')
+        response = self.client.get('/home/dealer_deals/%s/' % self.place_id)
+        self.assertTrue("<img src='%s" % settings.GMAP_STATIC_MAP_URL
+                        in response.content)
+        self.assertTrue('"map_url": "http' in response.content)
+
+    def test_price_trend(self):
+        self.search('find')
+        response = self.client.get('/home/price_trend/',
+                                   {'place_id': self.place_id})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        months = json.loads(response.content)['months']
+        self.assertEqual(len(months), settings.PRICE_TREND_MONTHS)
+        self.assertEqual(months[-1]['month'], date.today().strftime('%Y-%m'))
+        response = self.client.get('/home/price_trend/')
+        self.assertEqual(len(json.loads(response.content)['months']),
+                         settings.PRICE_TREND_MONTHS)
+
+    def test_session_holds_only_keys(self):
+        self.search('find')
+        self.client.get('/home/area_summary/', {'trim': '2'})
+        selection = self.client.session['selection']
+        self.assertEqual(sorted(selection), ['lat_lng', 'location', 'make',
+                                             'model', 'places_key', 'trim',
+                                             'year'])
+
+
+class DealNamesTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    place_id = 'ad76924a25faa79a7a60ffe4aef03cd8e87a073e'
+
+    def setUp(self):
+        spam.get_backend().clear()
+
+    def get_names(self, deal_pk):
+        return Deal.objects.filter(pk=deal_pk).values_list(
+            'year', 'make_name', 'model_name', 'trim_name', 'dealer_name')[0]
+
+    def test_fixture_and_entry(self):
+        self.assertEqual(self.get_names(1), (2012, u'BMW', u'3 Series',
+                                             u'328i Sedan', u'BMW of Honolulu'))
+        deal = enter_deal(self.place_id, 2, 45000)
+        self.assertEqual(self.get_names(deal.pk)[3], u'335i Sedan')
+        self.assertEqual(unicode(deal), u'2012 BMW 3 Series 335i Sedan '
+                         u'BMW of Honolulu 45000 2013-04-01')
+
+    def test_renames(self):
+        dealer = Dealer.objects.get(place_id=self.place_id)
+        dealer.name = u'BMW Honolulu'
+        dealer.save()
+        trim = Trim.objects.get(pk=1)
+        trim.name = u'328i'
+        trim.save()
+        self.assertEqual(self.get_names(1)[3:], (u'328i', u'BMW Honolulu'))
+        self.assertEqual(self.get_names(2)[3:], (u'335i Sedan', u'BMW Honolulu'))
+
+    def test_list_in_one_query(self):
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        dealer = queries.get_dealer(self.place_id)
+        with self.assertNumQueries(1):
+            names = [unicode(d) + d.trim_name
+                     for d in queries.get_deals(vehicle, dealer, None)]
+        self.assertEqual(len(names), 5)
+        with self.assertNumQueries(1):
+            deal = queries.get_deal(1)
+            deal.dealer.name, deal.user_ip.user.email
+
+    def test_fill(self):
+        Deal.objects.update(year=None, make_name='', model_name='',
+                            trim_name='', dealer_name='')
+        self.assertEqual(schema.fill_deal_names(), Deal.objects.count())
+        self.assertEqual(self.get_names(1), (2012, u'BMW', u'3 Series',
+                                             u'328i Sedan', u'BMW of Honolulu'))
+        self.assertEqual(schema.fill_deal_names(), 0)
+
+    def test_admin_changelist(self):
+        AuthUser.objects.create_superuser('admin', 'admin@whachapay.com',
+                                          'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/admin/core/deal/')
+        self.assertContains(response, 'BMW of Honolulu')
+        deals = Deal.objects.count()
+        # The session, the user, the count, and the page, however many deals
+        # are listed.
+        with self.assertNumQueries(4):
+            self.client.get('/admin/core/deal/')
+        self.assertEqual(len(response.context['cl'].result_list), deals)
+
+
+class DealerEnrichmentTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    def setUp(self):
+        self.server = PlacesStubServer()
+        self.server.start()
+        self.places_client = places.PlacesClient(self.server.url, 'key')
+        # The Ford dealer has details, the BMW dealer was stored without a
+        # reference, and Honda Windward isn't found.
+        Dealer.objects.filter(pk=2).update(
+            reference='CnRvFABA111BB43D6AC1F42E308B')
+        Dealer.objects.create(
+            place_id='3c9a7e1d0c2b5f4a6e8d9b0a1c2e3f4a5b6c7d8e',
+            location='21.296654,-157.846577', name='Honda Windward',
+            address='45-655 Kamehameha Highway, Kaneohe',
+            reference='CnRv3C9A7E1D0C2B5F4A6E8D9B0A')
+
+    def tearDown(self):
+        self.places_client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        geo.bump_version()
+
+    def test_enrich(self):
+        self.assertEqual(enrich.enrich_dealers(client=self.places_client), (3, 0))
+        self.assertEqual(self.server.hits, 2)
+        ford = Dealer.objects.get(pk=2)
+        self.assertEqual((ford.street, ford.city, ford.state, ford.postal_code,
+                          ford.country),
+                         (u'1370 North King Street', u'Honolulu', u'HI',
+                          u'96817', u'US'))
+        self.assertEqual(ford.location, '21.328935,-157.870345')
+        self.assertEqual(ford.latitude, 21.328935)
+        self.assertTrue('center=21.328935%2C-157.870345' in ford.map_url)
+        bmw = Dealer.objects.get(pk=1)
+        self.assertEqual(bmw.formatted_address, '')
+        self.assertTrue('center=21.300311%2C-157.853781' in bmw.map_url)
+        honda = Dealer.objects.get(name='Honda Windward')
+        self.assertTrue(honda.enriched and honda.map_url and not honda.street)
+        self.assertEqual(enrich.enrich_dealers(client=self.places_client), (0, 0))
+        self.assertEqual(
+            queries.get_dealer_map_urls([ford.place_id, 'unknown']),
+            {ford.place_id: ford.map_url})
+
+    def test_failed_lookups_are_retried(self):
+        down = places.PlacesClient('http://127.0.0.1:1/maps/api/place/search/json',
+                                   'key')
+        try:
+            self.assertEqual(enrich.enrich_dealers(client=down), (1, 2))
+        finally:
+            down.close()
+        self.assertEqual(Dealer.objects.filter(enriched__isnull=True).count(),
+                         2)
+        # A new dealer goes ahead of the ones that failed.
+        dealer = Dealer.objects.create(
+            place_id='4d8b6f2e1a3c5e7f9b0d2c4e6a8f0b1d3c5e7a9b',
+            location='21.290129,-157.842438', name='Honda Kapiolani',
+            address='1200 Kapiolani Boulevard, Honolulu')
+        self.assertEqual(enrich.enrich_dealers(1, client=self.places_client),
+                         (1, 0))
+        self.assertTrue(Dealer.objects.get(pk=dealer.pk).enriched)
+        self.assertEqual(enrich.enrich_dealers(client=self.places_client), (2, 0))
+
+    @override_settings(GMAP_ENRICH_MAX_ATTEMPTS=2)
+    def test_failing_lookups_are_given_up(self):
+        down = places.PlacesClient('http://127.0.0.1:1/maps/api/place/search/json',
+                                   'key')
+        try:
+            self.assertEqual(enrich.enrich_dealers(client=down), (1, 2))
+            self.assertEqual(enrich.enrich_dealers(client=down), (2, 0))
+        finally:
+            down.close()
+        ford = Dealer.objects.get(pk=2)
+        self.assertEqual((ford.enrich_attempts, ford.street), (2, ''))
+        self.assertTrue(ford.enriched and ford.map_url)
+        self.assertEqual(enrich.enrich_dealers(client=self.places_client), (0, 0))
+
+    def test_pages_bumped(self):
+        ford = Dealer.objects.get(pk=2)
+        deal = Deal.objects.filter(dealer=ford).select_related('vehicle')[0]
+        dealer_key = page_cache.get_dealer_key(
+            deal.year, deal.vehicle.make_id, deal.vehicle.model_id,
+            ford.place_id)
+        vehicle_key = page_cache.get_vehicle_key(
+            deal.year, deal.vehicle.make_id, deal.vehicle.model_id)
+        deal_key = page_cache.get_deal_key(deal.pk)
+        before = page_cache.get_versions([dealer_key, deal_key, vehicle_key])
+        enrich.enrich_dealers(client=self.places_client)
+        after = page_cache.get_versions([dealer_key, deal_key, vehicle_key])
+        self.assertNotEqual(after[0], before[0])
+        self.assertNotEqual(after[1], before[1])
+        self.assertEqual(after[2], before[2])
+
+    def test_rate_limit(self):
+        client = places.PlacesClient(self.server.url, 'key', details_rate=20)
+        start = time.time()
+        try:
+            details = client.get_details(['CnRvFABA111BB43D6AC1F42E308B'] * 5)
+        finally:
+            client.close()
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual(details['CnRvFABA111BB43D6AC1F42E308B']['city'],
+                         u'Honolulu')
+
+
+class DealEntryTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    place = {'id': 'ad76924a25faa79a7a60ffe4aef03cd8e87a073e',
+             'location': '21.300311,-157.853781', 'name': 'BMW of Honolulu',
+             'vicinity': '777 Kapiolani Boulevard, Honolulu'}
+    selection = {'year': 2012, 'make': 1, 'model': 1}
+
+    def setUp(self):
+        queries.rebuild_deal_stats()
+        catalog.get_index()
+        spam.get_backend().clear()
+
+    def enter(self, email='joe@customer.com', ip='127.0.0.1', place=None,
+              price=45000):
+        return queries.enter_deal({'REMOTE_ADDR': ip}, self.selection,
+                                  place or self.place,
+                                  {'email': email, 'trim': 2, 'price': price,
+                                   'date': date(2013, 4, 1), 'comment': ''})
+
+    def get_stats(self):
+        return DealStats.objects.get(vehicle=1, trim=2, dealer=1)
+
+    @override_settings(TASKS_EAGER=False)
+    def test_deferred_stats(self):
+        count = self.get_stats().count
+        # The user IP, vehicle, trim, dealer, and near duplicate lookups, then
+        # the deal and task inserts.
+        with self.assertNumQueries(7):
+            deal = self.enter()
+        self.assertEqual(deal.user_ip_id, 1)
+        self.assertEqual(deal.make_name, u'BMW')
+        self.assertEqual(self.get_stats().count, count)
+        self.enter(price=47000)
+        self.assertEqual(Task.objects.count(), 2)
+        # Both deals are added to the stats row at once.
+        self.assertEqual(tasks.process(), 2)
+        stats = self.get_stats()
+        self.assertEqual((stats.count, stats.max_price), (count + 2, 47000))
+        self.assertEqual(Task.objects.count(), 0)
+        self.assertEqual(tasks.process(), 0)
+
+    def test_eager(self):
+        count = self.get_stats().count
+        self.enter()
+        self.assertEqual(self.get_stats().count, count + 1)
+        self.assertEqual(Task.objects.count(), 0)
+
+    def test_creates_missing(self):
+        place = dict(self.place, id='%040x' % 1, name='New BMW')
+        deal = self.enter(email='new@customer.com', ip='10.0.0.9', place=place)
+        self.assertEqual((deal.user_ip.user.email, deal.user_ip.ip.ip),
+                         (u'new@customer.com', u'10.0.0.9'))
+        self.assertEqual((deal.dealer.name, deal.dealer.latitude),
+                         (u'New BMW', 21.300311))
+        user_ips, dealers = UserIP.objects.count(), Dealer.objects.count()
+        self.assertEqual(self.enter(email='new@customer.com', ip='10.0.0.9',
+                                    place=place, price=46000).user_ip,
+                         deal.user_ip)
+        self.assertEqual((UserIP.objects.count(), Dealer.objects.count()),
+                         (user_ips, dealers))
+        stats = DealStats.objects.get(dealer=deal.dealer)
+        self.assertEqual((stats.count, stats.min_price), (2, 45000))
+
+    @override_settings(TASKS_EAGER=False, TASK_MAX_ATTEMPTS=2)
+    def test_failed_tasks_are_kept(self):
+        self.enter()
+        handler = tasks.HANDLERS['deal_stored']
+        tasks.HANDLERS['deal_stored'] = 'core.tests.fail'
+        tasks.logger.disabled = True
+        try:
+            for i in range(3):
+                self.assertEqual(tasks.process(), 0)
+        finally:
+            tasks.HANDLERS['deal_stored'] = handler
+            tasks.logger.disabled = False
+        task = Task.objects.get()
+        self.assertEqual((task.attempts, task.error), (2, u'Failed.'))
+
+    def test_sliding_window(self):
+        count = lambda now: spam.count_submission('ip', '10.0.0.1', now)
+        for i in range(3):
+            self.assertEqual(count(0), i + 1)
+        self.assertEqual(count(settings.SPAM_WINDOW - 1), 4)
+        # The first slot has left the window.
+        slot_seconds = settings.SPAM_WINDOW // settings.SPAM_WINDOW_SLOTS
+        self.assertEqual(count(settings.SPAM_WINDOW + slot_seconds), 2)
+        self.assertEqual(spam.count_submission('user', u'joe@customer.com'), 1)
+
+    @override_settings(SPAM_IP_LIMIT=2)
+    def test_flood_is_flagged(self):
+        count = self.get_stats().count
+        deals = [self.enter(email='user%d@customer.com' % i, price=40000 + i)
+                 for i in range(3)]
+        self.assertEqual([d.flagged for d in deals], [False, False, True])
+        self.assertEqual(deals[2].spam_reasons, 'ip')
+        # Stored, but left out of the stats and the deal list.
+        self.assertEqual(Deal.objects.filter(pk=deals[2].pk).count(), 1)
+        self.assertEqual(self.get_stats().count, count + 2)
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        listed = queries.get_deals(vehicle, deals[2].dealer, None)
+        self.assertFalse(listed.filter(pk=deals[2].pk).exists())
+        summaries, stats = queries.get_price_stats([self.place['id']],
+                                                   vehicle, None)
+        self.assertEqual(stats['count'], listed.count())
+        queries.rebuild_deal_stats()
+        self.assertEqual(self.get_stats().count, count + 2)
+        # Another IP is still counted.
+        self.assertFalse(self.enter(ip='10.0.0.2').flagged)
+        self.assertEqual(queries.approve_deals([deals[2].pk]), 1)
+        tasks.run_eager()
+        self.assertEqual(self.get_stats().count, count + 4)
+        self.assertEqual(queries.approve_deals([deals[2].pk]), 0)
+
+    def test_flag_deals(self):
+        deals = [self.enter(email='user%d@customer.com' % i, price=price)
+                 for i, price in enumerate((20000, 60000))]
+        stats = self.get_stats()
+        month = DealMonthStats.objects.get(vehicle=1, trim=2, dealer=1,
+                                           month=date(2013, 4, 1))
+        self.assertEqual((stats.max_price, month.count), (60000, 2))
+        self.assertEqual(queries.flag_deals([deals[1].pk]), 1)
+        self.assertEqual(queries.flag_deals([deals[1].pk]), 0)
+        flagged = self.get_stats()
+        self.assertEqual((flagged.count, flagged.sum),
+                         (stats.count - 1, stats.sum - 60000))
+        self.assertTrue(flagged.max_price < 60000)
+        self.assertEqual(DealMonthStats.objects.get(pk=month.pk).count, 1)
+        # As rebuilt.
+        queries.rebuild_deal_stats()
+        rebuilt = self.get_stats()
+        self.assertEqual((rebuilt.count, rebuilt.sum, rebuilt.min_price,
+                          rebuilt.max_price, rebuilt.sum_squares),
+                         (flagged.count, flagged.sum, flagged.min_price,
+                          flagged.max_price, flagged.sum_squares))
+        # The month's last deal.
+        queries.flag_deals([deals[0].pk])
+        self.assertFalse(DealMonthStats.objects.filter(
+            vehicle=1, trim=2, dealer=1, month=date(2013, 4, 1)).exists())
+
+    @override_settings(TASKS_EAGER=False)
+    def test_flag_queued_deal(self):
+        count = self.get_stats().count
+        deal = self.enter()
+        self.assertEqual(queries.flag_deals([deal.pk]), 1)
+        self.assertEqual(self.get_stats().count, count)
+        tasks.process()
+        self.assertEqual(self.get_stats().count, count)
+
+    @override_settings(TASKS_EAGER=False)
+    def test_approve_queued_deal(self):
+        count = self.get_stats().count
+        deal = self.enter()
+        queries.flag_deals([deal.pk])
+        self.assertEqual(queries.approve_deals([deal.pk]), 1)
+        # The task queued on entry counts it, once.
+        self.assertEqual(Task.objects.count(), 1)
+        tasks.process(1)
+        tasks.process(1)
+        self.assertEqual(self.get_stats().count, count + 1)
+
+    def test_near_duplicate_is_flagged(self):
+        self.assertFalse(self.enter().flagged)
+        deal = self.enter(price=45099)
+        self.assertEqual((deal.flagged, deal.spam_reasons),
+                         (True, 'duplicate'))
+        self.assertFalse(self.enter(price=45200).flagged)
+        self.assertFalse(self.enter(email='new@customer.com').flagged)
+
+def fail(args):
+    raise ValueError('Failed.')
+
+
+class IngestTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    csv = ('email,ip,year,make,model,trim,place_id,dealer_name,'
+           'dealer_location,dealer_address,price,date,comment\n'
+           'joe@customer.com,127.0.0.1,2012,BMW,3 Series,328i Sedan,'
+           'ad76924a25faa79a7a60ffe4aef03cd8e87a073e,BMW of Honolulu,,,'
+           '31000,2013-04-01,\n'
+           'new@customer.com,10.0.0.1,2013,Honda,Fit,Fit Sport,new_place,'
+           'New Honda,"21.3,-157.8",1 Ala Moana,18000,2013-04-02,Great\n'
+           'new@customer.com,10.0.0.1,2013,honda,fit,fit sport,new_place,'
+           'New Honda,"21.3,-157.8",1 Ala Moana,18000,2013-04-02,Great\n'
+           'bad@customer.com,10.0.0.2,2012,Acura,TL,Base,new_place,'
+           'New Honda,,,25000,2013-04-03,\n')
+
+    def setUp(self):
+        # The rejected records are expected.
+        ingest.logger.disabled = True
+
+    def tearDown(self):
+        ingest.logger.disabled = False
+
+    def test_import(self):
+        deals = Deal.objects.count()
+        result = ingest.import_deals(StringIO(self.csv), batch_size=2)
+        self.assertEqual((result.created, result.duplicates, result.rejected),
+                         (2, 1, 1))
+        self.assertEqual(Deal.objects.count(), deals + 2)
+        # Existing users and dealers are reused.
+        self.assertEqual(User.objects.filter(
+            email='joe@customer.com').count(), 1)
+        dealer = Dealer.objects.get(place_id='new_place')
+        self.assertEqual((dealer.name, dealer.latitude), ('New Honda', 21.3))
+        deal = Deal.objects.get(dealer=dealer)
+        self.assertEqual((deal.price, deal.trim_id, deal.vehicle.model_id),
+                         (18000, 5, 3))
+        # bulk_create skips pre_save; the names are copied by the ingester.
+        self.assertEqual((deal.year, deal.make_name, deal.model_name,
+                          deal.trim_name, deal.dealer_name),
+                         (2013, u'Honda', u'Fit', u'Fit Sport', u'New Honda'))
+        stats = DealStats.objects.get(vehicle=deal.vehicle, dealer=dealer)
+        self.assertEqual(stats.count, 1)
+
+    def test_import_is_idempotent(self):
+        ingest.import_deals(StringIO(self.csv))
+        deals = Deal.objects.count()
+        result = ingest.import_deals(StringIO(self.csv))
+        self.assertEqual((result.created, result.duplicates), (0, 3))
+        self.assertEqual(Deal.objects.count(), deals)
+
+    def build_records(self, count):
+        return [{'email': 'user%d@customer.com' % i,
+                 'ip': '10.0.%d.%d' % (i // 256, i % 256),
+                 'year': '2012', 'make': 'BMW', 'model': '3 Series',
+                 'trim': '335i Sedan', 'place_id': 'place%d' % (i % 3),
+                 'dealer_name': 'Dealer', 'price': str(30000 + i),
+                 'date': '2013-04-01'} for i in range(count)]
+
+    def test_batch_queries(self):
+        ingester = ingest.DealIngester(batch_size=50)
+        ingester.get_catalog()
+        # Independent of the batch size, up to the database's limits: the
+        # duplicate check, then a lookup, insert, and re-lookup for each of
+        # IPs, users, user IPs, and dealers, a vehicle lookup, the dealer
+        # names, and the deals insert.
+        with self.assertNumQueries(16):
+            result = ingester.ingest(self.build_records(50))
+        self.assertEqual(result.created, 50)
+
+    def test_large_batch(self):
+        deals = Deal.objects.count()
+        result = ingest.DealIngester().ingest(self.build_records(1200))
+        self.assertEqual(result.created, 1200)
+        self.assertEqual(Deal.objects.count(), deals + 1200)
+        result = ingest.DealIngester().ingest(self.build_records(1200))
+        self.assertEqual(result.duplicates, 1200)
+
+    def test_bad_ip_is_rejected(self):
+        records = self.build_records(2)
+        records[0]['ip'] = 'not an ip'
+        result = ingest.DealIngester().ingest(records)
+        self.assertEqual((result.created, result.rejected), (1, 1))
+
+    def test_jsonl(self):
+        lines = ['{"email": "new@customer.com", "ip": "10.0.0.1", '
+                 '"year": 2012, "make": "BMW", "model": "3 Series", '
+                 '"trim": "328i Sedan", "place_id": "new_place", '
+                 '"dealer_name": "New BMW", "price": 29000, '
+                 '"date": "2013-04-01"}',
+                 '',
+                 'not json']
+        result = ingest.import_deals(StringIO('\n'.join(lines)),
+                                     format='jsonl')
+        self.assertEqual((result.created, result.rejected), (1, 1))
+
+
+class ExportTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    def setUp(self):
+        queries.rebuild_deal_stats()
+
+    def test_deals_in_chunks(self):
+        # One query per chunk, plus one for the last, partial chunk.
+        with self.assertNumQueries(3):
+            rows = list(export.iter_rows('deals', chunk_size=3))
+        self.assertEqual([r['id'] for r in rows], range(1, 9))
+        self.assertEqual((rows[0]['make'], rows[0]['trim'], rows[0]['price']),
+                         (u'BMW', u'328i Sedan', 30000))
+
+    def test_flagged_deals_left_out(self):
+        queries.flag_deals([1])
+        rows = list(export.iter_rows('deals'))
+        self.assertEqual([r['id'] for r in rows], range(2, 9))
+        self.assertEqual(sum(r['count'] for r in export.iter_rows('stats')), 7)
+
+    def test_stats(self):
+        rows = list(export.iter_rows(
+            'stats', dealer='faba111bb43d6ac1f42e308b4dff2475d2b8562b'))
+        self.assertEqual(sorted((r['trim'], r['count'], r['avg'])
+                                for r in rows),
+                         [(u'328i Sedan', 2, 23500), (u'335i Sedan', 1, 24000)])
+
+    def test_csv(self):
+        lines = ''.join(export.iter_export('deals', 'csv')).splitlines()
+        self.assertEqual(lines[0].split(','), export.get_columns('deals'))
+        self.assertEqual(len(lines), 9)
+
+    def test_view(self):
+        url = '/home/export/stats.ndjson'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse('count' in response.content)
+        AuthUser.objects.create_superuser('admin', 'admin@whachapay.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(url, {'vehicle': 1})
+        rows = [json.loads(l) for l in response.content.splitlines()]
+        self.assertEqual(sum(r['count'] for r in rows), 8)
+
+
+class SyntheticDataTest(TestCase):
+    def test_seed(self):
+        data = synthetic.SyntheticData(seed=1)
+        data.seed(makes=2, models=3, trims=2, years=range(2010, 2014),
+                  dealers=10, deals=600, users=50)
+        # A vehicle per model and year made, with one or two trims.
+        self.assertTrue(6 <= len(data.vehicles) <= 24)
+        self.assertTrue(all(1 <= len(v[4]) <= 2 for v in data.vehicles))
+        self.assertEqual(Deal.objects.filter(
+            dealer__in=data.dealer_pks).count(), 600)
+        self.assertEqual(User.objects.filter(
+            email__startswith='user').count(), 50)
+        self.assertEqual(sum(DealStats.objects.filter(
+            dealer__in=data.dealer_pks).values_list('count', flat=True)), 600)
+        # Dealers are within three standard deviations of a metro.
+        for dealer in Dealer.objects.filter(pk__in=data.dealer_pks):
+            self.assertTrue(min(util.get_distance(
+                dealer.latitude, dealer.longitude, m[1], m[2])
+                for m in synthetic.METROS) <= 3 * 1.5 * data.spread)
+        results = data.get_places_response(count=5)['results']
+        self.assertEqual([r['id'] for r in results],
+                         [p['id'] for p in data.places[:5]])
+
+    def test_reproducible(self):
+        deals = []
+        for i in range(2):
+            data = synthetic.SyntheticData(seed=1)
+            data.seed(makes=1, models=2, trims=2, dealers=3, deals=100)
+            deals.append(list(Deal.objects.filter(
+                dealer__in=data.dealer_pks).values_list('price', 'date')))
+        self.assertEqual(deals[0], deals[1])
+
+    def test_copy_value(self):
+        self.assertEqual(synthetic.copy_value(None), '\\N')
+        self.assertEqual(synthetic.copy_value(u'a\tb\\'), 'a\\tb\\\\')
+
+
+class InstrumentTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    def setUp(self):
+        instrument.reset_stats()
+
+    def test_request_metrics(self):
+        self.client.get('/home/')
+        stats = instrument.get_stats()
+        self.assertEqual(sorted(stats), ['core.views.home'])
+        home = stats['core.views.home']
+        self.assertEqual(home['count'], 1)
+        self.assertEqual(sum(home['wall_ms_histogram'].values()), 1)
+        self.assertTrue(home['mean']['template_ms'] > 0)
+        self.assertTrue('queries' in home['mean'])
+
+    def test_queries_are_counted_without_debug_cursor(self):
+        request = RequestFactory().get('/')
+        middleware = instrument.InstrumentMiddleware()
+        middleware.process_request(request)
+        Deal.objects.count()
+        Dealer.objects.count()
+        metrics = instrument.current()
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(metrics.queries, 2)
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_query_budget(self):
+        request = RequestFactory().get('/')
+        middleware = instrument.InstrumentMiddleware()
+        view = instrument.query_budget(1)(
+            lambda request: HttpResponse(str(Deal.objects.count()
+                                             + Dealer.objects.count())))
+        middleware.process_request(request)
+        middleware.process_view(request, view, (), {})
+        with self.settings(PERF_ENFORCE_BUDGETS=True):
+            self.assertRaises(instrument.QueryBudgetExceeded,
+                              middleware.process_response, request,
+                              view(request))
+
+    def test_stats_view(self):
+        self.assertEqual(self.client.get('/home/perf/').status_code, 200)
+        AuthUser.objects.create_superuser('admin', 'admin@whachapay.com',
+                                          'admin')
+        self.client.login(username='admin', password='admin')
+        self.client.get('/home/')
+        response = self.client.get('/home/perf/')
+        self.assertTrue('core.views.home' in json.loads(response.content))
+
+
+class FakeConnection(object):
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.closed = False
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.checked = []
+        self.pool = pool.ConnectionPool(2, 60, self.check, self.close)
+
+    def check(self, connection, idle):
+        self.checked.append(connection)
+        return not connection.broken
+
+    def close(self, connection):
+        connection.closed = True
+
+    def test_reuse(self):
+        self.assertEqual(self.pool.get(), None)
+        now = time.time()
+        first, second, third = [FakeConnection() for i in range(3)]
+        for conn in (first, second, third):
+            self.pool.put(conn, now)
+        # Beyond the pool's size, returned connections are closed.
+        self.assertTrue(third.closed)
+        self.assertEqual(self.pool.get(), (second, now))
+        self.assertEqual(self.pool.get(), (first, now))
+        self.assertEqual(self.pool.get(), None)
+        self.assertEqual(self.checked, [second, first])
+        self.assertFalse(first.closed or second.closed)
+
+    def test_unusable_connections_are_closed(self):
+        now = time.time()
+        usable, broken, old = (FakeConnection(), FakeConnection(True),
+                               FakeConnection())
+        self.pool.put(usable, now)
+        self.pool.put(broken, now)
+        self.assertEqual(self.pool.get(), (usable, now))
+        self.assertTrue(broken.closed)
+        self.pool.put(old, now - 61)
+        self.assertTrue(old.closed)
+        self.pool.put(usable, now)
+        self.pool.clear()
+        self.assertTrue(usable.closed)
+        self.assertEqual(self.pool.get(), None)
+
+@override_settings(DATABASE_REPLICAS=('replica1',))
+class ReplicaRouterTest(TestCase):
+    def setUp(self):
+        self.router = replicas.ReplicaRouter()
+        page_cache.get_backend().clear()
+
+    def get_read_db(self, request, model=Deal):
+        view = replicas.read_only(
+            lambda request: self.router.db_for_read(model))
+        return view(request)
+
+    def test_read_only_views_read_from_replicas(self):
+        request = RequestFactory().get('/')
+        self.assertEqual(self.get_read_db(request), 'replica1')
+        self.assertEqual(self.get_read_db(request, AuthUser), None)
+        self.assertEqual(self.router.db_for_read(Deal), None)
+        self.assertEqual(self.router.db_for_write(Deal), 'default')
+        self.assertFalse(self.router.allow_syncdb('replica1', Deal))
+        with self.settings(DATABASE_REPLICAS=()):
+            self.assertEqual(self.get_read_db(request), None)
+
+    def test_pinned_after_entry(self):
+        response = replicas.pin_primary(HttpResponse())
+        cookie = response.cookies[replicas.PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], settings.DATABASE_REPLICA_LAG)
+        request = RequestFactory().get('/')
+        request.COOKIES[replicas.PIN_COOKIE] = cookie.value
+        self.assertEqual(self.get_read_db(request), None)
+
+    def test_changed_pages_render_from_primary(self):
+        key = page_cache.get_vehicle_key(2012, 1, 1)
+        render = lambda: HttpResponse(replicas.get_replica() or 'default')
+        view = replicas.read_only(lambda request: page_cache.get_page(
+            'test', (), [key], render))
+        request = RequestFactory().get('/')
+        self.assertEqual(view(request).content, 'replica1')
+        page_cache.bump(key)
+        self.assertEqual(view(request).content, 'default')
+        page_cache.get_backend().delete(page_cache.get_bumped_key(key))
+        page_cache.bump_all()
+        self.assertEqual(view(request).content, 'default')
+
+    def test_indexes_are_built_from_primary(self):
+        with self.settings(DATABASE_REPLICAS=()):
+            replicas_seen = []
+            build = geo.build_index
+            geo.build_index = lambda version: replicas_seen.append(
+                replicas.get_replica()) or build(version)
+            try:
+                geo.bump_version()
+                replicas._state.replica = 'replica1'
+                geo.get_index()
+            finally:
+                replicas._state.replica = None
+                geo.build_index = build
+        self.assertEqual(replicas_seen, [None])
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite',
+                     'Query plans are checked with SQLite.')
+class QueryPlanTest(TestCase):
+    fixtures = ['sample_deals.yaml']
+
+    def assertUsesIndex(self, queryset, index):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertTrue(index in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def test_get_deals(self):
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        dealer = queries.get_dealer(FlowTest.place_id)
+        self.assertUsesIndex(queries.get_deals(vehicle, dealer, 1),
+                             'core_deal_vehicle_dealer_trim_price')
+        self.assertUsesIndex(queries.get_deals(vehicle, dealer, None),
+                             'core_deal_vehicle_dealer_price')
+
+    def test_deal_pages(self):
+        vehicle = queries.get_vehicle(2012, 1, 1)
+        dealer = queries.get_dealer(FlowTest.place_id)
+        deals = queries.get_deals(vehicle, dealer, 1)
+        after = deals.filter(Q(price__gt=30000) | Q(price=30000, pk__gt=1))
+        self.assertUsesIndex(after.order_by('price', 'pk')[:21],
+                             'core_deal_vehicle_dealer_trim_price')
+        before = deals.filter(Q(price__lt=30000) | Q(price=30000, pk__lt=1))
+        self.assertUsesIndex(before.order_by('-price', '-pk')[:21],
+                             'core_deal_vehicle_dealer_trim_price')
+
+    def test_unique_lookups(self):
+        # The unique_together indexes.
+        self.assertUsesIndex(Vehicle.objects.filter(make_year=1, make=1,
+                                                    model=1),
+                             'sqlite_autoindex_core_vehicle_1')
+        self.assertUsesIndex(MakeYear.objects.filter(make=1, year=2012)
+                             .order_by(), 'sqlite_autoindex_core_makeyear_1')
+        self.assertUsesIndex(DealStats.objects.filter(vehicle=1, dealer=1),
+                             'sqlite_autoindex_core_dealstats_1')
+
+    def test_upgrade_is_idempotent(self):
+        self.assertEqual(schema.create_indexes(), [])
+        self.assertEqual(schema.add_columns(), [])
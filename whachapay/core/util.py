@@ -1,3 +1,15 @@
+import math, time
+from django.core.cache import cache
+from django.db import connection
+
+# Mean radius, in meters.
+EARTH_RADIUS = 6371000
+
+# SQLite limits a statement to 500 compound SELECT terms, as bulk_create
+# writes inserts there, and to 999 variables.
+SQLITE_MAX_TERMS = 500
+SQLITE_MAX_VARIABLES = 999
+
 def get_client_ip(meta):
     """
     !!! FIX: Make client IP tracking more robust. See WikiP link here:
@@ -16,6 +28,91 @@ def get_dict(seq, attr, value):
             return d
     return None
 
+def get_int(value, default=None):
+    """Convert a value to an int, or return the default if it can't be."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
 def get_unicode(*items):
     """Get a space-separated unicode string from the given items."""
     return u' '.join(map(unicode, items))
+
+def get_lat_lng(location):
+    """
+    Parse a "lat,lng" location string.
+
+    Returns tuple of floats, or (None, None) if the location can't be parsed.
+    """
+    try:
+        lat, lng = [float(l) for l in location.split(',')]
+    except (AttributeError, ValueError):
+        return (None, None)
+    return (lat, lng)
+
+def get_month(day):
+    """Returns date, the first day of a date's month."""
+    return day.replace(day=1)
+
+def add_months(month, months):
+    """
+    Add a number of months, which may be negative, to the first day of a
+    month.
+
+    Returns date.
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1, day=1)
+
+def get_distance(lat1, lng1, lat2, lng2):
+    """Get the great-circle distance in meters between two points."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2)
+         * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+def get_version_stamp(key):
+    """
+    Get the version stamp stored in the cache under key, starting a new one
+    if the cache has none. Stamps invalidate in-process indexes; see
+    core.geo.
+
+    Returns int.
+    """
+    version = cache.get(key)
+    if version is None:
+        # Time based, so that a stamp lost from the cache is never reused.
+        cache.add(key, int(time.time() * 1000))
+        version = cache.get(key)
+    return version
+
+def bump_version_stamp(key):
+    """Change the version stamp stored in the cache under key."""
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000))
+
+def bulk_create(model, objs):
+    """Insert the objects in as few statements as the database allows."""
+    size = len(objs) or 1
+    if connection.vendor == 'sqlite':
+        size = min(SQLITE_MAX_TERMS,
+                   SQLITE_MAX_VARIABLES // len(model._meta.local_fields))
+    for start in range(0, len(objs), size):
+        model.objects.bulk_create(objs[start:start + size])
+
+def get_chunks(values):
+    """
+    Split values into lists short enough for an IN lookup: of at most
+    SQLITE_MAX_TERMS on SQLite, and of all of them elsewhere.
+
+    Returns list of lists.
+    """
+    values = list(values)
+    size = len(values) or 1
+    if connection.vendor == 'sqlite':
+        size = SQLITE_MAX_TERMS
+    return [values[start:start + size]
+            for start in range(0, len(values), size)]
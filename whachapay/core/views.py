@@ -1,19 +1,30 @@
-import json, pprint, urllib
+import hashlib, json, pprint
 from datetime import date
 from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.cache import cache
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.shortcuts import redirect, render_to_response
 from django.template import RequestContext
-from django.template.loader import render_to_string
-from core import queries, util
+from core import (catalog, export, geo, instrument, page_cache, pagination,
+                  places, price_stats, queries, replicas, util)
 from core.forms import HomeForm, EntryForm, TrimForm
 
 _pp = pprint.PrettyPrinter(indent=2)
-_rtr = render_to_response
+
+def _rtr(*args, **kwargs):
+    """render_to_response, timed for core.instrument."""
+    with instrument.timer('template'):
+        return render_to_response(*args, **kwargs)
 
 ### Views
 
+# Each view's query budget allows for the session, and for rebuilding the
+# catalog and dealer indexes after they have been invalidated. The read_only
+# views read from a replica, if there are any; see core.replicas.
+
+@instrument.query_budget(10)
 def home(request):
     """
     Main home view.
@@ -22,7 +33,8 @@ def home(request):
     if 'enter' in request.GET or 'find' in request.GET:
         form = HomeForm(request.GET)
         if form.is_valid():
-            request.session['data'] = build_home_selection(form.cleaned_data)
+            request.session['selection'] = build_home_selection(
+                form.cleaned_data)
             if 'enter' in request.GET:
                 return redirect(dealer_select)
             else:
@@ -33,23 +45,80 @@ def home(request):
     else:
         form = HomeForm(initial={'make_year': 0})
 
-    return _rtr('home/home.html', {'form': form},
+    return _rtr('home/home.html',
+                {'form': form,
+                 'catalog_version': catalog.get_index().version},
                 context_instance=RequestContext(request))
 
 def build_home_selection(data):
     """
-    Home view helper function. Build a dictionary of data for the downstream
-    templates.
+    Home view helper function. Build the selection that is kept in the session
+    for the downstream views. It holds only keys; the places results are kept
+    in the shared cache under places_key, and everything else is looked up per
+    request. The places are only searched for when dealer selection needs
+    them; area searches use the known dealers.
+
+    Returns dictionary:
+        { 'year': 0,
+          'make': 0,
+          'model': 0,
+          'location': '',
+          'lat_lng': '',
+          'places_key': '' }
+    """
+    selection = {'year': int(data['make_year']),
+                 'make': int(data['make']),
+                 'model': int(data['model']),
+                 'location': data['place_name'],
+                 'lat_lng': data['lat_lng'],
+                 'places_key': get_places_key(data['lat_lng'])}
+    return selection
+
+def build_selection_context(selection):
     """
-    return {'vehicle': {'obj': {'make': data['make'], 
-                                'model': data['model']},
-                        'text': {'year': data['make_year'],
+    Build the template variables common to the views downstream of home from
+    the session selection.
+
+    Returns dictionary.
+    """
+    return {'vehicle': {'obj': {'make': selection['make'],
+                                'model': selection['model']},
+                        'text': {'year': selection['year'],
                                  'make_name':
-                                     queries.get_make_name(data['make']),
+                                     queries.get_make_name(selection['make']),
                                  'model_name':
-                                     queries.get_model_name(data['model'])},},
-            'location': data['place_name'],
-            'places': get_places(data['lat_lng'])}
+                                     queries.get_model_name(selection['model'])}},
+            'location': selection['location']}
+
+def get_session_places(selection):
+    """
+    Get the places results for the session selection from the shared cache,
+    searching if they haven't been fetched or have been evicted. Failed
+    searches and partial results aren't cached, so that the next request
+    retries, or gets the rest.
+
+    Returns list. See places.build_places.
+    """
+    places_data = cache.get(selection['places_key'])
+    if places_data is None:
+        places_data = get_places(selection['lat_lng'])
+        if 'results' in places_data and not places_data.get('partial'):
+            cache.set(selection['places_key'], places_data,
+                      settings.GMAP_PLACE_CACHE_TTL)
+    return places_data.get('results', [])
+
+def get_dealer_place(dealer):
+    """
+    Build a places result style dictionary for a stored dealer, for the maps
+    JavaScript, with the dealer's map image URL, if it has one.
+
+    Returns dictionary. See places.build_places.
+    """
+    return {'location': dealer.location,
+            'id': dealer.place_id,
+            'name': dealer.name,
+            'vicinity': dealer.address,
+            'map_url': dealer.map_url}
 
 def build_vehicle_options(get_data, form):
     """
@@ -62,62 +131,62 @@ def build_vehicle_options(get_data, form):
     make = get_data.get('make', 0)
     model = get_data.get('model', 0)
 
-    form.fields['make'].choices = (
-        [(m.id, m.name) for m in queries.get_make_options(make_year)])
+    form.fields['make'].choices = list(queries.get_make_options(make_year))
     form.fields['make'].choices.insert(0, (0, 'Make'))
     form.fields['make'].initial = make
 
-    form.fields['model'].choices = (
-        [(m.id, m.name) for m in queries.get_model_options(make, make_year)])
+    form.fields['model'].choices = list(queries.get_model_options(make,
+                                                                   make_year))
     form.fields['model'].choices.insert(0, (0, 'Model'))
     form.fields['model'].initial = model
 
-def ajax_home_update_selections(request):
-    """
-    Home screen vehicle selection Ajax view.
-
-    Returns HttpResponse or raises Http404.
-    """
-    if request.is_ajax():
-        # These might be 'Year', 'Make', or 'Model'.
-        make_year = request.GET['make_year']
-        make = request.GET['make']
-        model = request.GET['model']
-        selected = request.GET['selected']
-        data = {}
-        options = None
-
-        if selected == 'make_year' and make_year.isdigit():
-            options = queries.get_make_options(make_year)
-        data['make'] = render_to_string('home/update_select.html',
-                                        {'options': options,
-                                         'name': 'Make'})
-        options = None
-        if selected == 'make' and make.isdigit():
-            options = queries.get_model_options(make, make_year)
-        data['model'] = render_to_string('home/update_select.html',
-                                         {'options': options,
-                                          'name': 'Model'})
-        return HttpResponse(json.dumps(data), content_type='application/json')
+@instrument.query_budget(6)
+@replicas.read_only
+def vehicle_options(request, version, make_year, make):
+    """
+    Home screen vehicle selection options view. Serves the make options for a
+    year, and the model options for a year and make, as JSON. The URL carries
+    the catalog version, so a response never changes and can be cached by
+    browsers and front caches; requests for an old version are redirected to
+    the current one.
 
-    raise Http404
+    Returns HttpResponse.
+    """
+    index = catalog.get_index()
+    if int(version) != index.version:
+        return redirect(vehicle_options, index.version, make_year, make)
+    etag = '"%s-%s-%s"' % (index.version, make_year, make)
+    if etag in [e.strip() for e in
+                request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(
+            index.get_options_json(int(make_year), int(make)),
+            content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = ('public, max-age=%d'
+                                 % settings.CATALOG_OPTIONS_MAX_AGE)
+    return response
 
+@instrument.query_budget(8)
 def dealer_select(request):
     """
     Dealer selection view.
     """
-    if 'data' in request.session:
-        data = request.session['data']
+    if 'selection' in request.session:
+        selection = request.session['selection']
+        data = build_selection_context(selection)
         # Set up pagination.
-        places_results = ()
-        if 'results' in data['places']:
-            places_results = data['places']['results']
-        results = get_page(request, places_results, 5)
+        results = get_page(request, get_session_places(selection), 5)
+        # Show the map images of the dealers that have been enriched.
+        map_urls = queries.get_dealer_map_urls(
+            [r['id'] for r in results.object_list])
+        results.object_list = [dict(r, map_url=map_urls.get(r['id'], ''))
+                               for r in results.object_list]
         data['results'] = results
         # Make the places data available to JavaScript.
         data['places_json'] = json.dumps(results.object_list)
-        request.session['data'] = data
-        return _rtr('dealer_select.html', request.session['data'],
+        return _rtr('dealer_select.html', data,
                     context_instance=RequestContext(request))
     raise Http404
 
@@ -142,33 +211,33 @@ def get_page(request, object_list, per_page):
     except (EmptyPage, InvalidPage):
         return paginator.page(paginator.num_pages)
 
+@instrument.query_budget(25)
 def deal_entry(request, place_id):
     """
     Deal entry view.
     """
-    if 'data' in request.session:
-        # Verify that the passed-in place is in the session.
-        place_data = util.get_dict(
-            request.session['data']['places']['results'], 'id', place_id)
+    if 'selection' in request.session:
+        selection = request.session['selection']
+        # Verify that the passed-in place is in the session's places.
+        place_data = util.get_dict(get_session_places(selection), 'id',
+                                   place_id)
         if not place_data:
             raise Http404
-        data = {'vehicle': request.session['data']['vehicle'],
-                'dealer': place_data}
-        model_pk = data['vehicle']['obj']['model']
-        trim_year = data['vehicle']['text']['year']
+        data = build_selection_context(selection)
+        data['dealer'] = place_data
+        model_pk = selection['model']
+        trim_year = selection['year']
         data['place_json'] = json.dumps(place_data)
         if request.method == 'POST':
             form = EntryForm(request.POST, model_pk=model_pk, trim_year=trim_year,
                              label_suffix='')
             if form.is_valid():
-                user_ip = queries.store_user_ip(request.META, form.cleaned_data)
-                vehicle = queries.store_vehicle(data['vehicle'])
-                dealer = queries.store_dealer(place_data)
-                deal = queries.store_deal(user_ip, vehicle, dealer,
-                                          form.cleaned_data)
-                data['deal'] = deal
-                request.session['data'] = data
-                return redirect(deal_entered)
+                deal = queries.enter_deal(request.META, selection,
+                                          place_data, form.cleaned_data)
+                selection['deal'] = deal.pk
+                request.session['selection'] = selection
+                # Read the new deal back from the default database.
+                return replicas.pin_primary(redirect(deal_entered))
         else:
             form = EntryForm(initial={'date': date.today()}, model_pk=model_pk,
                              trim_year=trim_year, label_suffix='')
@@ -178,184 +247,279 @@ def deal_entry(request, place_id):
                     context_instance=RequestContext(request))
     raise Http404
 
+@instrument.query_budget(8)
 def deal_entered(request):
     """
     Deal entered confirmation view.
     """
-    if 'data' in request.session:
-        return _rtr('deal_entered.html', request.session['data'],
-                    context_instance=RequestContext(request))
+    if 'selection' in request.session:
+        selection = request.session['selection']
+        deal = queries.get_deal(selection.get('deal'))
+        if deal:
+            data = build_selection_context(selection)
+            data['deal'] = deal
+            data['dealer'] = get_dealer_place(deal.dealer)
+            data['place_json'] = json.dumps(data['dealer'])
+            return _rtr('deal_entered.html', data,
+                        context_instance=RequestContext(request))
     raise Http404
 
+@instrument.query_budget(16)
+@replicas.read_only
 def area_summary(request):
     """
-    Area summary view.
+    Area summary view. Cached; see core.page_cache.
     """
-    if 'data' in request.session:
-        data = request.session['data']
-        # Get the vehicle instance from the database.
-        v = data['vehicle']
-        vehicle = queries.get_vehicle(v['text']['year'], v['obj']['make'],
-                                      v['obj']['model'])
+    if 'selection' in request.session:
+        selection = request.session['selection']
         # Get the trim to send to the deals query.
-        form = TrimForm(request.GET, model_pk=v['obj']['model'],
-                        trim_year=v['text']['year'])
+        form = TrimForm(request.GET, model_pk=selection['model'],
+                        trim_year=selection['year'])
         trim = None
         if 'trim' in request.GET and form.is_valid():
             trim = form.cleaned_data['trim']
         trim = trim if trim and int(trim) > 0 else None
-        # Look up the dealers from the places.
-        dealer_list, deal_count, area_avg = [], 0, 0
-        places = ()
-        if 'results' in data['places']:
-            places = data['places']['results']
-        for p in places:
-            dealer = queries.get_dealer(p['id'])
-            if dealer:
-                # Look up the deals from the vehicle and dealer instances.
-                deals = queries.get_deals(vehicle, dealer, trim)
-                deal_count += len(deals)
-                dealer_sum = get_deals_sum(deals)
-                area_avg += dealer_sum
-                # Add dealer and average to data if deals were found.
-                if deals:
-                    dealer_avg = dealer_sum / len(deals)
-                    dealer_list.append({'obj': dealer, 'avg': dealer_avg})
-        # Set up pagination.
-        dealers = get_page(request, dealer_list, 5)
-        places_for_js = [{'location': d['obj'].location,
-                          'id': d['obj'].place_id,
-                          'name': d['obj'].name}
-                         for d in dealers.object_list]
-        # Set up template variables.
-        data['area_avg'] = area_avg / (deal_count if deal_count > 0 else 1)
-        data['dealers'] = dealers
-        data['form'] = form
-        data['form_action'] = 'area_summary'
-        data['trim'] = trim
-        data['places_json'] = json.dumps(places_for_js)
-        request.session['data'] = data
-        return _rtr('area_summary.html', request.session['data'],
-                    context_instance=RequestContext(request))
+        # Remember the trim for the dealer deals view.
+        if selection.get('trim') != trim:
+            selection['trim'] = trim
+            request.session['selection'] = selection
+        inputs = get_selection_inputs(selection) + (
+            selection['lat_lng'], trim, request.GET.get('page', '1'),
+            geo.get_version())
+        return page_cache.get_page(
+            'area_summary', inputs,
+            [page_cache.get_vehicle_key(selection['year'], selection['make'],
+                                        selection['model'])],
+            lambda: render_area_summary(request, selection, form, trim))
     raise Http404
 
-def get_deals_sum(deals):
+def render_area_summary(request, selection, form, trim):
     """
-    Area summary and dealer deals views helper function. Sum the prices of
-    a list of deals.
-    
-    Returns int.
+    Area summary view helper function.
+
+    Returns HttpResponse.
     """
-    deals_sum = 0
-    for d in deals:
-        deals_sum += d.price
-    return deals_sum
+    data = build_selection_context(selection)
+    # Get the vehicle instance from the database.
+    vehicle = queries.get_vehicle(selection['year'], selection['make'],
+                                  selection['model'])
+    # The known dealers in the area with deals, nearest first.
+    place_ids = queries.get_nearby_dealer_ids(
+        selection['lat_lng'], vehicle, trim, settings.DEALER_SEARCH_RADIUS)
+    summaries, area_stats = queries.get_price_stats(place_ids, vehicle, trim)
+    # Set up pagination, and look up the stats of the page's dealers only.
+    dealers = get_page(request, place_ids, 5)
+    dealers.object_list = queries.get_dealer_stats(dealers.object_list,
+                                                   vehicle, trim)
+    queries.add_price_stats(dealers.object_list, summaries)
+    places_for_js = [{'location': d['location'],
+                      'id': d['place_id'],
+                      'name': d['name']}
+                     for d in dealers.object_list]
+    # Set up template variables.
+    data['area_avg'] = area_stats['trimmed_mean'] if area_stats else 0
+    data['area_median'] = area_stats['median'] if area_stats else 0
+    data['dealers'] = dealers
+    data['form'] = form
+    data['form_action'] = 'area_summary'
+    data['places_json'] = json.dumps(places_for_js)
+    return _rtr('area_summary.html', data,
+                context_instance=RequestContext(request))
 
+@instrument.query_budget(12)
+@replicas.read_only
 def dealer_deals(request, place_id):
     """
-    Dealer deals view.
+    Dealer deals view. Cached; see core.page_cache.
     """
-    dealer = queries.get_dealer(place_id)
-    if 'data' in request.session and dealer:
-        data = request.session['data']
-        # Get the vehicle instance from the database.
-        v = data['vehicle']
-        vehicle = queries.get_vehicle(v['text']['year'], v['obj']['make'],
-                                      v['obj']['model'])
-        if not vehicle:
-            raise Http404
+    if 'selection' in request.session:
+        selection = request.session['selection']
         # Get the trim to send to the deals query.
         trim = None
         #  Try for the trim specified in the form.
-        form = TrimForm(request.GET, model_pk=v['obj']['model'],
-                        trim_year=v['text']['year'])
+        form = TrimForm(request.GET, model_pk=selection['model'],
+                        trim_year=selection['year'])
         # Fall back on the trim specified in the session.
-        if 'trim' not in request.GET and 'trim' in data:
-            form = TrimForm(data, model_pk=v['obj']['model'],
-                            trim_year=v['text']['year'])
+        if 'trim' not in request.GET and selection.get('trim'):
+            form = TrimForm({'trim': selection['trim']},
+                            model_pk=selection['model'],
+                            trim_year=selection['year'])
         if form.is_valid():
             trim = form.cleaned_data['trim']
         trim = trim if trim and int(trim) > 0 else None
-        # Look up the deals from the vehicle and dealer instances.
-        deals = queries.get_deals(vehicle, dealer, trim)
-        data['dealer'] = dealer
-        data['deals'] = deals
-        data['dealer_avg'] = get_deals_sum(deals) / (len(deals) if len(deals) > 0
-                                                     else 1)
-        data['form'] = form
-        data['form_action'] = 'dealer_deals'
-        place_data = util.get_dict(data['places']['results'], 'id', place_id)
-        data['place_json'] = json.dumps(place_data)
-        request.session['data'] = data
-        return _rtr('dealer_deals.html', request.session['data'],
-                    context_instance=RequestContext(request))
+        inputs = get_selection_inputs(selection) + (
+            place_id, trim, request.GET.get('after'), request.GET.get('before'))
+        return page_cache.get_page(
+            'dealer_deals', inputs,
+            [page_cache.get_dealer_key(selection['year'], selection['make'],
+                                       selection['model'], place_id)],
+            lambda: render_dealer_deals(request, selection, place_id, form,
+                                        trim))
     raise Http404
 
+def render_dealer_deals(request, selection, place_id, form, trim):
+    """
+    Dealer deals view helper function.
+
+    Returns HttpResponse.
+    """
+    dealer = queries.get_dealer(place_id)
+    # Get the vehicle instance from the database.
+    vehicle = queries.get_vehicle(selection['year'], selection['make'],
+                                  selection['model'])
+    if not dealer or not vehicle:
+        raise Http404
+    data = build_selection_context(selection)
+    # Page through the deals by price.
+    deals = pagination.get_keyset_page(
+        request, queries.get_deals(vehicle, dealer, trim), 'price', 20)
+    summaries, stats = queries.get_price_stats([place_id], vehicle, trim)
+    for deal in deals:
+        deal.outlier = price_stats.is_outlier(deal.price, stats)
+    data['dealer'] = dealer
+    data['deals'] = deals
+    data['dealer_avg'] = stats['trimmed_mean'] if stats else 0
+    data['dealer_median'] = stats['median'] if stats else 0
+    data['form'] = form
+    data['form_action'] = 'dealer_deals'
+    data['place_json'] = json.dumps(get_dealer_place(dealer))
+    return _rtr('dealer_deals.html', data,
+                context_instance=RequestContext(request))
+
+@instrument.query_budget(8)
+@replicas.read_only
 def deal_detail(request, deal_pk):
     """
-    Deal detail view.
+    Deal detail view. Flagged deals aren't shown. Cached; see
+    core.page_cache.
+    """
+    if 'selection' in request.session:
+        selection = request.session['selection']
+        return page_cache.get_page(
+            'deal_detail', get_selection_inputs(selection) + (int(deal_pk),),
+            [page_cache.get_deal_key(deal_pk)],
+            lambda: render_deal_detail(request, selection, deal_pk))
+    raise Http404
+
+def render_deal_detail(request, selection, deal_pk):
+    """
+    Deal detail view helper function.
+
+    Returns HttpResponse.
     """
     deal = queries.get_deal(deal_pk)
-    if 'data' in request.session and deal:
-        data = request.session['data']
-        data['deal'] = deal
-        # Clear the form action so that the trim filter isn't rendered.
-        if 'form_action' in data:
-            del data['form_action']
-        request.session['data'] = data
-        return _rtr('deal_detail.html', request.session['data'],
-                    context_instance=RequestContext(request))
+    if not deal or deal.flagged:
+        raise Http404
+    data = build_selection_context(selection)
+    data['deal'] = deal
+    data['dealer'] = deal.dealer
+    data['place_json'] = json.dumps(get_dealer_place(deal.dealer))
+    return _rtr('deal_detail.html', data,
+                context_instance=RequestContext(request))
+
+@instrument.query_budget(8)
+@replicas.read_only
+def price_trend(request):
+    """
+    Price trend view. Serves the monthly prices of the session selection's
+    vehicle and trim over the last settings.PRICE_TREND_MONTHS months as
+    JSON, at the dealer with the place_id GET parameter, or at the known
+    dealers in the area. Cached; see core.page_cache.
+
+    Returns HttpResponse.
+    """
+    if 'selection' in request.session:
+        selection = request.session['selection']
+        place_id = request.GET.get('place_id')
+        year, make, model = (selection['year'], selection['make'],
+                             selection['model'])
+        if place_id:
+            version_key = page_cache.get_dealer_key(year, make, model,
+                                                    place_id)
+        else:
+            version_key = page_cache.get_vehicle_key(year, make, model)
+        # The trend moves on a month at a time.
+        inputs = get_selection_inputs(selection) + (
+            place_id or selection['lat_lng'], selection.get('trim'),
+            date.today().strftime('%Y-%m'), geo.get_version())
+        return page_cache.get_page(
+            'price_trend', inputs, [version_key],
+            lambda: render_price_trend(selection, place_id))
     raise Http404
+
+def render_price_trend(selection, place_id):
+    """
+    Price trend view helper function.
+
+    Returns HttpResponse.
+    """
+    vehicle = queries.get_vehicle(selection['year'], selection['make'],
+                                  selection['model'])
+    trim = selection.get('trim')
+    if place_id:
+        place_ids = [place_id]
+    else:
+        place_ids = queries.get_nearby_dealer_ids(
+            selection['lat_lng'], vehicle, trim, settings.DEALER_SEARCH_RADIUS)
+    trend = queries.get_price_trend(place_ids, vehicle, trim,
+                                    settings.PRICE_TREND_MONTHS)
+    return HttpResponse(json.dumps({'months': trend}),
+                        content_type='application/json')
+
+def get_selection_inputs(selection):
+    """
+    Get the parts of the session selection that the cached pages show, and
+    the catalog version for the names.
+
+    Returns tuple.
+    """
+    return (selection['year'], selection['make'], selection['model'],
+            selection['location'], catalog.get_version())
+
+@staff_member_required
+def perf_stats(request):
+    """
+    Performance stats view, for staff. Serves this process's aggregated
+    request measurements as JSON. See core.instrument.
+
+    Returns HttpResponse.
+    """
+    return HttpResponse(json.dumps(instrument.get_stats(), sort_keys=True),
+                        content_type='application/json')
+
+@staff_member_required
+def price_export(request, kind, format):
+    """
+    Price export view, for staff. Streams the deals or the price statistics,
+    optionally limited to a vehicle pk and a dealer place id given as GET
+    params. See core.export.
+
+    Returns HttpResponse.
+    """
+    rows = export.iter_export(kind, format,
+                              vehicle=util.get_int(request.GET.get('vehicle')),
+                              dealer=request.GET.get('dealer'))
+    response = HttpResponse(rows, content_type=export.CONTENT_TYPES[format])
+    response['Content-Disposition'] = ('attachment; filename=%s.%s'
+                                       % (kind, format))
+    return response
     
 ### Google Maps API web service calls
 
 def get_places(location):
     """
-    Make a request to the Google Places API with the given location,
-    radius (in meters), GPS sensor, keyword, and types.
+    Get the car dealers near the given location from the Google Places API,
+    through the shared caching client.
 
-    Returns dictionary.
+    Returns dictionary. See places.build_places.
     """
-    geo_args = {'key': settings.GMAP_API_KEY,
-                'location': location,
-                'radius': '50000',
-                'sensor': 'false',
-                'keyword': 'car+dealer',
-                'types': 'car_dealer|establishment'}
-    url = settings.GMAP_PLACE_URL + '?' + urllib.urlencode(geo_args)
-    response = None
-    try:
-        usock = urllib.urlopen(url)
-        try:
-            response = json.load(usock)
-        finally:
-            usock.close()
-    except IOError:
-        pass
-    try:
-        if response and response['status'] == 'OK':
-            return build_places(response)
-    except KeyError:
-        pass
-    return {}
-    
-def build_places(response):
+    with instrument.timer('places'):
+        return places.get_client().search(location)
+
+def get_places_key(location):
     """
-    get_places helper function. Construct a dictionary of just the relevant
-    places data.
-    
-    Returns dictionary:
-        { 'results': [ { 'location': '',
-                         'id': '',
-                         'name': '',
-                         'vicinity': ''}]
-          'html_attributions': []}
-    """
-    results = [{'location': str(r['geometry']['location']['lat']) + ','
-                + str(r['geometry']['location']['lng']),
-                'id': r['id'],
-                'name': r['name'],
-                'vicinity': r['vicinity'] } for r in response['results']]
-    places = {'html_attributions': response['html_attributions']}
-    places['results'] = results
-    return places
+    Get the shared cache key for the places results of a location.
+
+    Returns string.
+    """
+    return 'places:' + hashlib.md5(location.encode('utf-8')).hexdigest()
@@ -15,6 +15,54 @@ MANAGERS = ADMINS
 
 DATABASES = {'default': dj_database_url.config(default='postgres://localhost')}
 
+# Read replicas, from the comma separated URLs of the DATABASE_REPLICA_URLS
+# environment variable. The read only views read from them, and a visitor who
+# enters a deal reads from the default database for DATABASE_REPLICA_LAG
+# seconds after. See core.replicas.
+for i, url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS',
+                                                    '').split(','))):
+    DATABASES['replica%d' % (i + 1)] = dict(dj_database_url.parse(url),
+                                            TEST_MIRROR='default')
+DATABASE_REPLICAS = tuple(sorted(alias for alias in DATABASES
+                                 if alias != 'default'))
+DATABASE_REPLICA_LAG = 10
+DATABASE_ROUTERS = ['core.replicas.ReplicaRouter']
+
+# PostgreSQL connections are kept in a per process pool between requests, of
+# up to DATABASE_POOL_SIZE idle connections per database. A connection idle for
+# more than DATABASE_POOL_CHECK_AFTER seconds is checked with a query before it
+# is reused, and one older than DATABASE_POOL_MAX_AGE seconds is closed. See
+# core.backends.postgresql_pool.
+for database in DATABASES.values():
+    if database['ENGINE'] == 'django.db.backends.postgresql_psycopg2':
+        database['ENGINE'] = 'core.backends.postgresql_pool'
+DATABASE_POOL_SIZE = 5
+DATABASE_POOL_CHECK_AFTER = 30
+DATABASE_POOL_MAX_AGE = 30 * 60
+
+# The dealer index version stamp (see core.geo) and the cached catalog version
+# (see core.catalog) live in the default cache. Use a backend shared between
+# processes, e.g. memcached, when running more than one.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Vehicle selection option responses are keyed by the catalog version, so they
+# can be cached for as long as a year.
+CATALOG_OPTIONS_MAX_AGE = 365 * 24 * 60 * 60
+
+# Catalog index snapshot, built at deploy by the build_catalog_snapshot command
+# and loaded by each process instead of querying the catalog tables. Ignored if
+# missing. See core.catalog.
+CATALOG_SNAPSHOT = os.path.join(SITE_ROOT, 'catalog.snapshot')
+
+# The catalog version is read from the database and kept in the cache for
+# CATALOG_VERSION_TTL seconds. Catalog edits clear it, so with a cache shared
+# between processes they take effect at once, and otherwise within that time.
+CATALOG_VERSION_TTL = 60
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -90,6 +138,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'core.instrument.InstrumentMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -143,6 +192,10 @@ LOGGING = {
         'mail_admins': {
             'level': 'ERROR',
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'DEBUG',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -151,9 +204,109 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # Request measurements, one JSON line per request at DEBUG, and slow
+        # or over budget requests at WARNING. See core.instrument.
+        'core.instrument': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        # Failed deferred tasks. See core.tasks.
+        'core.tasks': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        # Records rejected by deal imports. See core.ingest.
+        'core.ingest': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     }
 }
 
+# Secondary work after a deal is stored, the deal stats and page cache
+# updates, is queued in the core_task table and run by the process_tasks
+# command. See core.tasks. With TASKS_EAGER, it is run in the request instead,
+# after the deal is committed.
+TASKS_EAGER = False
+# Most tasks run in one transaction by a worker.
+TASK_BATCH_SIZE = 500
+# Failing tasks are retried this many times, and then kept for inspection.
+TASK_MAX_ATTEMPTS = 5
+
+# Requests slower than this are logged as warnings by core.instrument.
+PERF_SLOW_REQUEST_MS = 1000
+# Raise an error when a view runs more queries than its declared budget.
+# Turned on in tests with core.instrument.enforce_query_budgets.
+PERF_ENFORCE_BUDGETS = False
+
 # Google Maps API settings
 GMAP_PLACE_URL = 'https://maps.googleapis.com/maps/api/place/search/json'
 GMAP_API_KEY = 'my_api_key'
+# Seconds to wait for the Places connection, and then for each response read.
+GMAP_CONNECT_TIMEOUT = 2.0
+GMAP_READ_TIMEOUT = 5.0
+# Places search results are cached per process, keyed on the location rounded
+# to GMAP_PLACE_CACHE_PRECISION decimal places (2 is roughly 1 km).
+GMAP_PLACE_CACHE_SIZE = 1000
+GMAP_PLACE_CACHE_TTL = 60 * 60
+GMAP_PLACE_CACHE_PRECISION = 2
+# A search runs one query per keyword in parallel, on GMAP_FETCH_THREADS
+# threads per process, and returns the first pages of 20 results it has after
+# GMAP_SEARCH_DEADLINE seconds. Up to GMAP_PLACE_MAX_PAGES pages per keyword
+# are then fetched in the background, as Google requires a pause of about
+# GMAP_PAGE_TOKEN_DELAY seconds before a page token can be used.
+GMAP_PLACE_KEYWORDS = ('car+dealer', 'used+cars')
+GMAP_PLACE_MAX_PAGES = 3
+GMAP_PAGE_TOKEN_DELAY = 2.0
+GMAP_SEARCH_DEADLINE = GMAP_CONNECT_TIMEOUT + GMAP_READ_TIMEOUT
+GMAP_FETCH_THREADS = 8
+# Dealers are enriched with Place Details by the enrich_dealers command, in
+# batches of GMAP_ENRICH_BATCH_SIZE, at most GMAP_DETAILS_RATE lookups per
+# second; a dealer whose lookup fails GMAP_ENRICH_MAX_ATTEMPTS times is given
+# up on. Their pages then show a Static Maps image of GMAP_STATIC_MAP_SIZE
+# pixels (the .map style) rather than a JavaScript map. See core.enrich.
+GMAP_ENRICH_BATCH_SIZE = 50
+GMAP_ENRICH_MAX_ATTEMPTS = 5
+GMAP_DETAILS_RATE = 5
+GMAP_STATIC_MAP_URL = 'https://maps.googleapis.com/maps/api/staticmap'
+GMAP_STATIC_MAP_SIZE = '250x150'
+
+# Area searches use the known dealers within DEALER_SEARCH_RADIUS meters, from
+# an in-process grid index of DEALER_INDEX_CELL_SIZE degree cells.
+DEALER_SEARCH_RADIUS = 50000
+DEALER_INDEX_CELL_SIZE = 0.1
+
+# Fraction of the lowest and of the highest prices left out of the trimmed
+# mean that is shown as the average price. See core.price_stats.
+PRICE_TRIM_FRACTION = 0.1
+
+# Price statistics are computed exactly from up to PRICE_EXACT_LIMIT deals, and
+# estimated from the merged price sketches of the deal stats beyond that. See
+# core.sketches.
+PRICE_EXACT_LIMIT = 2000
+
+# Months of monthly prices shown by the price trend view, including the
+# current one. See queries.get_price_trend.
+PRICE_TREND_MONTHS = 24
+
+# Entered deals are flagged as spam, and left out of the deal lists and price
+# aggregates, when their IP address has entered more than SPAM_IP_LIMIT deals,
+# or their email more than SPAM_USER_LIMIT, within SPAM_WINDOW seconds, or when
+# they repeat a deal of their user for the same vehicle, dealer, and date at a
+# price within SPAM_DUPLICATE_PRICE_STEP dollars. The deals are counted in the
+# SPAM_CACHE_ALIAS cache, in SPAM_WINDOW_SLOTS slots. See core.spam.
+SPAM_IP_LIMIT = 20
+SPAM_USER_LIMIT = 10
+SPAM_WINDOW = 60 * 60
+SPAM_WINDOW_SLOTS = 12
+SPAM_DUPLICATE_PRICE_STEP = 100
+SPAM_CACHE_ALIAS = 'default'
+
+# The area summary, dealer deals, and deal detail pages are cached in this
+# cache for up to PAGE_CACHE_TTL seconds, and invalidated when their deals
+# change. See core.page_cache.
+PAGE_CACHE_ALIAS = 'default'
+PAGE_CACHE_TTL = 24 * 60 * 60
@@ -5,3 +5,7 @@ from settings import *
 DATABASES = {'default': dj_database_url.config(default='sqlite:////'
                                                + os.path.join(SITE_ROOT,
                                                               'sqlite3.db'))}
+DATABASE_REPLICAS = ()
+
+# Run the deferred tasks in the request, so that no worker is needed.
+TASKS_EAGER = True